@@ -0,0 +1,578 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for riakkit. Run with python bench_all.py [--json] [group]
+
+None of these talks to a Riak server. The documents groups use MemoryClient,
+an in-memory stand-in for RiakClient, so they measure riakkit and not the
+network.
+
+With --json, every result is printed as a line of JSON:
+  {"group": ..., "name": ..., "number": ..., "us": ..., "riakkit": ..., "python": ...}
+which could be appended to a file to track regressions over time.
+"""
+
+import json
+import platform
+import time
+
+from riakkit import *
+import riakkit
+from riakkit.queries import _MAP_OBJECT
+
+import riak
+from riak.mapreduce import RiakLink
+
+_json = False
+_group = None
+
+def bench(name, func, number):
+  """Runs func number of times and prints the time per call.
+
+  Returns:
+    The seconds per call.
+  """
+  start = time.time()
+  for i in xrange(number):
+    func()
+  elapsed = (time.time() - start) / number
+  if _json:
+    print json.dumps({"group" : _group, "name" : name, "number" : number,
+                      "us" : round(elapsed * 1000000, 3),
+                      "riakkit" : riakkit.__version__,
+                      "python" : platform.python_version()})
+  else:
+    print "%-50s %12.2f us" % (name, elapsed * 1000000)
+  return elapsed
+
+###############################################################################
+# In-memory Riak
+
+class MemoryIndexEntry(object):
+  def __init__(self, field, value):
+    self._field = field
+    self._value = value
+
+  def get_field(self):
+    return self._field
+
+  def get_value(self):
+    return self._value
+
+
+class MemoryObject(object):
+  """Stands in for RiakObject. The data is encoded when stored and decoded
+  when fetched, like it would be over the network."""
+  def __init__(self, bucket, key, data=None, content_type="application/json"):
+    self._bucket = bucket
+    self._key = key
+    self._data = data
+    self._content_type = content_type
+    self._links = []
+    self._indexes = []
+    self._exists = False
+
+  def get_key(self):
+    return self._key
+
+  def get_bucket(self):
+    return self._bucket
+
+  def get_data(self):
+    return self._data
+
+  def set_data(self, data):
+    self._data = data
+    return self
+
+  def get_content_type(self):
+    return self._content_type
+
+  def set_content_type(self, content_type):
+    self._content_type = content_type
+    return self
+
+  def get_links(self):
+    return self._links
+
+  def set_links(self, links, all_link=False):
+    self._links = list(links)
+    return self
+
+  def get_indexes(self):
+    return self._indexes
+
+  def set_indexes(self, indexes):
+    self._indexes = [MemoryIndexEntry(field, value) for field, value in indexes]
+    return self
+
+  def exists(self):
+    return self._exists
+
+  def store(self, w=None, dw=None, **kwargs):
+    self._bucket._store(self)
+    self._exists = True
+    return self
+
+  def reload(self, r=None, vtag=None, **kwargs):
+    self._bucket._fetch(self)
+    return self
+
+  def delete(self, rw=None, **kwargs):
+    self._bucket._objects.pop(self._key, None)
+    self._exists = False
+    self._data = None
+    return self
+
+
+class MemoryBucket(object):
+  """Stands in for RiakBucket."""
+  def __init__(self, client, name):
+    self._client = client
+    self._name = name
+    self._objects = {} # key => (content type, encoded data, links, indexes)
+    self._encoders = {"application/json" : json.dumps}
+    self._decoders = {"application/json" : json.loads}
+
+  def get_name(self):
+    return self._name
+
+  def get_encoder(self, content_type):
+    return self._encoders.get(content_type)
+
+  def set_encoder(self, content_type, encoder):
+    self._encoders[content_type] = encoder
+    return self
+
+  def get_decoder(self, content_type):
+    return self._decoders.get(content_type)
+
+  def set_decoder(self, content_type, decoder):
+    self._decoders[content_type] = decoder
+    return self
+
+  def new(self, key, data=None, content_type="application/json"):
+    return MemoryObject(self, key, data, content_type)
+
+  def get(self, key, r=None):
+    return self._fetch(MemoryObject(self, key))
+
+  def _store(self, obj):
+    encoded = self._encoders[obj._content_type](obj._data)
+    links = [(l.get_bucket(), l.get_key(), l.get_tag()) for l in obj._links]
+    indexes = [(i.get_field(), i.get_value()) for i in obj._indexes]
+    self._objects[obj._key] = (obj._content_type, encoded, links, indexes)
+
+  def _fetch(self, obj):
+    stored = self._objects.get(obj._key)
+    obj._exists = stored is not None
+    if stored is None:
+      obj._data = None
+      obj._links = []
+      obj._indexes = []
+    else:
+      content_type, encoded, links, indexes = stored
+      obj._content_type = content_type
+      obj._data = self._decoders[content_type](encoded)
+      obj._links = [RiakLink(*l) for l in links]
+      obj.set_indexes(indexes)
+    return obj
+
+
+class MemoryIndexQuery(object):
+  """Stands in for the RiakMapReduce of an index lookup, without phases."""
+  def __init__(self, bucket, index, startkey, endkey=None):
+    self._bucket = bucket
+    self._index = index
+    self._startkey = startkey
+    self._endkey = startkey if endkey is None else endkey
+
+  def run(self, timeout=None):
+    name = self._bucket.get_name()
+    return [RiakLink(name, key) for key, (ct, d, l, indexes) in self._bucket._objects.iteritems()
+            if any(field == self._index and self._startkey <= value <= self._endkey
+                   for field, value in indexes)]
+
+
+class MemoryMapReduce(object):
+  """Stands in for the RiakMapReduce fetching documents by their keys
+  (Document._loadMany), which only has the _MAP_OBJECT phase."""
+  def __init__(self, client):
+    self._client = client
+    self._inputs = []
+
+  def add(self, bucket, key):
+    self._inputs.append((bucket, key))
+    return self
+
+  def map(self, function, options=None):
+    if function != _MAP_OBJECT:
+      raise NotImplementedError("Only _MAP_OBJECT is run in memory.")
+    return self
+
+  def run(self, timeout=None):
+    result = []
+    for name, key in self._inputs:
+      stored = self._client.bucket(name)._objects.get(key)
+      if stored is not None:
+        content_type, encoded, links, indexes = stored
+        result.append([name, key, encoded, content_type, map(list, links), map(list, indexes), None])
+    return result
+
+
+class MemoryClient(object):
+  """Stands in for RiakClient: buckets, index lookups and fetches by key."""
+  def __init__(self):
+    self._buckets = {}
+
+  def bucket(self, name):
+    if name not in self._buckets:
+      self._buckets[name] = MemoryBucket(self, name)
+    return self._buckets[name]
+
+  def index(self, bucket, index, startkey, endkey=None):
+    return MemoryIndexQuery(self.bucket(bucket), index, startkey, endkey)
+
+  def add(self, bucket, key):
+    return MemoryMapReduce(self).add(bucket, key)
+
+###############################################################################
+
+class BenchReferenced(SimpleDocument):
+  pass
+
+def largeModel(fields=50):
+  """Creates a SimpleDocument class with fields * 4 fields."""
+  attrs = {}
+  for i in xrange(fields):
+    attrs["int%d" % i] = IntegerProperty(validators=lambda x: x is None or x >= 0)
+    attrs["str%d" % i] = StringProperty(validators=lambda x: x is None or len(x) < 100)
+    attrs["ref%d" % i] = ReferenceProperty(BenchReferenced)
+    attrs["list%d" % i] = ListProperty(validators=lambda x: all(isinstance(v, int) for v in x))
+  return type("BenchLargeModel%d" % fields, (SimpleDocument, ), attrs)
+
+def largeDocument(cls, fields=50):
+  doc = cls()
+  referenced = BenchReferenced()
+  for i in xrange(fields):
+    doc["int%d" % i] = i
+    doc["str%d" % i] = "string %d" % i
+    doc["ref%d" % i] = referenced
+    doc["list%d" % i] = range(20)
+  return doc
+
+def benchValidation():
+  bucket = riak.RiakClient().bucket("bench")
+  doc = largeDocument(largeModel())
+  bench("repeated save (toRiakObject) of 200 fields", lambda: doc.toRiakObject(bucket), 200)
+  bench("repeated serialize of 200 fields", doc.serialize, 200)
+  bench("valid() of 200 fields", doc.valid, 200)
+
+  def changeOneAndSave():
+    doc.int0 += 1
+    doc.toRiakObject(bucket)
+  bench("change 1 field and save of 200 fields", changeOneAndSave, 200)
+
+  for prop, value in ((IntegerProperty(), "12"), (FloatProperty(), "1.5"), (StringProperty(), "a")):
+    name = prop.__class__.__name__
+    bench("%s validate + standardize" % name, lambda: prop.validate(value) and prop.standardize(value), 100000)
+    bench("%s setter" % name, lambda: prop.setter()(value), 100000)
+
+  for label, kwargs in (("local time", {}), ("utc", {"utc" : True}),
+                        ("utc milliseconds", {"utc" : True, "milliseconds" : True})):
+    attrs = dict(("time%d" % i, DateTimeProperty(**kwargs)) for i in xrange(20))
+    cls = type("BenchEvent", (BaseDocument, ), attrs)
+    timestamp = 1330559998000 if kwargs.get("milliseconds") else 1330559998
+    data = dict(("time%d" % i, timestamp + i) for i in xrange(20))
+    bench("deserialize 20 DateTimeProperty (%s)" % label, lambda: cls().deserialize(data), 1000)
+    bench("mergeData of 20 timestamps (%s)" % label, lambda: cls().mergeData(data), 1000)
+    doc = cls().mergeData(data)
+    bench("serialize 20 DateTimeProperty (%s)" % label, doc.serialize, 1000)
+
+def benchContainers():
+  plain = []
+  tracked = TrackedList()
+  bench("list.append", lambda: plain.append(1), 100000)
+  bench("TrackedList.append", lambda: tracked.append(1), 100000)
+
+  plain = set()
+  tracked = TrackedSet()
+  bench("set.add", lambda: plain.add(1), 100000)
+  bench("TrackedSet.add", lambda: tracked.add(1), 100000)
+
+  plain = {}
+  tracked = DictProperty.DotDict()
+  bench("dict.__setitem__", lambda: plain.__setitem__("a", 1), 100000)
+  bench("DotDict.__setitem__", lambda: tracked.__setitem__("a", 1), 100000)
+
+class BenchParent(SimpleDocument):
+  children = MultiReferenceProperty(BenchReferenced)
+
+def benchReferences():
+  """Membership and removal in collections of n references, what Document.save
+  and deleteReference do for every child saved or deleted."""
+  prop = BenchParent._meta["children"]
+  child = BenchReferenced("child0")
+  for n in (1000, 10000, 50000):
+    keys = ["child%d" % i for i in xrange(n)]
+
+    plain = list(keys)
+    bench("linear search in %d references" % n, lambda: "missing" in plain, 200)
+
+    references = ReferenceList(keys)
+    references.hasKey("missing") # Builds the index
+    bench("ReferenceList.hasKey in %d references" % n, lambda: references.hasKey("missing"), 100000)
+
+    parent = BenchParent(children=keys)
+    parent.children.hasKey("missing") # Builds the index
+    def removeAndAdd():
+      prop.deleteReference(parent, child)
+      parent.children.append(child)
+    bench("deleteReference + append in %d references" % n, removeAndAdd, 1000)
+
+    # A different key every time, from the start of the list.
+    front = iter(keys)
+    def removeFront():
+      parent.children.removeKey(next(front))
+    bench("ReferenceList.removeKey in %d references" % n, removeFront, 500)
+
+def benchRelations():
+  doc = BenchReferenced()
+  for i in xrange(50):
+    doc.addIndex("field%d_int" % i, i)
+    doc.addLink(BenchReferenced(), "tag%d" % i)
+
+  bench("indexes() of 50 indexes", doc.indexes, 10000)
+  bench("indexesView() of 50 indexes", doc.indexesView, 10000)
+  bench("links() of 50 links", doc.links, 10000)
+  bench("linksView() of 50 links", doc.linksView, 10000)
+  bench("setIndexes of 50 indexes", lambda: doc.setIndexes(doc._indexes), 10000)
+
+  linked = [BenchReferenced() for i in xrange(10000)]
+  for d in linked:
+    doc.addLink(d)
+  bench("removeLink + addLink in 10000 links", lambda: doc.removeLink(linked[0]).addLink(linked[0]), 10000)
+
+def benchIndexCollection():
+  """Looking up documents in memory by their indexes, with IndexCollection
+  and with a loop over indexes() like one would do without it."""
+  docs = [BenchReferenced("doc%d" % i).addIndex("age_int", i % 100).addIndex("name_bin", "name%d" % i)
+          for i in xrange(100000)]
+  collection = []
+  bench("IndexCollection of 100000 documents", lambda: collection.append(IndexCollection(docs)), 1)
+  collection = collection[0]
+
+  def loop():
+    return [d for d in docs if ("name_bin", "name5") in d.indexes()]
+  bench("loop over indexes(), exact _bin", loop, 1)
+  bench("IndexCollection exact _bin", lambda: collection.indexLookup("name_bin", "name5"), 10000)
+  bench("IndexCollection range _int (3000 documents)", lambda: collection.indexLookup("age_int", 10, 12), 100)
+  bench("addIndex + removeIndex in a collection", lambda: docs[0].addIndex("age_int", 500).removeIndex("age_int", 500), 10000)
+
+memoryClient = MemoryClient()
+
+def schema(fields):
+  """The properties of a schema with fields * 4 fields."""
+  attrs = {}
+  for i in xrange(fields):
+    attrs["int%d" % i] = IntegerProperty()
+    attrs["str%d" % i] = StringProperty()
+    attrs["list%d" % i] = ListProperty()
+    attrs["dict%d" % i] = DictProperty()
+  return attrs
+
+def schemaValues(fields):
+  values = {}
+  for i in xrange(fields):
+    values["int%d" % i] = i
+    values["str%d" % i] = "string %d" % i
+    values["list%d" % i] = range(10)
+    values["dict%d" % i] = {"a" : i, "b" : "value"}
+  return values
+
+def schemaClasses(name, fields):
+  """Creates the same schema as a BaseDocument, a SimpleDocument and a
+  Document class."""
+  attrs = dict(schema(fields), client=memoryClient, bucket_name="bench_%s" % name.lower())
+  return [type("BenchBase%s" % name, (BaseDocument, ), schema(fields)),
+          type("BenchSimple%s" % name, (SimpleDocument, ), schema(fields)),
+          type("BenchDocument%s" % name, (Document, ), attrs)]
+
+def benchDocuments():
+  """The same operations on BaseDocument, SimpleDocument and Document, with a
+  small (4 fields) and a large (200 fields) schema."""
+  bucket = memoryClient.bucket("bench_simple")
+
+  class Plain(object):
+    def __init__(self):
+      self.int0 = 1
+      self.str0 = "a"
+  plain = Plain()
+  def getattrsPlain():
+    plain.int0
+    plain.str0
+  bench("getattr x2 plain object", getattrsPlain, 100000)
+
+  for name, fields, number in (("Small", 1, 10000), ("Large", 50, 200)):
+    values = schemaValues(fields)
+    for cls in schemaClasses(name, fields):
+      label = "%s (%d fields)" % (cls.__bases__[0].__name__, fields * 4)
+      bench("construct %s" % label, lambda: cls(**values), number)
+
+      doc = cls(**values)
+      def setattrs():
+        doc.int0 = 1
+        doc.str0 = "a"
+      bench("setattr x2 %s" % label, setattrs, number * 10)
+      def getattrs():
+        doc.int0
+        doc.str0
+      bench("getattr x2 %s" % label, getattrs, number * 10)
+      bench("mergeData %s" % label, lambda: doc.mergeData(values), number)
+      bench("construct + serialize %s" % label, lambda: cls(**values).serialize(), number)
+      data = doc.serialize()
+      bench("deserialize %s" % label, lambda: doc.deserialize(data), number)
+
+      if issubclass(cls, Document):
+        bench("save %s" % label, doc.save, number)
+        key = doc.key
+        doc = None
+        bench("load (not cached) %s" % label, lambda: cls.load(key), number)
+      elif issubclass(cls, SimpleDocument):
+        bench("toRiakObject %s" % label, lambda: doc.toRiakObject(bucket), number)
+        robj = doc.toRiakObject(bucket).store()
+        bench("SimpleDocument.load %s" % label, lambda: cls.load(bucket.get(robj.get_key())), number)
+
+class BenchUser(Document):
+  client = memoryClient
+  bucket_name = "bench_users"
+
+  username = StringProperty(unique=True)
+  age = IntegerProperty(index=True)
+
+class BenchPost(Document):
+  client = memoryClient
+  bucket_name = "bench_posts"
+
+  author = ReferenceProperty(BenchUser, collection_name="posts")
+  content = StringProperty()
+
+def benchPersistence():
+  """Document.save with uniques and collection_name, loading with links and
+  hydrating the results of a query."""
+  counter = [0]
+  def saveUser():
+    counter[0] += 1
+    BenchUser(username="user%d" % counter[0], age=counter[0] % 100).save()
+  bench("save with a unique and an index", saveUser, 1000)
+
+  author = BenchUser(username="author", age=30).save()
+  bench("save with collection_name", lambda: BenchPost(author=author, content="hi").save(), 1000)
+
+  post = BenchPost(author=author.key, content="hi")
+  bench("read a ReferenceProperty (loaded once)", lambda: post.author, 10000)
+  bench("read a collection_name of 1000 documents", lambda: author.posts, 10000)
+
+  linked = [BenchUser(username="linked%d" % i).save() for i in xrange(20)]
+  user = BenchUser(username="links", age=30)
+  for doc in linked:
+    user.addLink(doc, "friend")
+  key = user.save().key
+  del user
+  bench("load (not cached) with 20 links", lambda: BenchUser.load(key), 1000)
+  bench("load (not cached) and links() of 20 links", lambda: BenchUser.load(key).links(), 1000)
+
+  bench("query hydration (10 documents)", lambda: BenchUser.query(age=5).all(), 100)
+  bench("query hydration (100 documents)", lambda: BenchUser.query(age__range=(0, 9)).all(), 10)
+
+def benchCompact():
+  """The size and speed of CompactCodec against JSON, for a document with
+  enums, booleans and a set."""
+  from riakkit.commons.codecs import CompactCodec
+
+  attrs = {"kind" : EnumProperty(["view", "click", "purchase"]),
+           "tags" : SetProperty(), "count" : IntegerProperty(),
+           "at" : DateTimeProperty(utc=True)}
+  for i in xrange(8):
+    attrs["flag%d" % i] = BooleanProperty()
+  layout = sorted(attrs)
+
+  for label, codec in (("json", "json"), ("compact", CompactCodec([layout]))):
+    cls = type("BenchCompact", (BaseDocument, ), dict(attrs, codec=codec))
+    doc = cls(kind="click", tags=set(["b", "a", "c"]), count=12, at=1330559998,
+              **dict(("flag%d" % i, i % 2 == 0) for i in xrange(8)))
+    encoded = doc.serialize(False)
+    bench("serialize(False) %s (%d bytes)" % (label, len(encoded)), lambda: doc.serialize(False), 10000)
+    bench("deserialize %s" % label, lambda: cls().deserialize(encoded), 10000)
+
+def benchStartup():
+  """Defining the models of an application, and importing riakkit."""
+  import subprocess
+  import sys
+
+  counter = [0]
+  def define():
+    counter[0] += 1
+    attrs = dict(schema(5), client=memoryClient, bucket_name="bench_startup%d" % counter[0],
+                 username=StringProperty(unique=True), email=StringProperty(unique=True))
+    type("BenchStartup%d" % counter[0], (Document, ), attrs)
+  bench("define a Document class (22 fields, 2 uniques)", define, 300)
+
+  def hierarchy():
+    counter[0] += 1
+    parent = Document
+    for i in xrange(500):
+      attrs = {"field%d" % i : StringProperty(), "client" : memoryClient,
+               "bucket_name" : "bench_hierarchy%d_%d" % (counter[0], i)}
+      if i % 50 == 0:
+        attrs["unique%d" % i] = StringProperty(unique=True)
+      parent = type("BenchHierarchy%d" % i, (parent, ), attrs)
+  bench("define 500 Document classes, each a subclass of the previous one", hierarchy, 3)
+
+  def wide():
+    counter[0] += 1
+    mixins = [type("BenchMixin%d" % i, (SimpleDocument, ), {"mixin%d" % i : StringProperty()}) for i in xrange(10)]
+    for i in xrange(500):
+      parents = (mixins[i % 10], mixins[(i + 3) % 10])
+      type("BenchWide%d" % i, parents, {"field" : StringProperty()})
+  bench("define 500 SimpleDocument classes with 2 parents each", wide, 3)
+
+  python = lambda code: subprocess.check_call([sys.executable, "-c", code])
+  bench("start python", lambda: python("pass"), 5)
+  bench("start python and import riakkit", lambda: python("import riakkit"), 5)
+
+if __name__ == "__main__":
+  import sys
+  args = sys.argv[1:]
+  _json = "--json" in args
+  args = [a for a in args if a != "--json"]
+  arg = args[0] if args else "all"
+
+  groups = {
+    "compact" : benchCompact,
+    "containers" : benchContainers,
+    "documents" : benchDocuments,
+    "indexcollection" : benchIndexCollection,
+    "persistence" : benchPersistence,
+    "references" : benchReferences,
+    "relations" : benchRelations,
+    "startup" : benchStartup,
+    "validation" : benchValidation,
+  }
+
+  for name in sorted(groups):
+    if arg in (name, "all"):
+      _group = name
+      groups[name]()
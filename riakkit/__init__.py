@@ -17,10 +17,11 @@
 contents in a convinient fashion.
 
 It imports everything from under commons.properties as well as
-commons.exceptions It also import SimpleDocument, BaseDocument, and Document.
+commons.exceptions It also import SimpleDocument, BaseDocument, IndexCollection
+and Document.
 This also sets up EmDocument"""
 
-from riakkit.simple import SimpleDocument, BaseDocument
+from riakkit.simple import SimpleDocument, BaseDocument, IndexCollection
 EmDocument = BaseDocument
 from riakkit.document import Document
 from riakkit.commons.properties import *
@@ -0,0 +1,192 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Back references (collection_name) that are not stored inside the referenced
+document.
+
+By default, collection_name adds a MultiReferenceProperty to the referenced
+class, holding the keys of every document that refers to it. With
+collection_storage="sharded", the keys are kept in collection_shards shard
+objects instead, in the bucket _<bucket_name>_rs_<collection_name> under the
+keys <parent key>:<shard number>. Saving a document that refers to another
+only rewrites one shard, and the referenced document is never loaded or
+saved.
+
+getattr(parent, collection_name) then gives a ShardedQuery, which reads the
+shards one at a time as it is iterated.
+
+With collection_storage="index", nothing is stored besides the referring
+document itself: it gets the secondary index <property name>_bin with the keys
+it refers to, and getattr(parent, collection_name) is an index lookup. Saving a
+referring document is then a single write.
+"""
+
+from zlib import crc32
+
+from riakkit.commons import getShardsGivenBucketName
+from riakkit.commons.instrumentation import timed, GET, STORE, DELETE
+from riakkit.queries import ShardedQuery
+
+
+class Collection(object):
+  """The collection_name of a reference property when it is not stored in the
+  referenced document. This is installed as a descriptor on the referenced
+  class.
+
+  Attributes:
+    cls: The class that refers to the owner of the collection.
+    name: The name of the reference property in cls.
+    collection_name: The name of the collection.
+    owner: The referenced class.
+  """
+  def __init__(self, cls, name, collection_name):
+    self.cls = cls
+    self.name = name
+    self.collection_name = collection_name
+    self.owner = None
+
+  def bind(self, owner):
+    """Attaches this collection to the referenced class.
+
+    Args:
+      owner: The referenced class (reference_class of the property).
+    """
+    self.owner = owner
+    owner._collections[self.collection_name] = self
+    setattr(owner, self.collection_name, self)
+
+  def __get__(self, parent, cls):
+    if parent is None:
+      return self
+    return self.query(parent.key)
+
+  def query(self, parentKey):
+    """Gets the documents in the collection of parentKey."""
+    raise NotImplementedError
+
+  def update(self, doc, value):
+    """Called by Document.save when the reference property of doc changed,
+    before doc is stored.
+
+    Args:
+      doc: The referring document.
+      value: The value of its reference property.
+    """
+    pass
+
+  def add(self, parentKey, key, w=None, dw=None):
+    """Adds the key of a referring document to the collection of parentKey.
+    Called after the referring document is stored."""
+    pass
+
+  def remove(self, parentKey, key, w=None, dw=None):
+    """Removes the key of a referring document from the collection of
+    parentKey. Called after the referring document is stored or deleted."""
+    pass
+
+  def clear(self, parentKey, rw=None):
+    """Called when the document with parentKey is deleted."""
+    pass
+
+
+class ShardedCollection(Collection):
+  """A collection stored in shard objects.
+
+  Attributes:
+    shards: The number of shards per referenced document.
+  """
+  def __init__(self, cls, name, collection_name, shards):
+    Collection.__init__(self, cls, name, collection_name)
+    self.shards = shards
+    self._bucket = None
+
+  @property
+  def bucket(self):
+    if self._bucket is None:
+      self._bucket = self.owner.client.bucket(getShardsGivenBucketName(self.owner.bucket_name, self.collection_name))
+    return self._bucket
+
+  def query(self, parentKey):
+    """Gets the collection of parentKey as a ShardedQuery."""
+    return ShardedQuery(self, parentKey)
+
+  def shardKey(self, parentKey, number):
+    return "%s:%d" % (parentKey, number)
+
+  def shardOf(self, key):
+    """Gets the shard number that holds the key of a referring document."""
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+    return (crc32(key) & 0xffffffff) % self.shards
+
+  def shard(self, parentKey, number):
+    """Gets the RiakObject of a shard. Its data is the list of keys."""
+    key = self.shardKey(parentKey, number)
+    return timed(GET, self.cls, self.bucket.get_name(), key, self.bucket.get, key)
+
+  def add(self, parentKey, key, w=None, dw=None):
+    """Adds the key of a referring document to the collection of parentKey."""
+    obj = self.shard(parentKey, self.shardOf(key))
+    keys = obj.get_data() if obj.exists() else None
+    keys = keys or []
+    if key not in keys:
+      keys.append(key)
+      obj.set_data(keys)
+      self._store(obj, w, dw)
+
+  def remove(self, parentKey, key, w=None, dw=None):
+    """Removes the key of a referring document from the collection of
+    parentKey."""
+    obj = self.shard(parentKey, self.shardOf(key))
+    if not obj.exists():
+      return
+
+    keys = obj.get_data() or []
+    if key in keys:
+      keys.remove(key)
+      obj.set_data(keys)
+      self._store(obj, w, dw)
+
+  def clear(self, parentKey, rw=None):
+    """Deletes all the shards of parentKey."""
+    for number in xrange(self.shards):
+      obj = self.shard(parentKey, number)
+      if obj.exists():
+        timed(DELETE, self.cls, self.bucket.get_name(), obj.get_key(), obj.delete, rw=rw)
+
+  def _store(self, obj, w, dw):
+    timed(STORE, self.cls, self.bucket.get_name(), obj.get_key(), obj.store, w=w, dw=dw)
+
+
+class IndexedCollection(Collection):
+  """A collection looked up through a secondary index of the referring
+  documents.
+
+  Attributes:
+    index: The name of the index, <property name>_bin.
+  """
+  def __init__(self, cls, name, collection_name):
+    Collection.__init__(self, cls, name, collection_name)
+    self.index = "%s_bin" % name
+
+  def query(self, parentKey):
+    """Gets the collection of parentKey as a MapReduceQuery."""
+    return self.cls.indexLookup(self.index, parentKey)
+
+  def update(self, doc, value):
+    if self.index in doc._indexes:
+      doc.removeIndex(self.index)
+    for key in doc._referenceKeys(value):
+      doc.addIndex(self.index, key)
@@ -58,10 +58,25 @@ def getUniqueListGivenBucketName(bucketName, propertyName):
   """
   return "_%s_ul_%s" % (bucketName, propertyName)
 
+def getShardsGivenBucketName(bucketName, collectionName):
+  """Gets the bucket name that holds the shards of a sharded collection_name.
+
+  Args:
+    bucketName: The name of the bucket of the referenced class
+    collectionName: The collection name
+
+  Returns:
+    Returns the bucket name.
+  """
+  return "_%s_rs_%s" % (bucketName, collectionName)
+
 def walkParents(parents, bases=("Document", "type", "object")):
   """Walks through the parents and return each parent class object uptil the
   name of the classes specified in bases.
 
+  The result is computed once for every parents and bases, and cached on the
+  first parent (in its _parentsWalks), so it goes away with the class.
+
   Args:
     p: The list of direct parents of a class object
     bases: The name of the classes that's considered to to be the ones that
@@ -69,26 +84,54 @@ def walkParents(parents, bases=("Document", "type", "object")):
            Default: ("Document", "type", "object")
 
   Returns:
-    A list of all the parents, every level. Ordered via breath first search,
-    although each levels are not separated
+    A list of all the parents, every level. Ordered like the method resolution
+    order of a class with these parents.
   """
-  frontier = parents
-  next = []
-  all_parents = []
-  found = False
-  while not found:
-    found = True
-    for cls in frontier:
-      if cls.__name__ not in bases:
-        found = False
-        if cls not in all_parents: # Inefficient
-          all_parents.append(cls)
-          next.extend(cls.__bases__)
-
-    frontier = next
-    next = []
-
-  return all_parents
+  parents = tuple(parents)
+  key = (parents[1:], tuple(bases))
+  walks = parents[0].__dict__.get("_parentsWalks")
+  walk = walks.get(key) if walks is not None else None
+  if walk is None:
+    order = _linearize(parents)
+    ends = set()
+    for cls in order:
+      if cls.__name__ in bases:
+        ends.update(cls.__mro__)
+    walk = tuple(cls for cls in order if cls not in ends)
+    if walks is None:
+      walks = {}
+      try:
+        parents[0]._parentsWalks = walks
+      except TypeError: # Builtins, like object.
+        pass
+    walks[key] = walk
+  return list(walk)
+
+def _linearize(parents):
+  """Gets what the __mro__ of a class with these parents would be, without the
+  class itself."""
+  if len(parents) == 1:
+    return parents[0].__mro__
+
+  # C3, like python does.
+  sequences = [list(p.__mro__) for p in parents] + [list(parents)]
+  order = []
+  while True:
+    sequences = [s for s in sequences if s]
+    if not sequences:
+      return order
+
+    for s in sequences:
+      head = s[0]
+      if not any(head in other[1:] for other in sequences):
+        break
+    else:
+      raise TypeError("Cannot create a consistent method resolution order for %s" % (parents, ))
+
+    order.append(head)
+    for s in sequences:
+      if s[0] is head:
+        del s[0]
 
 def getProperty(name, attrs, parents):
   """Used in __new__ while getting attributes of class objects that's about to
@@ -103,19 +146,18 @@ def getProperty(name, attrs, parents):
 
   Returns:
     None if the attributes is not found from the attrs nor the parents.
-    Otherwise the first one that's found, from attrs to BFS'ed parents.
+    Otherwise the first one that's found, from attrs to the parents in method
+    resolution order.
   """
-  parents = walkParents(parents)
   value = attrs.get(name, None)
-  i = 0
-  length = len(parents)
-  while value is None:
-    if i == length:
-      return None
-    value = getattr(parents[i], name, None)
-    i += 1
-
-  return value
+  if value is not None:
+    return value
+
+  for cls in walkParents(parents):
+    value = getattr(cls, name, None)
+    if value is not None:
+      return value
+  return None
 
 def getKeys(*args, **kwargs):
   """Gets the keys of all of the dictionaries and returns it in a list.
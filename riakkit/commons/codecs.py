@@ -0,0 +1,289 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Codecs used to turn serialized documents into bytes and back.
+
+A document class picks its codec with the class attribute `codec`, which could
+either be the name of a registered codec or a Codec object. The default is
+"json", which uses python's json module and is byte compatible with what
+riak-python-client stores.
+
+Other codecs are registered only if their module is installed:
+
+  - "fastjson": ujson or simplejson, whichever is available. Still JSON, so
+                it could be read by anything that reads the default.
+  - "msgpack": msgpack. Much smaller payloads, but not readable by riak search
+               or javascript map reduce phases.
+
+CompactCodec stores the fields of a document by position instead of by name.
+"""
+
+from itertools import izip
+from weakref import WeakKeyDictionary
+import json
+
+from riakkit.commons.exceptions import RiakkitError
+from riakkit.commons.properties import BooleanProperty, SetProperty
+
+
+# RiakBucket => {content type : the codec bound to it}
+_boundCodecs = WeakKeyDictionary()
+
+class Codec(object):
+  """A codec that encodes the serialized dictionary of a document.
+
+  Attributes:
+    name: The name this codec is registered under.
+    content_type: The content type stored with the RiakObject.
+  """
+  def __init__(self, name, content_type, encode, decode):
+    """Initializes a codec.
+
+    Args:
+      name: The name of the codec.
+      content_type: The content type of the encoded data.
+      encode: A callable that takes the serialized data and returns a string.
+      decode: A callable that takes a string and returns the serialized data.
+    """
+    self.name = name
+    self.content_type = content_type
+    self.encode = encode
+    self.decode = decode
+
+  def bind(self, bucket):
+    """Registers this codec as the encoder/decoder for its content type in a
+    bucket, so the RiakObjects created from the bucket uses it. It replaces the
+    encoders the client has by default (its JSON one).
+
+    Args:
+      bucket: A RiakBucket object.
+
+    Returns:
+      The bucket.
+
+    Raises:
+      RiakkitError if another codec, that encodes in another way, is already
+      bound to the bucket for the same content type.
+    """
+    bound = _boundCodecs.get(bucket)
+    if bound is None:
+      bound = _boundCodecs[bucket] = {}
+
+    other = bound.get(self.content_type)
+    if other is None or other is self:
+      bound[self.content_type] = self
+      if bucket.get_encoder(self.content_type) is not self.encode:
+        bucket.set_encoder(self.content_type, self.encode)
+        bucket.set_decoder(self.content_type, self.decode)
+    elif not self._compatible(other):
+      raise RiakkitError("Bucket %s already encodes %s with the %s codec." %
+                         (bucket.get_name(), self.content_type, other.name))
+    return bucket
+
+  def _compatible(self, other):
+    """Checks if the documents encoded by another codec bound to the same
+    bucket are the same as the ones this codec would give."""
+    return other.encode is self.encode and other.decode is self.decode
+
+  def forClass(self, cls):
+    """Gets the codec a document class uses, called when the class is
+    defined. Codecs that depend on the properties of the class give one made
+    for it.
+
+    Args:
+      cls: The document class.
+
+    Returns:
+      A Codec object, this one by default.
+    """
+    return self
+
+
+class CompactCodec(Codec):
+  """Stores a document as an array of its values, in the order of a layout,
+  instead of a dictionary repeating the name of every field:
+
+    class Event(Document):
+      bucket_name = "events"
+      codec = CompactCodec([("kind", "at", "tags", "active")])
+
+  A document is stored as [version, booleans, values...]. The version is the
+  position of the layout in the list of layouts (from 1). booleans packs the
+  values of the BooleanProperty fields, 2 bits each. The other values follow in
+  the order of the layout. SetProperty values are sorted, so the same set is
+  always stored the same way. Fields that are not in the layout, and values
+  that cannot be packed, are kept in a dictionary at the end. The names in the
+  last layout must be properties of the class (the older layouts could name
+  fields that were removed since).
+
+  Documents are written with the last layout. A layout must not change once
+  documents are stored with it: to add or remove fields, add a new layout.
+  Documents stored with the previous layouts, or stored as a dictionary
+  before the class used this codec, are still read.
+
+  The content type is not application/json, so riak search and the
+  javascript phases (where(), the aggregations of MapReduceBuilder) could not
+  read these documents.
+  """
+
+  def __init__(self, layouts, codec="json", name="compact"):
+    """Initializes a compact codec.
+
+    Args:
+      layouts: A list of tuples of field names, the oldest first.
+      codec: The codec that encodes the array. Default: "json"
+      name: The name of the codec. Default: "compact"
+    """
+    self.layouts = [tuple(layout) for layout in layouts]
+    if not self.layouts:
+      raise RiakkitError("CompactCodec needs at least one layout!")
+
+    self.codec = getCodec(codec)
+    Codec.__init__(self, name, "application/x-riakkit-compact+" + self.codec.name,
+                   self._encode, self._decode)
+    self._fields = [((), layout) for layout in self.layouts]
+    self._names = frozenset(self.layouts[-1])
+
+  def forClass(self, cls):
+    meta = cls._meta
+    for name in self.layouts[-1]:
+      if name not in meta:
+        raise RiakkitError("%s in the layout of %s is not a property." % (name, cls.__name__))
+
+    codec = CompactCodec(self.layouts, self.codec, self.name)
+    codec._fields = []
+    for layout in self.layouts:
+      booleans = tuple(name for name in layout if isinstance(meta.get(name), BooleanProperty))
+      others = tuple(name for name in layout if name not in booleans)
+      codec._fields.append((booleans, others))
+    codec._sets = frozenset(name for name, prop in meta.iteritems() if isinstance(prop, SetProperty))
+    return codec
+
+  _sets = frozenset()
+
+  def _compatible(self, other):
+    # The same layouts and types of fields, as it's the encoder already in the
+    # bucket that writes the documents of this class.
+    return (isinstance(other, CompactCodec) and other.codec is self.codec and
+            other._fields == self._fields and other._sets == self._sets)
+
+  def _encode(self, data):
+    booleans, others = self._fields[-1]
+    packed = 0
+    extra = {}
+    for i, name in enumerate(booleans):
+      value = data.get(name)
+      if value is True:
+        packed |= 2 << (i * 2)
+      elif value is False:
+        packed |= 1 << (i * 2)
+      elif value is not None:
+        extra[name] = value
+
+    values = [len(self._fields), packed]
+    sets = self._sets
+    for name in others:
+      value = data.get(name)
+      if name in sets and isinstance(value, list):
+        value = sorted(value)
+      values.append(value)
+
+    names = self._names
+    for name, value in data.iteritems():
+      if name not in names:
+        extra[name] = value
+    if extra:
+      values.append(extra)
+    return self.codec.encode(values)
+
+  def _decode(self, encoded):
+    values = self.codec.decode(encoded)
+    if isinstance(values, dict): # Stored before the class used this codec.
+      return values
+
+    version = values[0]
+    if not 0 < version <= len(self._fields):
+      raise RiakkitError("Unknown layout version %s, was it stored with a newer layout?" % version)
+
+    booleans, others = self._fields[version - 1]
+    data = {}
+    packed = values[1]
+    for i, name in enumerate(booleans):
+      bits = (packed >> (i * 2)) & 3
+      data[name] = None if bits == 0 else bits == 2
+
+    data.update(izip(others, values[2:]))
+    if len(values) > len(others) + 2:
+      data.update(values[-1])
+    return data
+
+
+_codecs = {}
+
+def registerCodec(codec):
+  """Registers a codec so document classes could refer to it by name.
+
+  Args:
+    codec: A Codec object. Replaces any codec with the same name.
+
+  Returns:
+    The codec.
+  """
+  _codecs[codec.name] = codec
+  return codec
+
+def getCodec(codec):
+  """Gets a codec.
+
+  Args:
+    codec: The name of a registered codec or a Codec object.
+
+  Returns:
+    A Codec object.
+
+  Raises:
+    RiakkitError if the codec is not registered.
+  """
+  if isinstance(codec, Codec):
+    return codec
+
+  try:
+    return _codecs[codec]
+  except KeyError:
+    raise RiakkitError("Codec '%s' is not available. Is it installed?" % codec)
+
+
+JSON_CODEC = registerCodec(Codec("json", "application/json", json.dumps,
+                                 json.loads))
+
+try:
+  import ujson as _fastjson
+except ImportError:
+  try:
+    import simplejson as _fastjson
+  except ImportError:
+    _fastjson = None
+
+if _fastjson is not None:
+  registerCodec(Codec("fastjson", "application/json", _fastjson.dumps,
+                      _fastjson.loads))
+
+try:
+  import msgpack
+except ImportError:
+  pass
+else:
+  registerCodec(Codec("msgpack", "application/x-msgpack", msgpack.packb,
+                      lambda data: msgpack.unpackb(data, encoding="utf-8")))
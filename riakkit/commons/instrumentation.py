@@ -0,0 +1,189 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reports the requests riakkit makes to Riak.
+
+Every get, store, delete, index lookup, search and map reduce done by Document
+and the queries is an Event, given to the listeners added with addListener.
+When there are no listeners, nothing is timed or created.
+
+capture() gathers the events of a block of code:
+
+  with capture() as stats:
+    user.save()
+  print stats.count(GET), stats.count(STORE)
+
+An event also has the cascade depth: the number of Document.save, delete and
+load calls it happened in. A save of a document with uniques and back
+references makes requests at depth 1, and the saves of the referenced
+documents at depth 2.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+GET = "get"
+STORE = "store"
+DELETE = "delete"
+INDEX = "index"
+SEARCH = "search"
+MAPREDUCE = "mapreduce"
+
+_listeners = []
+_state = threading.local()
+
+
+class Event(object):
+  """A request made to Riak.
+
+  Attributes:
+    operation: One of GET, STORE, DELETE, INDEX, SEARCH, MAPREDUCE.
+    cls: The document class that made it, or None.
+    bucket: The bucket name.
+    key: The key, or None for queries.
+    latency: The time it took, in seconds.
+    depth: The cascade depth, 0 if it was made outside of save, delete and
+           load.
+  """
+  __slots__ = ("operation", "cls", "bucket", "key", "latency", "depth")
+
+  def __init__(self, operation, cls, bucket, key, latency, depth):
+    self.operation = operation
+    self.cls = cls
+    self.bucket = bucket
+    self.key = key
+    self.latency = latency
+    self.depth = depth
+
+  def __repr__(self):
+    return "<Event %s %s/%s %.2fms depth %d>" % (self.operation, self.bucket, self.key, self.latency * 1000, self.depth)
+
+
+def addListener(listener):
+  """Adds a listener, called with every Event from any thread.
+
+  Args:
+    listener: A callable that takes an Event.
+  """
+  _listeners.append(listener)
+
+def removeListener(listener):
+  """Removes a listener.
+
+  Raises:
+    ValueError if it was not added.
+  """
+  _listeners.remove(listener)
+
+def depth():
+  """Gets the cascade depth of the current thread."""
+  return getattr(_state, "depth", 0)
+
+def timed(operation, cls, bucket, key, func, *args, **kwargs):
+  """Calls func(*args, **kwargs), which makes a request to Riak, and gives the
+  listeners an Event for it, even if it raises.
+
+  Returns:
+    What func returns.
+  """
+  if not _listeners:
+    return func(*args, **kwargs)
+
+  start = time.time()
+  try:
+    return func(*args, **kwargs)
+  finally:
+    event = Event(operation, cls, bucket, key, time.time() - start, depth())
+    for listener in list(_listeners):
+      listener(event)
+
+def cascading(func):
+  """Decorator for the methods that make requests through other documents
+  (save, delete, load). The requests made while it runs are one level deeper.
+  """
+  @wraps(func)
+  def wrapper(*args, **kwargs):
+    if not _listeners:
+      return func(*args, **kwargs)
+
+    _state.depth = depth() + 1
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _state.depth -= 1
+  return wrapper
+
+
+class Stats(object):
+  """A listener that keeps the events and counts them.
+
+  Attributes:
+    events: All the events, in order.
+  """
+  def __init__(self):
+    self.events = []
+
+  def __call__(self, event):
+    self.events.append(event)
+
+  def count(self, operation=None, bucket=None):
+    """Counts the events of an operation and/or a bucket. All of them if
+    neither is given."""
+    return len(self.select(operation, bucket))
+
+  def latency(self, operation=None, bucket=None):
+    """The total time of the events of an operation and/or a bucket, in
+    seconds."""
+    return sum(e.latency for e in self.select(operation, bucket))
+
+  def maxDepth(self):
+    """The deepest cascade depth of the events, 0 if there are none."""
+    return max([e.depth for e in self.events] or [0])
+
+  def repeated(self, operation=GET):
+    """Gets the keys that were requested more than once, which usually means
+    an N+1 pattern.
+
+    Returns:
+      A dictionary of (bucket, key) : number of requests.
+    """
+    counts = {}
+    for e in self.select(operation):
+      if e.key is not None:
+        counts[(e.bucket, e.key)] = counts.get((e.bucket, e.key), 0) + 1
+    return dict((k, n) for k, n in counts.iteritems() if n > 1)
+
+  def select(self, operation=None, bucket=None):
+    """Gets the events of an operation and/or a bucket."""
+    return [e for e in self.events if (operation is None or e.operation == operation) and
+                                      (bucket is None or e.bucket == bucket)]
+
+
+@contextmanager
+def capture():
+  """Gathers the events of the block in a Stats. Events from other threads
+  made during the block are included as well.
+
+  Yields:
+    The Stats.
+  """
+  stats = Stats()
+  addListener(stats)
+  try:
+    yield stats
+  finally:
+    removeListener(stats)
@@ -0,0 +1,185 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Profiling of the properties of document classes.
+
+When a class is profiled, the validate, standardize, convertToDb and
+convertFromDb of its properties, and every one of their forward, backward and
+standard processors, count their calls and the time spent in them:
+
+  from riakkit.commons import profiling
+
+  profiling.enable(User) # or profiling.enable() for every class
+  ...
+  profiling.printReport()
+
+The times are inclusive: the time of convertFromDb includes the time of the
+backwardprocessors. Properties inherited from a parent class are shared with
+it, so they are profiled (and named) with the first class that enabled them,
+and until the last class profiling them is disabled.
+
+Classes that are not profiled are not affected in any way.
+"""
+
+import sys
+from timeit import default_timer
+
+METHODS = ("validate", "standardize", "convertToDb", "convertFromDb")
+PROCESSORS = ("forwardprocessors", "backwardprocessors", "standardprocessors")
+
+_stats = {} # name => [calls, seconds]
+_classes = set()
+_everything = False
+
+
+def _timed(name, func):
+  stat = _stats.setdefault(name, [0, 0.0])
+  def wrapper(*args, **kwargs):
+    start = default_timer()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      stat[0] += 1
+      stat[1] += default_timer() - start
+  return wrapper
+
+def _instrument(cls, prefix, prop):
+  profiledBy = prop.__dict__.get("_profiledBy")
+  if profiledBy is not None:
+    profiledBy.add(cls)
+    return
+
+  original = {}
+  for method in METHODS:
+    setattr(prop, method, _timed("%s.%s" % (prefix, method), getattr(prop, method)))
+
+  for attr in PROCESSORS:
+    processors = original[attr] = getattr(prop, attr)
+    if callable(processors):
+      wrapped = _timed("%s.%s %s" % (prefix, attr, _name(processors)), processors)
+    else:
+      wrapped = [_timed("%s.%s[%d] %s" % (prefix, attr, i, _name(p)), p) for i, p in enumerate(processors)]
+    setattr(prop, attr, wrapped)
+
+  prop._profiled = original
+  prop._profiledBy = set([cls])
+  prop._setter = None
+
+def _restore(cls, prop):
+  profiledBy = prop.__dict__.get("_profiledBy")
+  if profiledBy is None:
+    return
+
+  # Still profiled by the other classes sharing it.
+  profiledBy.discard(cls)
+  if profiledBy:
+    return
+
+  del prop._profiledBy
+  original = prop.__dict__.pop("_profiled")
+
+  for method in METHODS:
+    delattr(prop, method)
+  for attr, processors in original.iteritems():
+    setattr(prop, attr, processors)
+  prop._setter = None
+
+def _name(func):
+  return getattr(func, "__name__", func.__class__.__name__)
+
+def _allClasses():
+  from riakkit.simple.basedocument import BaseDocument
+  classes = []
+  frontier = [BaseDocument]
+  while frontier:
+    cls = frontier.pop()
+    for sub in cls.__subclasses__():
+      if sub not in classes:
+        classes.append(sub)
+        frontier.append(sub)
+  return classes
+
+def enable(cls=None):
+  """Starts profiling a class.
+
+  Args:
+    cls: A BaseDocument, SimpleDocument or Document class. If None, every
+         class is profiled, including the ones defined afterwards.
+  """
+  global _everything
+  if cls is None:
+    _everything = True
+    for c in _allClasses():
+      enable(c)
+    return
+
+  _classes.add(cls)
+  for name, prop in cls.__dict__.get("_meta", {}).iteritems():
+    _instrument(cls, "%s.%s" % (cls.__name__, name), prop)
+
+def disable(cls=None):
+  """Stops profiling a class. The numbers so far are kept.
+
+  Args:
+    cls: The class. If None, no class is profiled anymore.
+  """
+  global _everything
+  if cls is None:
+    _everything = False
+    for c in list(_classes):
+      disable(c)
+    return
+
+  _classes.discard(cls)
+  for prop in cls.__dict__.get("_meta", {}).itervalues():
+    _restore(cls, prop)
+
+def profiled(cls):
+  """Checks if a class is profiled."""
+  return cls in _classes
+
+def classCreated(cls):
+  """Called by the metaclasses when a class is defined."""
+  if _everything:
+    enable(cls)
+
+def reset():
+  """Sets every count and time back to 0."""
+  for stat in _stats.itervalues():
+    stat[0] = 0
+    stat[1] = 0.0
+
+def report():
+  """Gets the numbers, most expensive first.
+
+  Returns:
+    A list of (name, calls, seconds) for everything that was called. The
+    name is <class>.<property>.<method or processor>.
+  """
+  rows = [(name, calls, seconds) for name, (calls, seconds) in _stats.iteritems() if calls]
+  rows.sort(key=lambda row: row[2], reverse=True)
+  return rows
+
+def printReport(out=None, limit=None):
+  """Prints report() as a table.
+
+  Args:
+    out: A file. Default: sys.stdout
+    limit: Only the first limit rows. Default: all of them.
+  """
+  out = out or sys.stdout
+  print >> out, "%12s %10s %12s  %s" % ("seconds", "calls", "us/call", "name")
+  for name, calls, seconds in report()[:limit]:
+    print >> out, "%12.6f %10d %12.3f  %s" % (seconds, calls, seconds / calls * 1e6, name)
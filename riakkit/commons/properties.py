@@ -22,6 +22,486 @@ from uuid import uuid1
 NONE_TYPE = type(None)
 _valueOrList = lambda value: [] if value is None else value
 
+# Returned by BaseProperty.setter() for the values that don't pass validation.
+INVALID = object()
+
+def _pipeline(processors):
+  """Composes processors (a callable or a list of them) into one function, or
+  None if there is nothing to do."""
+  if callable(processors):
+    return processors
+  processors = tuple(processors)
+  if not processors:
+    return None
+  if len(processors) == 1:
+    return processors[0]
+
+  def process(value):
+    for processor in processors:
+      value = processor(value)
+    return value
+  return process
+
+def _conjunction(validators):
+  """Composes validators (a callable or a list of them) into one function, or
+  None if there is nothing to check."""
+  if callable(validators):
+    return validators
+  validators = tuple(validators)
+  if not validators:
+    return None
+  if len(validators) == 1:
+    return validators[0]
+
+  def validate(value):
+    for validator in validators:
+      if not validator(value):
+        return False
+    return True
+  return validate
+
+def _composed(name, compose):
+  """A property that keeps what it's set to, as well as the result of compose
+  in _<name>, so it is only composed when it's set."""
+  attr = "_" + name
+  def get(self):
+    return self.__dict__.get(name, [])
+  def set(self, value):
+    self.__dict__[name] = value
+    self.__dict__[attr] = compose(value)
+    self._setter = None
+  return property(get, set)
+
+def _fusedSetter(validate, process, convert, parse=False, validateFirst=False):
+  """Builds the setter of a property that validates and standardizes in a
+  single pass.
+
+  Args:
+    validate: The composed validators, or None.
+    process: The composed standardprocessors, or None.
+    convert: What standardize does to the values that are not None after
+             process (int, unicode...), or None.
+    parse: True if validate also checks that convert works on the value (a
+           ValueError makes it invalid). The converted value is then kept, and
+           is the standardized value when there is no process.
+    validateFirst: With parse, True if the validators are called before
+                   convert.
+  """
+  if not parse:
+    def setter(value):
+      if validate is not None and not validate(value):
+        return INVALID
+      if process is not None:
+        value = process(value)
+      if value is None or convert is None:
+        return value
+      return convert(value)
+    return setter
+
+  def setter(value):
+    if validateFirst and validate is not None and not validate(value):
+      return INVALID
+
+    converted = None
+    if value is not None:
+      try:
+        converted = convert(value)
+      except ValueError:
+        return INVALID
+
+    if not validateFirst and validate is not None and not validate(value):
+      return INVALID
+
+    if process is None:
+      return converted
+    value = process(value)
+    return None if value is None else convert(value)
+  return setter
+
+# Containers that count the changes made to them in place (_mutations). This
+# way the document holding them knows whether or not the value changed since it
+# last validated or saved it, without comparing the content.
+#
+# The cost is a python call for every change. Measured with timeit on CPython
+# 2.7, an append or add takes 0.3 to 0.5us instead of 0.05 to 0.08us, and a
+# DotDict __setitem__ 0.6 to 0.9us instead of 0.05us (also see bench_all.py
+# containers). The methods changing a single element, the most used ones, call
+# the methods of the builtins bound here instead of looking them up every time,
+# which saves about 10% of that.
+
+_listAppend = list.append
+_listSetitem = list.__setitem__
+_listPop = list.pop
+_setAdd = set.add
+_setDiscard = set.discard
+_dictSetitem = dict.__setitem__
+_dictDelitem = dict.__delitem__
+
+class TrackedList(list):
+  """A list that counts its in place changes."""
+  _mutations = 0
+
+  def append(self, x):
+    self._mutations += 1
+    _listAppend(self, x)
+
+  def extend(self, x):
+    self._mutations += 1
+    list.extend(self, x)
+
+  def insert(self, i, x):
+    self._mutations += 1
+    list.insert(self, i, x)
+
+  def pop(self, *args):
+    self._mutations += 1
+    return list.pop(self, *args)
+
+  def remove(self, x):
+    self._mutations += 1
+    list.remove(self, x)
+
+  def reverse(self):
+    self._mutations += 1
+    list.reverse(self)
+
+  def sort(self, *args, **kwargs):
+    self._mutations += 1
+    list.sort(self, *args, **kwargs)
+
+  def __setitem__(self, i, x):
+    self._mutations += 1
+    _listSetitem(self, i, x)
+
+  def __delitem__(self, i):
+    self._mutations += 1
+    list.__delitem__(self, i)
+
+  def __setslice__(self, i, j, x):
+    self._mutations += 1
+    list.__setslice__(self, i, j, x)
+
+  def __delslice__(self, i, j):
+    self._mutations += 1
+    list.__delslice__(self, i, j)
+
+  def __iadd__(self, x):
+    self._mutations += 1
+    return list.__iadd__(self, x)
+
+  def __imul__(self, n):
+    self._mutations += 1
+    return list.__imul__(self, n)
+
+
+class TrackedSet(set):
+  """A set that counts its in place changes."""
+  _mutations = 0
+
+  def add(self, x):
+    self._mutations += 1
+    _setAdd(self, x)
+
+  def discard(self, x):
+    self._mutations += 1
+    _setDiscard(self, x)
+
+  def remove(self, x):
+    self._mutations += 1
+    set.remove(self, x)
+
+  def pop(self):
+    self._mutations += 1
+    return set.pop(self)
+
+  def clear(self):
+    self._mutations += 1
+    set.clear(self)
+
+  def update(self, *others):
+    self._mutations += 1
+    set.update(self, *others)
+
+  def difference_update(self, *others):
+    self._mutations += 1
+    set.difference_update(self, *others)
+
+  def intersection_update(self, *others):
+    self._mutations += 1
+    set.intersection_update(self, *others)
+
+  def symmetric_difference_update(self, other):
+    self._mutations += 1
+    set.symmetric_difference_update(self, other)
+
+  def __ior__(self, other):
+    self._mutations += 1
+    return set.__ior__(self, other)
+
+  def __iand__(self, other):
+    self._mutations += 1
+    return set.__iand__(self, other)
+
+  def __isub__(self, other):
+    self._mutations += 1
+    return set.__isub__(self, other)
+
+  def __ixor__(self, other):
+    self._mutations += 1
+    return set.__ixor__(self, other)
+
+
+class TrackedDict(dict):
+  """A dictionary that counts its in place changes.
+
+  The counter is written through __dict__ so subclasses could map __setattr__
+  to the dictionary items (see DictProperty.DotDict).
+  """
+  _mutations = 0
+
+  def __setitem__(self, key, value):
+    self.__dict__["_mutations"] = self._mutations + 1
+    _dictSetitem(self, key, value)
+
+  def __delitem__(self, key):
+    self.__dict__["_mutations"] = self._mutations + 1
+    _dictDelitem(self, key)
+
+  def clear(self):
+    self.__dict__["_mutations"] = self._mutations + 1
+    dict.clear(self)
+
+  def pop(self, *args):
+    self.__dict__["_mutations"] = self._mutations + 1
+    return dict.pop(self, *args)
+
+  def popitem(self):
+    self.__dict__["_mutations"] = self._mutations + 1
+    return dict.popitem(self)
+
+  def setdefault(self, key, default=None):
+    self.__dict__["_mutations"] = self._mutations + 1
+    return dict.setdefault(self, key, default)
+
+  def update(self, *args, **kwargs):
+    self.__dict__["_mutations"] = self._mutations + 1
+    dict.update(self, *args, **kwargs)
+
+_referenceKey = lambda value: getattr(value, "key", value)
+
+class ReferenceList(TrackedList):
+  """A TrackedList of documents or keys that also indexes the positions of the
+  keys it holds, so checking for or removing a key doesn't go through the list.
+
+  removeKey moves the last element into the place of the removed one instead
+  of shifting the elements after it, so it doesn't depend on the size of the
+  list, but it doesn't keep the order of the list either.
+
+  The index is built the first time it is needed. append, extend, pop() of the
+  last element and removeKey keep it up to date, anything else throws it away.
+  """
+  _keys = None # key => [positions of the elements with that key]
+  _loaded = False # True if no element is a key that needs to be loaded.
+
+  def _index(self):
+    keys = self._keys
+    if keys is None:
+      keys = self._keys = {}
+      for i, v in enumerate(self):
+        keys.setdefault(_referenceKey(v), []).append(i)
+    return keys
+
+  def _indexed(self, values, start):
+    keys = self._keys
+    for i, v in enumerate(values, start):
+      if isinstance(v, basestring):
+        self._loaded = False
+      if keys is not None:
+        keys.setdefault(_referenceKey(v), []).append(i)
+
+  def _reindex(self):
+    self._keys = None
+    self._loaded = False
+
+  def hasKey(self, key):
+    """Checks if a document with that key is in the list."""
+    return key in self._index()
+
+  def removeKey(self, key):
+    """Removes a document (or key) with that key from the list. The last
+    element of the list takes its place.
+
+    Returns:
+      True if something got removed, False otherwise.
+    """
+    keys = self._index()
+    positions = keys.get(key)
+    if not positions:
+      return False
+
+    i = positions.pop()
+    if not positions:
+      del keys[key]
+    self._mutations += 1
+    last = len(self) - 1
+    if i != last:
+      moved = self[last]
+      _listSetitem(self, i, moved)
+      positions = keys[_referenceKey(moved)]
+      positions[positions.index(last)] = i
+    _listPop(self)
+    return True
+
+  def append(self, x):
+    TrackedList.append(self, x)
+    self._indexed((x, ), len(self) - 1)
+
+  def extend(self, x):
+    x = list(x)
+    TrackedList.extend(self, x)
+    self._indexed(x, len(self) - len(x))
+
+  def insert(self, i, x):
+    TrackedList.insert(self, i, x)
+    self._reindex()
+
+  def pop(self, *args):
+    value = TrackedList.pop(self, *args)
+    keys = self._keys
+    if keys is not None and (not args or args[0] in (-1, len(self))):
+      key = _referenceKey(value)
+      positions = keys[key]
+      positions.remove(len(self))
+      if not positions:
+        del keys[key]
+    else:
+      self._reindex()
+    return value
+
+  def remove(self, x):
+    TrackedList.remove(self, x)
+    self._reindex()
+
+  def __setitem__(self, i, x):
+    TrackedList.__setitem__(self, i, x)
+    self._reindex()
+
+  def __delitem__(self, i):
+    TrackedList.__delitem__(self, i)
+    self._reindex()
+
+  def __setslice__(self, i, j, x):
+    TrackedList.__setslice__(self, i, j, x)
+    self._reindex()
+
+  def __delslice__(self, i, j):
+    TrackedList.__delslice__(self, i, j)
+    self._reindex()
+
+  def __iadd__(self, x):
+    self.extend(x)
+    return self
+
+  def __imul__(self, n):
+    TrackedList.__imul__(self, n)
+    self._reindex()
+    return self
+
+
+class ReferenceDict(TrackedDict):
+  """A TrackedDict of documents or keys that also indexes the keys of the
+  documents it holds, so removing a document doesn't go through the values.
+
+  Like ReferenceList, the index is built on demand, kept up to date by
+  __setitem__, __delitem__ and pop, and thrown away by anything else.
+  """
+  _keys = None # key of the document => set of dictionary keys
+  _loaded = False # True if no value is a key that needs to be loaded.
+
+  def _index(self):
+    keys = self._keys
+    if keys is None:
+      keys = self.__dict__["_keys"] = {}
+      for k, v in self.iteritems():
+        keys.setdefault(_referenceKey(v), set()).add(k)
+    return keys
+
+  def _unindexed(self, k, value):
+    keys = self._keys
+    if keys is not None:
+      key = _referenceKey(value)
+      keys[key].discard(k)
+      if not keys[key]:
+        del keys[key]
+
+  def _reindex(self):
+    self.__dict__["_keys"] = None
+    self.__dict__["_loaded"] = False
+
+  def hasKey(self, key):
+    """Checks if a document with that key is one of the values."""
+    return key in self._index()
+
+  def removeKey(self, key):
+    """Removes all the items whose value is the document (or key) with that
+    key.
+
+    Returns:
+      True if something got removed, False otherwise.
+    """
+    names = self._index().pop(key, None)
+    if not names:
+      return False
+
+    self.__dict__["_mutations"] = self._mutations + 1
+    for k in names:
+      dict.__delitem__(self, k)
+    return True
+
+  def __setitem__(self, k, value):
+    if k in self:
+      self._unindexed(k, self[k])
+    TrackedDict.__setitem__(self, k, value)
+    if isinstance(value, basestring):
+      self.__dict__["_loaded"] = False
+    if self._keys is not None:
+      self._keys.setdefault(_referenceKey(value), set()).add(k)
+
+  def __delitem__(self, k):
+    self._unindexed(k, self[k])
+    TrackedDict.__delitem__(self, k)
+
+  def pop(self, k, *args):
+    if k in self:
+      self._unindexed(k, self[k])
+    return TrackedDict.pop(self, k, *args)
+
+  def clear(self):
+    TrackedDict.clear(self)
+    self._reindex()
+
+  def popitem(self):
+    item = TrackedDict.popitem(self)
+    self._reindex()
+    return item
+
+  def setdefault(self, k, default=None):
+    value = TrackedDict.setdefault(self, k, default)
+    self._reindex()
+    return value
+
+  def update(self, *args, **kwargs):
+    TrackedDict.update(self, *args, **kwargs)
+    self._reindex()
+
+def _tracked(value, cls, original):
+  """Wraps value into the tracked container cls if it is exactly of the type
+  original. Anything else (None, or whatever the processors returned) is kept
+  as is."""
+  if type(value) is original:
+    return cls(value)
+  return value
+
 class BaseProperty(object):
   """Base property type
 
@@ -33,10 +513,45 @@ class BaseProperty(object):
     validators: A list of callables or 1 callable that validates any value
                 given. The function should be callback(value), returning
                 a boolean.
+    mutable: Class attribute. True if the values of this property could be
+             changed in place (lists, dictionaries, embedded documents...).
+    tracked: Class attribute. True if the values of this mutable property are
+             tracked containers, which counts the changes done in place.
+    index: The name of the secondary index of this property, or False.
+    index_type: Class attribute. "bin" or "int", the type of index=True.
+    unique_bucket: The RiakBucket holding the values of a unique property of a
+                   Document, made from unique_bucket_name and the client of
+                   unique_owner the first time it is used.
   """
+
+  mutable = False
+  tracked = False
+  index_type = "bin"
+
+  unique_bucket_name = None
+  unique_owner = None
+  _unique_bucket = None
+
+  # Composed once, when they are set. Changing the lists in place afterwards
+  # is not seen, they have to be set again.
+  validators = _composed("validators", _conjunction)
+  forwardprocessors = _composed("forwardprocessors", _pipeline)
+  backwardprocessors = _composed("backwardprocessors", _pipeline)
+  standardprocessors = _composed("standardprocessors", _pipeline)
+  _validators = _forwardprocessors = _backwardprocessors = _standardprocessors = None
+
+  _setter = None
+
+  @property
+  def unique_bucket(self):
+    if self._unique_bucket is None:
+      from riakkit.document import getClient
+      self._unique_bucket = getClient(self.unique_owner).bucket(self.unique_bucket_name)
+    return self._unique_bucket
+
   def __init__(self, required=False, unique=False, default=None,
                validators=None, forwardprocessors=None, backwardprocessors=None,
-               standardprocessors=None):
+               standardprocessors=None, index=False):
     """Initializes the property field
 
     Args:
@@ -54,6 +569,10 @@ class BaseProperty(object):
       standardprocessors: A list of callables or 1 callable that processes the
                           data when the data is being fed into the Document
                           object.
+      index: True to keep a secondary index of the value of this property,
+             named <name>_bin (or _int, depending on the property). Could also
+             be the name of the index, ending with _bin or _int. Only for
+             SimpleDocument and Document.
 
     """
     self.required = required
@@ -63,16 +582,9 @@ class BaseProperty(object):
     self.forwardprocessors = _valueOrList(forwardprocessors)
     self.backwardprocessors = _valueOrList(backwardprocessors)
     self.standardprocessors = _valueOrList(standardprocessors)
+    self.index = index
     self.name = None
 
-  def _processValue(self, value, processors):
-    if callable(processors):
-      return processors(value)
-    else:
-      for processor in processors:
-        value = processor(value)
-    return value
-
   def hasValue(self, value):
     """Checks if a value exists in the db if the unique flag is turned on.
 
@@ -86,6 +598,104 @@ class BaseProperty(object):
       return self.unique_bucket.get(value).exists()
     return None
 
+  def observable(self, value):
+    """Checks if every change to a value could be seen by the document holding
+    it. That is the case if the value is immutable (it has to be set again to
+    change), or if it is a tracked container.
+
+    Tracking is shallow: changing a list inside a ListProperty's list will
+    not be seen.
+
+    Args:
+      value: The current (standardized) value of this property.
+
+    Returns:
+      True if the changes to the value are observable.
+    """
+    if not self.mutable:
+      return True
+    return self.tracked and (value is None or
+                             getattr(value, "_mutations", None) is not None)
+
+  def rawPassthrough(self, value):
+    """Checks if a value loaded from the database could be saved back as is,
+    without going through convertFromDb and convertToDb again, given that it
+    has not been changed since.
+
+    This is not the case for values whose changes are not observable, nor for
+    properties with forwardprocessors, as those are expected to run on every
+    save.
+
+    Args:
+      value: The current (standardized) value of this property.
+
+    Returns:
+      True if the raw value could be reused, False otherwise.
+    """
+    return not self.forwardprocessors and self.observable(value)
+
+  def difference(self, old, new):
+    """Gets the elements added and removed between two database values, for
+    properties that are collections of elements (sets, references).
+
+    Args:
+      old: The old value, in the database form.
+      new: The new value, in the database form.
+
+    Returns:
+      None if this property is not a collection, the value is then considered
+      as a whole. Otherwise a tuple of (added elements, removed elements).
+    """
+    return None
+
+  def patch(self, value, added, removed):
+    """Adds and removes elements from a value. The reverse of difference().
+
+    Args:
+      value: The current (standardized) value.
+      added: The elements to add, in the database form.
+      removed: The elements to remove, in the database form.
+
+    Returns:
+      The new value.
+    """
+    raise NotImplementedError("%s is not a collection." % self.__class__.__name__)
+
+  def indexName(self, name):
+    """Gets the name of the index of this property, given index=True or a name.
+
+    Args:
+      name: The name of this property.
+
+    Raises:
+      RiakkitError if the name of the index doesn't end with _bin or _int.
+    """
+    if self.index is True:
+      return "%s_%s" % (name, self.index_type)
+
+    if not self.index.endswith(("_bin", "_int")):
+      raise RiakkitError("Index %s of %s must end with _bin or _int!" % (self.index, name))
+    return self.index
+
+  def indexValues(self, value):
+    """Gets the values of the index of this property.
+
+    Args:
+      value: The value, in the database form. Every element of lists and sets
+             is a value of the index.
+
+    Returns:
+      A list of integers for _int indexes and strings for _bin ones.
+    """
+    if value is None:
+      return []
+    if not isinstance(value, (list, tuple, set)):
+      value = [value]
+
+    if self.index.endswith("_int"):
+      return [int(v) for v in value if v is not None]
+    return [v if isinstance(v, basestring) else unicode(v) for v in value if v is not None]
+
   def convertToDb(self, value):
     """Converts the value from the access form a DB valid form
 
@@ -97,7 +707,8 @@ class BaseProperty(object):
     Args:
       value: The value to be converted
     """
-    return self._processValue(value, self.forwardprocessors)
+    process = self._forwardprocessors
+    return value if process is None else process(value)
 
   def convertFromDb(self, value):
     """Converts the value from the database back to an app friendly value (a
@@ -116,7 +727,8 @@ class BaseProperty(object):
     default = self.defaultValue()
     if value is None and default is not None:
       value = default
-    return self._processValue(value, self.backwardprocessors)
+    process = self._backwardprocessors
+    return value if process is None else process(value)
 
   def standardize(self, value):
     """Converts the value from any form (input form, db form) into a form that's
@@ -134,7 +746,8 @@ class BaseProperty(object):
       TypeError: if type is not what's expected.
 
     """
-    return self._processValue(value, self.standardprocessors)
+    process = self._standardprocessors
+    return value if process is None else process(value)
 
   def validate(self, value):
     """The default validation function.
@@ -152,15 +765,47 @@ class BaseProperty(object):
     Returns:
       True if validation pass, False otherwise.
     """
+    validate = self._validators
+    return validate is None or validate(value)
 
-    if callable(self.validators):
-      return self.validators(value)
-    elif type(self.validators) in (tuple, list):
-      for validator in self.validators:
-        if not validator(value):
-          return False
+  def setter(self):
+    """Gets the function a document uses when a value of this property is set.
 
-    return True
+    It's built the first time, and again after the validators or the
+    standardprocessors are set.
+
+    Returns:
+      A function that takes the value, and returns it standardized or INVALID
+      if it doesn't pass validation.
+    """
+    setter = self._setter
+    if setter is None:
+      setter = self._setter = self._compileSetter()
+    return setter
+
+  def _compileSetter(self):
+    """Builds the function returned by setter(). The properties that could
+    validate and standardize a value in one pass override this, and do so
+    when their validate and standardize are their own (see _overrides)."""
+    if not self._overrides(BaseProperty):
+      return _fusedSetter(self._validators, self._standardprocessors, None)
+
+    validate = self.validate
+    standardize = self.standardize
+    def setter(value):
+      if not validate(value):
+        return INVALID
+      return standardize(value)
+    return setter
+
+  def _overrides(self, cls):
+    """Checks if validate or standardize are not the ones of cls, because a
+    subclass overrides them or profiling wraps them."""
+    for method in ("validate", "standardize"):
+      if (method in self.__dict__ or
+          getattr(self.__class__, method).im_func is not getattr(cls, method).im_func):
+        return True
+    return False
 
   def defaultValue(self):
     """The default value for this type.
@@ -185,14 +830,17 @@ class DictProperty(BaseProperty):
   you can use dot notation as well as dictionary notation.
   """
 
-  class DotDict(dict):
+  mutable = True
+  tracked = True
+
+  class DotDict(TrackedDict):
     """A dictionary but allows dot notation to access the attributes
     (strings at least)
     """
 
     __getattr__ = dict.__getitem__
-    __setattr__ = dict.__setitem__
-    __delattr__ = dict.__delitem__
+    __setattr__ = TrackedDict.__setitem__
+    __delattr__ = TrackedDict.__delitem__
 
   # These will never have None, as the default value is always {}
 
@@ -216,30 +864,58 @@ class DictProperty(BaseProperty):
     return BaseProperty.defaultValue(self) or DictProperty.DotDict()
 
 class ListProperty(BaseProperty):
-  """List property, []"""
+  """List property, []. Lists are stored as TrackedList."""
+
+  mutable = True
+  tracked = True
+
+  def standardize(self, value):
+    value = BaseProperty.standardize(self, value)
+    return _tracked(value, TrackedList, list)
+
+  def convertFromDb(self, value):
+    value = BaseProperty.convertFromDb(self, value)
+    return _tracked(value, TrackedList, list)
+
   def defaultValue(self):
     """Default value for list
 
     Returns:
       []
     """
-    return BaseProperty.defaultValue(self) or []
+    return _tracked(BaseProperty.defaultValue(self) or [], TrackedList, list)
 
 class SetProperty(BaseProperty):
-  """A set, using python's built-in set."""
+  """A set, using python's built-in set (as a TrackedSet)."""
+
+  mutable = True
+  tracked = True
+
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if value is None: return None
-    return set(value)
+    return TrackedSet(value)
 
   def convertToDb(self, value):
     value = BaseProperty.convertToDb(self, value)
     if value is None: return None
     return list(value)
 
+  def difference(self, old, new):
+    old = set(_valueOrList(old))
+    new = set(_valueOrList(new))
+    return list(new - old), list(old - new)
+
+  def patch(self, value, added, removed):
+    if value is None:
+      value = TrackedSet()
+    value.difference_update(removed)
+    value.update(added)
+    return value
+
   def convertFromDb(self, value):
     if value is not None:
-      value = set(value)
+      value = TrackedSet(value)
     return BaseProperty.convertFromDb(self, value)
 
   def validate(self, value): # TODO: Combine this so it's not duplicate work?
@@ -255,7 +931,7 @@ class SetProperty(BaseProperty):
     return checked and BaseProperty.validate(self, value)
 
   def defaultValue(self):
-    return BaseProperty.defaultValue(self) or set()
+    return _tracked(BaseProperty.defaultValue(self) or set(), TrackedSet, set)
 
 class StringProperty(BaseProperty):
   """String property. By default this converts strings to unicode."""
@@ -264,8 +940,16 @@ class StringProperty(BaseProperty):
     if value is None: return None
     return unicode(value)
 
+  def _compileSetter(self):
+    if self._overrides(StringProperty):
+      return BaseProperty._compileSetter(self)
+    return _fusedSetter(self._validators, self._standardprocessors, unicode)
+
 class IntegerProperty(BaseProperty):
   """Integer property."""
+
+  index_type = "int"
+
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if value is None: return None
@@ -284,6 +968,11 @@ class IntegerProperty(BaseProperty):
 
     return checked and BaseProperty.validate(self, value)
 
+  def _compileSetter(self):
+    if self._overrides(IntegerProperty):
+      return BaseProperty._compileSetter(self)
+    return _fusedSetter(self._validators, self._standardprocessors, int, parse=True)
+
 class FloatProperty(BaseProperty):
   """Floating point property"""
   def standardize(self, value):
@@ -304,13 +993,27 @@ class FloatProperty(BaseProperty):
 
     return BaseProperty.validate(self, value) and checked
 
+  def _compileSetter(self):
+    if self._overrides(FloatProperty):
+      return BaseProperty._compileSetter(self)
+    return _fusedSetter(self._validators, self._standardprocessors, float,
+                        parse=True, validateFirst=True)
+
 class BooleanProperty(BaseProperty):
   """Boolean property. Pretty self explanatory."""
+
+  index_type = "int"
+
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if value is None: return None
     return bool(value)
 
+  def _compileSetter(self):
+    if self._overrides(BooleanProperty):
+      return BaseProperty._compileSetter(self)
+    return _fusedSetter(self._validators, self._standardprocessors, bool)
+
 class EnumProperty(BaseProperty):
   """Not sure if enum is the best name, but this only allows some properties.
 
@@ -319,8 +1022,11 @@ class EnumProperty(BaseProperty):
   will be kept if they are objects, so try to use basic types).
   """
 
+  index_type = "int"
+
   def __init__(self, possible_values, required=False, unique=False, default=None,
-               validators=None, forwardprocessors=None, backwardprocessors=None):
+               validators=None, forwardprocessors=None, backwardprocessors=None,
+               index=False):
     """Initialize the Enum Property.
 
     Args:
@@ -332,7 +1038,8 @@ class EnumProperty(BaseProperty):
     BaseProperty.__init__(self, required=required, unique=unique,
                                 default=default, validators=validators,
                                 forwardprocessors=forwardprocessors,
-                                backwardprocessors=backwardprocessors)
+                                backwardprocessors=backwardprocessors,
+                                index=index)
     self._map_forward = {}
     self._map_backward = {}
     for i, v in enumerate(possible_values):
@@ -363,6 +1070,20 @@ class EnumProperty(BaseProperty):
 
     raise TypeError("EnumProperty only accepts string and integer, not %s." % str(value))
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+# The timestamps of datetime.min and datetime.max, in seconds.
+_FIRST_TIMESTAMP = -62135596800
+_LAST_TIMESTAMP = 253402300799
+_NUMBER_TYPES = (long, int, float)
+
+def _utc(value):
+  """Converts an aware datetime to a naive one in UTC. Naive ones are already
+  considered to be in UTC."""
+  offset = value.utcoffset()
+  if offset is None:
+    return value
+  return value.replace(tzinfo=None) - offset
+
 class DateTimeProperty(BaseProperty):
   """The datetime property.
 
@@ -371,18 +1092,81 @@ class DateTimeProperty(BaseProperty):
 
   Note that this is your timezone's time. Time is handled with your time only.
 
-  TODO: utc only feature later.
+  With utc=True, the datetimes are in UTC instead (naive ones, like
+  datetime.utcnow() gives, aware ones are converted) and are stored as an
+  integer number of seconds since the epoch, or milliseconds with
+  milliseconds=True. This skips the conversions from and to the local time,
+  which are slow. Numbers given to it are in the same unit as in the database.
   """
 
+  index_type = "int"
+
+  def __init__(self, required=False, unique=False, default=None,
+               validators=None, forwardprocessors=None, backwardprocessors=None,
+               standardprocessors=None, index=False, utc=False,
+               milliseconds=False):
+    """Initializes the DateTime Property.
+
+    Args:
+      utc: True to use UTC datetimes and integer timestamps. Default: False
+      milliseconds: True to store milliseconds instead of seconds. Only with
+                    utc. Default: False
+
+    Everything else is inheritted from BaseProperty.
+    """
+    BaseProperty.__init__(self, required=required, unique=unique,
+                                default=default, validators=validators,
+                                forwardprocessors=forwardprocessors,
+                                backwardprocessors=backwardprocessors,
+                                standardprocessors=standardprocessors,
+                                index=index)
+    if milliseconds and not utc:
+      raise RiakkitError("milliseconds is only available with utc!")
+
+    self.utc = utc
+    self.milliseconds = milliseconds
+    scale = 1000 if milliseconds else 1
+    self._first = _FIRST_TIMESTAMP * scale
+    self._last = _LAST_TIMESTAMP * scale
+
+  def _fromTimestamp(self, value):
+    """Converts a number from the database to a datetime.
+
+    Raises:
+      ValueError if it's out of range.
+    """
+    if not self.utc:
+      return datetime.datetime.fromtimestamp(value)
+
+    if not self._first <= value <= self._last:
+      raise ValueError("%s is out of the range of datetime" % value)
+    if self.milliseconds:
+      return _EPOCH + datetime.timedelta(milliseconds=value)
+    return _EPOCH + datetime.timedelta(seconds=value)
+
+  def _toTimestamp(self, value):
+    if not self.utc:
+      return time.mktime(value.timetuple())
+
+    delta = _utc(value) - _EPOCH
+    seconds = delta.days * 86400 + delta.seconds
+    if self.milliseconds:
+      return seconds * 1000 + delta.microseconds // 1000
+    return seconds
+
   def validate(self, value):
     check = False
-    if isinstance(value, (long, int, float)): # timestamp
-      try:
-        value = datetime.datetime.fromtimestamp(value)
-      except ValueError:
-        check = False
+    if isinstance(value, _NUMBER_TYPES): # timestamp
+      if self.utc and self._validators is None:
+        # Nothing needs the datetime.
+        check = self._first <= value <= self._last
       else:
-        check = True
+        try:
+          value = self._fromTimestamp(value)
+        except ValueError:
+          check = False
+        else:
+          check = True
     elif isinstance(value, (datetime.datetime, NONE_TYPE)):
       check = True
     return BaseProperty.validate(self, value) and check
@@ -391,28 +1175,65 @@ class DateTimeProperty(BaseProperty):
     value = BaseProperty.convertToDb(self, value)
     if isinstance(value, (long, int, float, NONE_TYPE)):
       return value
-    return time.mktime(value.timetuple())
+    return self._toTimestamp(value)
 
   def convertFromDb(self, value):
     if value is not None:
-      value = datetime.datetime.fromtimestamp(value)
+      value = self._fromTimestamp(value)
     return BaseProperty.convertFromDb(self, value)
 
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if isinstance(value, (int, float, long)):
-      return datetime.datetime.fromtimestamp(value)
+      return self._fromTimestamp(value)
+    elif isinstance(value, datetime.datetime) and self.utc:
+      return _utc(value)
     elif isinstance(value, (datetime.datetime, NONE_TYPE)):
       return value
 
     raise TypeError("DateTimeProperty only accepts integer, long, float, or datetime.datetime, not %s" % str(value))
 
+  def _compileSetter(self):
+    if self._overrides(DateTimeProperty):
+      return BaseProperty._compileSetter(self)
+
+    # A timestamp is converted once, for both validate and standardize.
+    validate = self._validators
+    process = self._standardprocessors
+    standardize = self.standardize
+    fromTimestamp = self._fromTimestamp
+    utc = self.utc
+    def setter(value):
+      checked = value # What the validators get, like in validate.
+      if isinstance(value, _NUMBER_TYPES):
+        try:
+          checked = converted = fromTimestamp(value)
+        except ValueError:
+          converted = INVALID
+      elif isinstance(value, datetime.datetime):
+        converted = _utc(value) if utc else value
+      elif value is None:
+        converted = None
+      else:
+        converted = INVALID
+
+      if validate is not None and not validate(checked):
+        return INVALID
+      if converted is INVALID or process is None:
+        return converted
+      return standardize(value)
+    return setter
+
   def defaultValue(self):
     """Returns the default specified or now."""
     if callable(self.default):
       return self.default()
 
-    return self.default or datetime.datetime.fromtimestamp(time.time())
+    if self.default:
+      return self.default
+    if self.utc:
+      return datetime.datetime.utcnow()
+    return datetime.datetime.fromtimestamp(time.time())
 
 
 class DynamicProperty(BaseProperty):
@@ -425,8 +1246,13 @@ class DynamicProperty(BaseProperty):
   Python json module...
   """
 
+  mutable = True
+
+COLLECTION_STORAGES = ("inline", "sharded", "index")
+
 class ReferenceBaseProperty(BaseProperty):
-  def __init__(self, reference_class, collection_name=None, required=False):
+  def __init__(self, reference_class, collection_name=None, required=False,
+               collection_storage="inline", collection_shards=16, index=False):
     """Initializes a Reference Property
 
     You can set it up so that riakkit automatically link back from
@@ -441,14 +1267,27 @@ class ReferenceBaseProperty(BaseProperty):
                        same way as GAE's collection_name for their
                        ReferenceProperty. See the README file at the repository
                        for detailed tutorial.
+      collection_storage: Where the collection is stored. "inline" (default)
+                          stores it as a MultiReferenceProperty in the
+                          referenced document. "sharded" stores it in separate
+                          shard objects (see riakkit.backrefs), so the
+                          referenced document doesn't grow with it. "index"
+                          adds the secondary index <name>_bin to the documents
+                          with this property, and looks them up with it.
+      collection_shards: The number of shards for "sharded". Defaults to 16.
+      index: Same as BaseProperty, the index holds the keys.
     """
-    BaseProperty.__init__(self, required=required)
+    BaseProperty.__init__(self, required=required, index=index)
     if not reference_class._clsType:
       raise TypeError("Reference property cannot be constructed with class '%s'" % reference_class.__name__)
 
     self.clstype = reference_class._clsType
     self.reference_class = reference_class
     self.collection_name = collection_name
+    if collection_storage not in COLLECTION_STORAGES:
+      raise RiakkitError("collection_storage must be one of %s!" % ", ".join(COLLECTION_STORAGES))
+    self.collection_storage = collection_storage
+    self.collection_shards = collection_shards
     self.is_reference_back = False
 
   def _checkForReferenceClass(self, l):
@@ -473,6 +1312,11 @@ class ReferenceBaseProperty(BaseProperty):
     else: # Document, EmDocument
       return self.reference_class.load(value, True)
 
+  def loaded(self, value):
+    """Checks if attemptLoad has nothing to load in value, and would return it
+    as is."""
+    return self.clstype == 1 or not isinstance(value, basestring)
+
   def attemptToDb(self, obj):
     if isinstance(obj, self.reference_class):
       return obj.key
@@ -498,32 +1342,71 @@ class ReferenceProperty(ReferenceBaseProperty):
       return False
 
     doc._data[self.name] = None
+    doc._fieldChanged(self.name)
     return True
 
 class MultiReferenceProperty(ReferenceBaseProperty):
+  mutable = True
+  tracked = True
+
+  def standardize(self, value):
+    value = BaseProperty.standardize(self, value)
+    return _tracked(value, ReferenceList, list)
+
   def convertToDb(self, value):
     value = BaseProperty.convertToDb(self, value)
     return [] if value is None else [self.attemptToDb(v) for v in value]
 
+  def convertFromDb(self, value):
+    value = BaseProperty.convertFromDb(self, value)
+    return _tracked(value, ReferenceList, list)
+
+  def difference(self, old, new):
+    old = set(_valueOrList(old))
+    new = set(_valueOrList(new))
+    return list(new - old), list(old - new)
+
+  def patch(self, value, added, removed):
+    if value is None:
+      value = ReferenceList()
+    for key in removed:
+      value.removeKey(key)
+    value.extend(added)
+    return value
+
   def attemptLoad(self, value): # This is called when we do things like len(obj.multiprop). Should somehow erradicate the need for that.
-    return [] if value is None else [ReferenceBaseProperty.attemptLoad(self, v) for v in value]
+    if value is None:
+      return ReferenceList()
+
+    if not isinstance(value, ReferenceList):
+      return ReferenceList(ReferenceBaseProperty.attemptLoad(self, v) for v in value)
+
+    if value._loaded or self.clstype == 1: # Nothing to load for SimpleDocument
+      return value
+
+    # Loading the documents is not a change, as they are stored as keys
+    # anyway. Hence list.__setitem__ instead of the tracked one. The keys and
+    # their positions stay the same, so the index is still right.
+    for i, v in enumerate(value):
+      loaded = ReferenceBaseProperty.attemptLoad(self, v)
+      if loaded is not v:
+        list.__setitem__(value, i, loaded)
+    value._loaded = True
+    return value
+
+  def loaded(self, value):
+    return isinstance(value, ReferenceList) and (value._loaded or self.clstype == 1)
 
   def defaultValue(self):
-    return []
+    return ReferenceList()
 
   def deleteReference(self, doc, ref):
     currentList = doc._data.get(self.name)
-    for i, r in enumerate(currentList): # TODO: Need a better search & destroy algorithm
-      if isinstance(r, self.reference_class):
-        key = r.key
-      else:
-        key = r
-
-      if key == ref.key:
-        currentList.pop(i) # This is a reference, which should modify the original list.
-        return True
-
-    return False
+    if currentList is None:
+      return False
+    if not isinstance(currentList, ReferenceList):
+      currentList = doc._data[self.name] = ReferenceList(currentList)
+    return currentList.removeKey(ref.key) # This is a reference, which should modify the original list.
 
 class DictReferenceProperty(ReferenceBaseProperty):
   """Dictionary based reference property.
@@ -531,18 +1414,42 @@ class DictReferenceProperty(ReferenceBaseProperty):
   This doesn't allow collection_name.
   """
 
+  mutable = True
+  tracked = True
+
   def __init__(self, *args, **kwargs):
     ReferenceBaseProperty.__init__(self, *args, **kwargs)
     if self.collection_name:
       raise RiakkitError("collection_name not allowed with DictReferenceProperty!")
 
+  def standardize(self, value):
+    value = BaseProperty.standardize(self, value)
+    return _tracked(value, ReferenceDict, dict)
 
   def attemptLoad(self, value):
-    new_values = {}
-    for key in value:
-      new_values[key] = ReferenceBaseProperty.attemptToLoad(self, value[key]) # key != value[key].key
+    if value is None:
+      return ReferenceDict()
 
-    return new_values
+    if not isinstance(value, ReferenceDict):
+      value = ReferenceDict(value)
+
+    if value._loaded or self.clstype == 1:
+      return value
+
+    # Same as MultiReferenceProperty.attemptLoad, loading is not a change.
+    changed = False
+    for key, v in value.iteritems():
+      loaded = ReferenceBaseProperty.attemptLoad(self, v) # key != value[key].key
+      if loaded is not v:
+        dict.__setitem__(value, key, loaded)
+        changed = True
+    if changed:
+      value._reindex()
+    value.__dict__["_loaded"] = True
+    return value
+
+  def loaded(self, value):
+    return isinstance(value, ReferenceDict) and (value._loaded or self.clstype == 1)
 
   def convertToDb(self, value):
     value = BaseProperty.convertToDb(self, value)
@@ -558,21 +1465,24 @@ class DictReferenceProperty(ReferenceBaseProperty):
   def convertFromDb(self, value):
     if value is None:
       value = {}
-    return BaseProperty.convertFromDb(self, value)
+    return _tracked(BaseProperty.convertFromDb(self, value), ReferenceDict, dict)
 
   def defaultValue(self):
-    return BaseProperty.defaultValue(self) or {}
+    return _tracked(BaseProperty.defaultValue(self) or {}, ReferenceDict, dict)
 
   def deleteReference(self, doc, ref):
     current = doc._data.get(self.name)
-    for k, r in current.iteritems():
-      if r.key == ref.key:
-        current.pop(k)
-        return True
-    return False
+    if current is None:
+      return False
+    if not isinstance(current, ReferenceDict):
+      current = doc._data[self.name] = ReferenceDict(current)
+    return current.removeKey(ref.key)
 
 class EmDocumentProperty(BaseProperty):
   """The EmDocument property"""
+
+  mutable = True
+
   def __init__(self, emdocument_class, required=False, validators=None,
                      forwardprocessors=None, backwardprocessors=None):
     """Initializes a EmDocumentProperty class
@@ -619,7 +1529,10 @@ class EmDocumentsDictProperty(BaseProperty):
 
   However, no convinient dot access for this.. unless demanded.
   """
-  class EmDocumentsDict(dict):
+
+  mutable = True
+
+  class EmDocumentsDict(TrackedDict):
     """A special dict that converts values like EmDocumentProperty and
     EmDocumentsListProperty."""
     def __init__(self, emdocument_class, x=None, **kwargs):
@@ -640,10 +1553,10 @@ class EmDocumentsDictProperty(BaseProperty):
       return value
 
     def __setitem__(self, key, value):
-      dict.__setitem__(self, key, self._standardize(value))
+      TrackedDict.__setitem__(self, key, self._standardize(value))
 
     def setdefault(self, key, default=None):
-      return dict.setdefault(self, key, self._standardize(default))
+      return TrackedDict.setdefault(self, key, self._standardize(default))
 
     def update(self, other=None, **kwargs):
       new_dict = {}
@@ -656,7 +1569,7 @@ class EmDocumentsDictProperty(BaseProperty):
         iteritems = kwargs
       for key, value in iteritems:
         new_dict[key] = self._standardize(value)
-      dict.update(self, new_dict)
+      TrackedDict.update(self, new_dict)
 
   def __init__(self, emdocument_class, required=False, validators=None,
                      forwardprocessors=None, backwardprocessors=None):
@@ -686,8 +1599,9 @@ class EmDocumentsDictProperty(BaseProperty):
 
   def convertFromDb(self, value):
     if value is not None:
-      for k, v in value.iteritems():
-        value[k] = self.emdocument_class.constructObject(v)
+      # A new dictionary, value is the one from the database.
+      constructObject = self.emdocument_class.constructObject
+      value = dict((k, constructObject(v)) for k, v in value.iteritems())
       value = EmDocumentsDictProperty.EmDocumentsDict(self.emdocument_class, value)
     return BaseProperty.convertFromDb(self, value)
 
@@ -696,7 +1610,11 @@ class EmDocumentsDictProperty(BaseProperty):
 
 class EmDocumentsListProperty(BaseProperty):
   """Property for a list of EmDocuments"""
-  class EmDocumentsList(list):
+
+  # EmDocumentsList is tracked, but not the EmDocuments inside of it.
+  mutable = True
+
+  class EmDocumentsList(TrackedList):
     """A special list that's a child of the built in list. Upon append it
     converts values like EmDocumentProperty. All interfaces except init stays
     the same. __init__ takes in a mandatory emdocument_class
@@ -733,17 +1651,17 @@ class EmDocumentsListProperty(BaseProperty):
       return value
 
     def append(self, x):
-      list.append(self, self._standardize(x))
+      TrackedList.append(self, self._standardize(x))
 
     def insert(self, i, x):
-      list.insert(self, i, self._standardize(x))
+      TrackedList.insert(self, i, self._standardize(x))
 
     def extend(self, x):
-      list.extend(self, self._standardizeList(x))
+      TrackedList.extend(self, self._standardizeList(x))
 
     def __setitem__(self, name, value):
       value = self._standardize(value)
-      list.__setitem__(self, name, value)
+      TrackedList.__setitem__(self, name, value)
 
   def __init__(self, emdocument_class, required=False, validators=None,
                      forwardprocessors=None, backwardprocessors=None):
@@ -773,8 +1691,8 @@ class EmDocumentsListProperty(BaseProperty):
 
   def convertFromDb(self, value):
     if value is not None:
-      for i, v in enumerate(value):
-        value[i] = self.emdocument_class.constructObject(v)
+      # A new list, value is the one from the database.
+      value = [self.emdocument_class.constructObject(v) for v in value]
       value = EmDocumentsListProperty.EmDocumentsList(self.emdocument_class, value)
     return BaseProperty.convertFromDb(self, value)
 
@@ -784,6 +1702,8 @@ class EmDocumentsListProperty(BaseProperty):
 ## Value Added Pack Starts Here
 
 class PasswordProperty(BaseProperty):
+  mutable = True
+
   def standardize(self, value):
     if not isinstance(value, basestring): # Feel like i'm doing too much of this. Isn't python all about ducttyping?
       raise TypeError("Password must be a string!")
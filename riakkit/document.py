@@ -14,12 +14,17 @@
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
 from copy import copy, deepcopy
-from weakref import WeakValueDictionary
-
-from riakkit.simple.basedocument import BaseDocumentMetaclass, BaseDocument, SimpleDocument
-from riakkit.commons.properties import BaseProperty, MultiReferenceProperty, ReferenceProperty
-from riakkit.commons import uuid1Key, getUniqueListGivenBucketName, getProperty, walkParents
+from weakref import WeakValueDictionary, ref
+
+from riakkit.simple.basedocument import BaseDocumentMetaclass, BaseDocument, SimpleDocument, addPropertyDescriptors
+from riakkit.commons.properties import BaseProperty, MultiReferenceProperty, ReferenceProperty, ReferenceList
+from riakkit.commons import uuid1Key, getUniqueListGivenBucketName, walkParents
+from riakkit.commons.codecs import getCodec
+from riakkit.commons import profiling
+from riakkit.commons.instrumentation import timed, cascading, GET, STORE, DELETE, INDEX, SEARCH, MAPREDUCE
 from riakkit.queries import *
+from riakkit.queries import _MAP_OBJECT
+from riakkit.backrefs import ShardedCollection, IndexedCollection
 from riakkit.commons.exceptions import *
 
 from riak import RiakObject
@@ -42,6 +47,30 @@ def getClassGivenBucketName(bucket_name):
   return _document_classes[bucket_name]
 
 
+class LazyBucket(object):
+  """The bucket attribute of Document classes. The RiakBucket is made from the
+  client and the bucket_name of the class the first time it is used."""
+
+  def __get__(self, instance, owner):
+    bucket = owner.__dict__.get("_bucket")
+    if bucket is None:
+      bucket = owner._codec.bind(getClient(owner).bucket(owner.bucket_name))
+      owner._bucket = bucket
+    return bucket
+
+
+def getClient(cls):
+  """Gets the client of a Document class.
+
+  Raises:
+    RiakkitError if the client is not set yet.
+  """
+  client = getattr(cls, "client", None)
+  if client is None:
+    raise RiakkitError("%s has no client!" % cls.__name__)
+  return client
+
+
 class DocumentMetaclass(BaseDocumentMetaclass):
   """Meta class that the Document class is made from.
 
@@ -52,10 +81,8 @@ class DocumentMetaclass(BaseDocumentMetaclass):
     if clsname == "Document":
       return type.__new__(cls, clsname, parents, attrs)
 
-    client = getProperty("client", attrs, parents)
-    if client is None:
-      return type.__new__(cls, clsname, parents, attrs)
-
+    # Nothing here needs the client: the buckets are only resolved when they
+    # are first used, so the client could be set after the class is defined.
     meta = {}
     uniques = []
     references_col_classes = []
@@ -66,30 +93,48 @@ class DocumentMetaclass(BaseDocumentMetaclass):
         meta[name] = prop = attrs.pop(name)
         refcls = getattr(prop, "reference_class", False)
         prop.name = name
+        if prop.index:
+          prop.index = prop.indexName(name)
         if refcls and not issubclass(refcls, Document):
           raise TypeError("ReferenceProperties for Document must be another Document!")
 
         colname = getattr(prop, "collection_name", False)
         if colname:
-          if colname in prop.reference_class._meta:
-            raise RiakkitError("%s already in %s!" % (colname, prop.reference_class))
-          references_col_classes.append((colname, prop.reference_class, name))
+          rcls = prop.reference_class
+          if colname in rcls._meta or colname in rcls._collections:
+            raise RiakkitError("%s already in %s!" % (colname, rcls))
+          references_col_classes.append((colname, prop, name))
           references.append(name)
         elif prop.unique: # Unique is not allowed with anything that has backref
-          prop.unique_bucket = client.bucket(getUniqueListGivenBucketName(attrs["bucket_name"], name))
+          prop.unique_bucket_name = getUniqueListGivenBucketName(attrs["bucket_name"], name)
           uniques.append(name)
+    own = meta.keys()
 
-    all_parents = reversed(walkParents(parents))
-    for p_cls in all_parents:
+    collections = {}
+    all_parents = walkParents(parents)
+    if len(parents) == 1 and all_parents:
+      # The parent already has everything from its own parents.
+      all_parents = all_parents[:1]
+    else:
+      own = None
+
+    for p_cls in reversed(all_parents):
       meta.update(p_cls._meta)
       uniques.extend(p_cls._uniques)
+      collections.update(p_cls._collections)
 
     attrs["_meta"] = meta
     attrs["_uniques"] = uniques
+    attrs["_collections"] = collections
+    attrs["_indexed"] = [(name, prop) for name, prop in meta.iteritems() if prop.index]
+    if "codec" in attrs:
+      attrs["_codec"] = getCodec(attrs["codec"])
     attrs["instances"] = WeakValueDictionary()
     attrs["_references"] = references
 
     new_class = type.__new__(cls, clsname, parents, attrs)
+    new_class._codec = new_class._codec.forClass(new_class)
+    addPropertyDescriptors(new_class, meta if own is None else own)
 
     bucket_name = attrs.get("bucket_name", None)
     if bucket_name is not None:
@@ -99,14 +144,28 @@ class DocumentMetaclass(BaseDocumentMetaclass):
       else:
         _document_classes[bucket_name] = new_class
 
-      new_class.bucket = client.bucket(bucket_name)
+    for name in new_class._uniques:
+      if new_class._meta[name].unique_owner is None:
+        new_class._meta[name].unique_owner = new_class
+
+    for colname, prop, back_name in references_col_classes:
+      rcls = prop.reference_class
+      if prop.collection_storage == "sharded":
+        ShardedCollection(new_class, back_name, colname, prop.collection_shards).bind(rcls)
+        continue
+      elif prop.collection_storage == "index":
+        IndexedCollection(new_class, back_name, colname).bind(rcls)
+        continue
 
-    for colname, rcls, back_name in references_col_classes:
       rcls._meta[colname] = MultiReferenceProperty(reference_class=new_class)
       rcls._meta[colname].name = colname
       rcls._meta[colname].is_reference_back = back_name
       rcls._references.append(colname)
+      addPropertyDescriptors(rcls, (colname, ))
+      if profiling.profiled(rcls):
+        profiling.enable(rcls) # For the new property
 
+    profiling.classCreated(new_class)
     return new_class
 
 class Document(SimpleDocument):
@@ -124,6 +183,12 @@ class Document(SimpleDocument):
   __metaclass__ = DocumentMetaclass
   _clsType = 2
 
+  bucket = LazyBucket()
+
+  # The revisions of the indexes and links last set on _obj.
+  _objIndexesRevision = None
+  _objLinksRevision = None
+
   def __init__(self, key=uuid1Key, saved=False, **kwargs):
     """Creates a new document from a bunch of keyword arguments.
 
@@ -147,14 +212,15 @@ class Document(SimpleDocument):
 
     self.__dict__["key"] = key
 
-    self._obj = self.bucket.get(self.key) if saved else None
-    self._links = set()
+    self._obj = timed(GET, type(self), self.bucket_name, key, self.bucket.get, key) if saved else None
+    self._links = {}
     self._indexes = {}
 
     BaseDocument.__init__(self, **kwargs)
 
     self.__class__.instances[self.key] = self
 
+  @cascading
   def save(self, w=None, dw=None, endpoint=False):
     """Saves the document into the database.
 
@@ -166,8 +232,10 @@ class Document(SimpleDocument):
       dw: DW value
     """
     dataToBeSaved = self.serialize()
+    self._indexProperties(dataToBeSaved)
     uniquesToBeDeleted = []
     othersToBeSaved = []
+    collectionsToBeUpdated = []
 
     # Process uniques
     for name in self._uniques:
@@ -186,95 +254,105 @@ class Document(SimpleDocument):
         else:
           changed = True
 
-        if changed and self._meta[name].unique_bucket.get(dataToBeSaved[name]).exists():
+        if changed and self._getUnique(name, dataToBeSaved[name]).exists():
           raise IntegrityError(
             field=name,
             message="'%s' already exists for '%s'!" % (self._data[name], name)
           )
 
-    # Process references
+    # Process references. Only the fields changed since the last load or save
+    # are looked at, and only the documents added to or removed from them.
+    raw = self._raw or {}
     for name in self._references:
-      currentDocsKeys = None
-      colname = self._meta[name].collection_name
+      prop = self._meta[name]
+      value = self._data.get(name)
+      if (self._raw is not None and prop.observable(value) and
+          not self._isChanged(name, prop)):
+        continue
+
+      originalDocsKeys = self._referenceKeys(raw.get(name))
+      colname = prop.collection_name
+
+      if colname and prop.collection_storage != "inline":
+        # The collection is not in the other documents, they are left alone.
+        collection = prop.reference_class._collections[colname]
+        collection.update(self, value)
+        currentDocsKeys = self._referenceKeys(value)
+        for dockey in currentDocsKeys - originalDocsKeys:
+          collectionsToBeUpdated.append((collection.add, dockey))
+        for dockey in originalDocsKeys - currentDocsKeys:
+          collectionsToBeUpdated.append((collection.remove, dockey))
+        continue
 
       if colname:
-        currentDocsKeys = set()
-        if isinstance(self._meta[name], ReferenceProperty):
+        if isinstance(prop, ReferenceProperty):
           docs = [getattr(self, name)]
         else:
           docs = getattr(self, name)
 
         for doc in docs: # These are foreign documents
-          if doc is None:
+          if doc is None or doc.key in originalDocsKeys:
             continue
 
-          currentDocsKeys.add(doc.key)
-
-          currentList = getattr(doc, colname, [])
-          found = False # Linear search algorithm. Maybe binary search??
-          for d in currentList:
-            if d.key == self.key:
-              found = True
-              break
-          if not found:
+          # Not through getattr, as that would load every document in the
+          # collection.
+          currentList = doc._data.get(colname)
+          if not isinstance(currentList, ReferenceList):
+            currentList = ReferenceList(currentList or ())
+          if not currentList.hasKey(self.key):
             currentList.append(self)
             doc._data[colname] = currentList
+            doc._fieldChanged(colname)
             othersToBeSaved.append((doc, False))
 
-
-      colname = colname or self._meta[name].is_reference_back
+      colname = colname or prop.is_reference_back
 
       if colname:
-        if self._obj:
-          originalValues = self._obj.get_data().get(name, [])
-          if not isinstance(originalValues, list):
-            originalValues = [originalValues]
-        else:
-          originalValues = []
-
-        if currentDocsKeys is None:
-          currentDocsKeys = set()
-          for d in self._data[name]:
-            if d is None:
-              continue
-            else:
-              currentDocsKeys.add(getattr(d, "key", d))
-
-        for dockey in originalValues:
-          if dockey is None:
-            continue
-
+        currentDocsKeys = self._referenceKeys(value)
+        for dockey in originalDocsKeys:
           # This means that this specific document is not in the current version,
           # but last version. Hence it needs to be cleaned from the last version.
           if dockey not in currentDocsKeys:
             try:
-              doc = self._meta[name].reference_class.load(dockey, True)
+              doc = prop.reference_class.load(dockey, True)
             except NotFoundError: # TODO: Another hackjob? This is _probably_ due to we're back deleting the reference.
               continue
             if doc._meta[colname].deleteReference(doc, self):
               othersToBeSaved.append((doc, True)) # CODE-REVIEW: For some reason i feel this won't work for some cases.
 
-
     if self._obj:
       self._obj.set_data(dataToBeSaved)
+      self._obj.set_content_type(self._codec.content_type)
     else:
-      self._obj = self.bucket.new(self.key, dataToBeSaved)
-
-    self._obj.set_links(self.links(True), True)
-    self._obj.set_indexes(self.indexes())
-    self.key = self._obj.get_key()
+      self._obj = self.bucket.new(self.key, dataToBeSaved, self._codec.content_type)
+      self._objIndexesRevision = self._objLinksRevision = None
+
+    # The links and indexes of _obj are only set if they changed since.
+    if self._objLinksRevision != self._linksRevision:
+      self._obj.set_links(self.links(True), True)
+      self._objLinksRevision = self._linksRevision
+    if self._objIndexesRevision != self._indexesRevision:
+      self._obj.set_indexes(self.indexesView())
+      self._objIndexesRevision = self._indexesRevision
+    self.__dict__["key"] = self._obj.get_key()
+
+    timed(STORE, type(self), self.bucket_name, self.key, self._obj.store, w=w, dw=dw)
+    self._resetRaw(dataToBeSaved)
+    for update, dockey in collectionsToBeUpdated:
+      update(dockey, self.key, w=w, dw=dw)
 
-    self._obj.store(w=w, dw=dw)
     for name in self._uniques:
-      if self._data[name] and not self._meta[name].unique_bucket.get(self._data[name]).exists():
-        obj = self._meta[name].unique_bucket.new(self._data[name], {"key" : self.key})
-        obj.store(w=w, dw=dw)
+      if self._data[name] and not self._getUnique(name, self._data[name]).exists():
+        bucket = self._meta[name].unique_bucket
+        obj = bucket.new(self._data[name], {"key" : self.key})
+        timed(STORE, type(self), bucket.get_name(), obj.get_key(), obj.store, w=w, dw=dw)
 
     for bucket, key in uniquesToBeDeleted:
-      bucket.get(key).delete()
+      obj = timed(GET, type(self), bucket.get_name(), key, bucket.get, key)
+      timed(DELETE, type(self), bucket.get_name(), key, obj.delete)
 
-    self.saved = True
-    self.deleted = False
+    self.__dict__["saved"] = True
+    self.__dict__["deleted"] = False
 
     if not endpoint: # CODE-REVIEW: Total hackjob. This gotta be redone
       for doc, end in othersToBeSaved:
@@ -282,6 +360,7 @@ class Document(SimpleDocument):
 
     return self
 
+  @cascading
   def reload(self, r=None, vtag=None):
     """Reloads the object from the database.
 
@@ -298,18 +377,53 @@ class Document(SimpleDocument):
       NotFoundError: if the object hasn't been saved before.
     """
     if self._obj:
-      self._obj.reload(r=r, vtag=vtag)
-      if not self._obj.exists():
-        self._deleted()
-      else:
-        self.saved = True
-        self.deleted = False
-        self.deserialize(self._obj.get_data())
-        self.setIndexes(self._getIndexesFromRiakObj(self._obj))
-        self.setLinks(self._getLinksFromRiakObj(self._obj))
+      timed(GET, type(self), self.bucket_name, self.key, self._obj.reload, r=r, vtag=vtag)
+      self._updateFromObj()
     else:
       raise NotFoundError("Object not saved!")
 
+  def _updateFromObj(self):
+    """Updates the document from _obj, which was just fetched."""
+    if not self._obj.exists():
+      self._deleted()
+    else:
+      self.__dict__["saved"] = True
+      self.__dict__["deleted"] = False
+      self.deserialize(self._obj.get_data())
+      self.setIndexes(self._getIndexesFromRiakObj(self._obj))
+      self._replaceLinks(self._getLinksFromRiakObj(self._obj))
+      self._resetRelations()
+      self._objIndexesRevision = self._indexesRevision
+      self._objLinksRevision = self._linksRevision
+
+  @staticmethod
+  def _referenceKeys(value):
+    """Gets the set of keys referred to by the value of a reference field,
+    either in the database form or not."""
+    if value is None:
+      return set()
+    if not isinstance(value, list):
+      value = [value]
+    return set(getattr(v, "key", v) for v in value if v is not None)
+
+  def _linkKey(self, document, tag):
+    # The links to documents without a bucket are stored in the bucket of this
+    # one (see links), so they have the same key once loaded back.
+    return (getattr(document, "bucket_name", None) or self.bucket_name, document.key, tag)
+
+  def _linkRef(self, document):
+    # Documents that could not be loaded back once collected (never saved, or
+    # without a bucket of their own) are held on to.
+    if getattr(document, "saved", False) and getattr(document, "bucket_name", None) in _document_classes:
+      return ref(document)
+    return document
+
+  @staticmethod
+  def _resolveLink(bucket, key):
+    if bucket not in _document_classes:
+      raise NotFoundError("%s is not in a bucket of a Document class." % key)
+    return getClassGivenBucketName(bucket).load(key, True)
+
   def _deleteBackRef(self, col_name, docs):
     docs_to_be_saved = []
     for doc in docs:
@@ -318,6 +432,7 @@ class Document(SimpleDocument):
 
     return docs_to_be_saved
 
+  @cascading
   def delete(self, rw=None):
     """Deletes this object from the database. Same interface as riak-python.
 
@@ -330,7 +445,16 @@ class Document(SimpleDocument):
       for k in self._meta:
         # is_reference_back is for deleting the document that has the collection_name
         # collection_name is the document that gives out collection_name
-        col_name = getattr(self._meta[k], "is_reference_back", False) or getattr(self._meta[k], "collection_name", False)
+        prop = self._meta[k]
+        col_name = getattr(prop, "is_reference_back", False) or getattr(prop, "collection_name", False)
+
+        if col_name and getattr(prop, "collection_storage", "inline") != "inline":
+          # Taken out of the collections without loading the referenced documents.
+          collection = prop.reference_class._collections[col_name]
+          dockeys = self._referenceKeys(self._data.get(k)) | self._referenceKeys((self._raw or {}).get(k))
+          for dockey in dockeys:
+            collection.remove(dockey, self.key)
+          continue
 
         if col_name:
           docs = getattr(self, k, [])
@@ -339,24 +463,36 @@ class Document(SimpleDocument):
               docs = [docs]
             docs_to_be_saved.extend(self._deleteBackRef(col_name, docs))
 
+      # The documents in the other collections of this document lose their
+      # reference to it, like the ones in inline collections.
+      for col_name, collection in self._collections.iteritems():
+        docs_to_be_saved.extend(self._deleteBackRef(collection.name, getattr(self, col_name)))
+        collection.clear(self.key, rw=rw)
+
       self.__class__.instances.pop(self.key, False)
 
-      self._obj.delete(rw=rw)
+      timed(DELETE, type(self), self.bucket_name, self.key, self._obj.delete, rw=rw)
 
       for name in self._uniques:
         if self._data[name] is not None:
-          obj = self._meta[name].unique_bucket.get(self._data[name])
-          obj.delete()
+          obj = self._getUnique(name, self._data[name])
+          timed(DELETE, type(self), obj.get_bucket().get_name(), self._data[name], obj.delete)
 
       self._deleted()
 
       for doc in docs_to_be_saved:
         doc.save()
 
+  def _getUnique(self, name, value):
+    """Gets the RiakObject that holds a value of the unique field name."""
+    bucket = self._meta[name].unique_bucket
+    return timed(GET, type(self), bucket.get_name(), value, bucket.get, value)
+
   def _deleted(self):
     self._obj = None
-    self.saved = False
-    self.deleted = True
+    self._objIndexesRevision = self._objLinksRevision = None
+    self.__dict__["saved"] = False
+    self.__dict__["deleted"] = True
     self.clear(False)
 
   def links(self, riakLinks=False):
@@ -368,8 +504,8 @@ class Document(SimpleDocument):
     Returns:
       A set of (document, tag) or [RiakLink, RiakLink]"""
     if riakLinks:
-      return [RiakLink(self.bucket_name, d.key, t) for d, t in self._links]
-    return copy(self._links)
+      return [RiakLink(b or self.bucket_name, k, t) for b, k, t in self._links]
+    return SimpleDocument.links(self)
 
   def getRawData(self, name, default=DocumentMetaclass):
     """Gets the raw data that's contained in the RiakObject.
@@ -409,15 +545,11 @@ class Document(SimpleDocument):
 
   @staticmethod
   def _getLinksFromRiakObj(robj):
-    objLinks = robj.get_links()
-    links = set()
-    for link in objLinks:
-      tag = link.get_tag()
-      c = getClassGivenBucketName(link.get_bucket())
-      links.add((c.load(link.get(), True), tag))
-    return links
+    # The linked documents are only loaded when links() is called.
+    return dict(((link.get_bucket(), link.get_key(), link.get_tag()), None) for link in robj.get_links())
 
   @classmethod
+  @cascading
   def load(cls, robj, cached=False, r=None):
     """Construct a Document based object given a RiakObject.
 
@@ -437,7 +569,7 @@ class Document(SimpleDocument):
     try:
       doc = cls.instances[key]
     except KeyError:
-      robj = cls.bucket.get(key, r)
+      robj = timed(GET, cls, cls.bucket_name, key, cls.bucket.get, key, r)
       if not robj.exists():
         raise NotFoundError("%s not found!" % key)
 
@@ -448,16 +580,88 @@ class Document(SimpleDocument):
       # exists, finish loading the referenced document, then come back and finish
       # loading this document.
 
-      doc = cls(key, saved=True)
+      doc = cls(key)
       doc._obj = robj
       cls.instances[key] = doc
-      doc.reload()
+      doc._updateFromObj() # robj was just fetched, no need to reload it.
     else:
       if not cached:
         doc.reload()
 
     return doc
 
+  @classmethod
+  @cascading
+  def _loadMany(cls, links, cached=False):
+    """Loads documents with a single map reduce, which sends back their
+    objects (_MAP_OBJECT), instead of fetching them one by one.
+
+    Args:
+      links: (bucket, key) of the documents, in the buckets of Document classes.
+      cached: Use the documents found in the pool of objects as they are.
+
+    Returns:
+      A dictionary of (bucket, key) : document, without the ones that are not
+      found.
+    """
+    owner = lambda bucket: cls if bucket == cls.bucket_name else getClassGivenBucketName(bucket)
+    docs = {}
+    mr = None
+    for bucket, key in links:
+      doc = owner(bucket).instances.get(key)
+      if cached and doc is not None:
+        docs[(bucket, key)] = doc
+      elif mr is None:
+        mr = getClient(cls).add(bucket, key)
+      else:
+        mr.add(bucket, key)
+
+    if mr is not None:
+      mr.map(_MAP_OBJECT)
+      for value in timed(MAPREDUCE, cls, cls.bucket_name, None, mr.run):
+        try:
+          docs[(value[0], value[1])] = owner(value[0])._loadFromMapReduce(value, cached)
+        except NotFoundError:
+          continue
+    return docs
+
+  @classmethod
+  def _loadFromMapReduce(cls, value, cached=False):
+    """Constructs a document from what _MAP_OBJECT sent back for it, the same
+    way load does from a fetched RiakObject.
+
+    Args:
+      value: [bucket, key, data, content type, links, indexes, vclock], or
+             [bucket, key] for an object with siblings, which is loaded by key.
+      cached: Use the document as it is if it's found in the pool of objects.
+
+    Returns:
+      A Document object.
+    """
+    key = value[1]
+    if len(value) == 2:
+      return cls.load(key, cached)
+
+    doc = cls.instances.get(key)
+    if cached and doc is not None:
+      return doc
+
+    bucketName, key, data, contentType, links, indexes, vclock = value
+    decoder = cls.bucket.get_decoder(contentType)
+    robj = cls.bucket.new(key, decoder(data) if decoder else data, contentType)
+    robj.set_links([RiakLink(b, k, t) for b, k, t in links], True)
+    robj.set_indexes([(field, int(v) if field.endswith("_int") else v) for field, v in indexes])
+    # What fetching the object would have set.
+    robj._vclock = vclock
+    robj._exists = True
+
+    if doc is None:
+      doc = cls(key)
+      cls.instances[key] = doc
+    doc._obj = robj
+    doc._updateFromObj()
+    return doc
+
   @classmethod
   def get(cls, key, cached=True, r=None):
     """Same as load, but the default of the cached is True.
@@ -493,7 +697,7 @@ class Document(SimpleDocument):
     Returns:
       True if the key exists, false otherwise.
     """
-    return cls.bucket.get(key, r).exists()
+    return timed(GET, cls, cls.bucket_name, key, cls.bucket.get, key, r).exists()
 
   @classmethod
   def search(cls, querytext):
@@ -508,7 +712,7 @@ class Document(SimpleDocument):
     Returns:
       A MapReduceQuery object. Similar to the RiakMapReduce object."""
     query_obj = cls.client.search(cls.bucket_name, querytext)
-    return MapReduceQuery(cls, query_obj)
+    return MapReduceQuery(cls, query_obj, SEARCH)
 
   @classmethod
   def solrSearch(cls, querytext, **kwargs):
@@ -520,7 +724,8 @@ class Document(SimpleDocument):
 
     Returns:
       A SolrQuery object. Similart to a MapReduceQuery"""
-    return SolrQuery(cls, cls.client.solr().search(cls.bucket_name, querytext, **kwargs))
+    result = timed(SEARCH, cls, cls.bucket_name, None, cls.client.solr().search, cls.bucket_name, querytext, **kwargs)
+    return SolrQuery(cls, result)
 
   @classmethod
   def indexLookup(cls, index, startkey, endkey=None):
@@ -534,13 +739,178 @@ class Document(SimpleDocument):
     Returns:
       A RiakMapReduce object
     """
-    return MapReduceQuery(cls, cls.client.index(cls.bucket_name, index, startkey, endkey))
+    return MapReduceQuery(cls, cls.client.index(cls.bucket_name, index, startkey, endkey), INDEX)
+
+  @classmethod
+  def query(cls, **condition):
+    """Looks up the documents with the index of a property (index=True).
+
+    Examples:
+      User.query(age=18)
+      User.query(age__range=(18, 25))
+
+    Args:
+      condition: One field=value or field__range=(start, end). The values are
+                 the same as the values of the field.
+
+    Returns:
+      A MapReduceQuery, same as indexLookup.
+
+    Raises:
+      RiakkitError if the field has no index, there's not exactly one
+      condition or the value is None (documents without a value are not in
+      the index).
+    """
+    if len(condition) != 1:
+      raise RiakkitError("query takes exactly one condition, not %d." % len(condition))
+
+    field, value = condition.items()[0]
+    isRange = field.endswith("__range")
+    if isRange:
+      field = field[:-len("__range")]
+
+    prop = cls._meta.get(field)
+    if prop is None or not prop.index:
+      raise RiakkitError("%s.%s has no index." % (cls.__name__, field))
+
+    def toIndex(v):
+      if prop.mutable: # Lists, sets... v is one of the elements.
+        values = prop.indexValues(getattr(v, "key", v))
+      else:
+        values = prop.indexValues(prop.convertToDb(prop.standardize(v)))
+      if not values:
+        raise RiakkitError("%s.%s cannot be queried with %r, it is not in the index." % (cls.__name__, field, v))
+      return values[0]
+
+    if isRange:
+      start, end = value
+      return cls.indexLookup(prop.index, toIndex(start), toIndex(end))
+    return cls.indexLookup(prop.index, toIndex(value))
+
+  @classmethod
+  def linkWalk(cls, keys, tag="_", depth=1, bucket="_", local=False):
+    """Follows the links of the documents with the keys.
+
+    The walk is a map reduce with a link phase for every hop, so only the
+    documents at the end are sent back. With local=True, it goes through the
+    links in memory instead. The documents of a hop that are not in memory
+    are then loaded together, by a single map reduce.
+
+    Args:
+      keys: A key or a list of keys of this class.
+      tag: The tag of the links to follow. "_" follows all of them.
+      depth: The number of hops. Default: 1
+      bucket: Only follow the links to this bucket. "_" follows all of them.
+      local: Follow the links here instead of in Riak. Default: False
+
+    Returns:
+      A LinkWalkQuery of the documents at the last hop.
+    """
+    if isinstance(keys, basestring):
+      keys = [keys]
+
+    if local:
+      docs = cls._loadMany([(cls.bucket_name, key) for key in keys], True)
+      return cls._walkLinks(docs.values(), tag, depth, bucket)
+
+    if not keys:
+      return LinkWalkQuery([], cls._resolveLinks)
+
+    mr = cls.client.add(cls.bucket_name, keys[0])
+    for key in keys[1:]:
+      mr.add(cls.bucket_name, key)
+    for i in xrange(depth):
+      mr.link(bucket, tag)
+    links = [(l.get_bucket(), l.get_key(), l.get_tag()) for l in timed(MAPREDUCE, cls, cls.bucket_name, None, mr.run)]
+    return LinkWalkQuery(links, cls._resolveLinks)
+
+  def walk(self, tag="_", depth=1, bucket="_", local=False):
+    """Follows the links of this document. See linkWalk.
+
+    With local=True, the links of this document are the ones in memory, which
+    do not have to be saved.
+
+    Returns:
+      A LinkWalkQuery of the documents at the last hop.
+    """
+    if local:
+      return self._walkLinks([self], tag, depth, bucket)
+    return self.linkWalk(self.key, tag, depth, bucket)
+
+  @classmethod
+  def _walkLinks(cls, docs, tag, depth, bucket):
+    """Follows the links of docs in memory. The documents of a hop are loaded
+    by a single map reduce, the ones at the last hop when the LinkWalkQuery is
+    iterated. The documents are resolved like links() does, so the ones still
+    in memory (saved or not) are used as they are, and the links that can't be
+    resolved are skipped.
+
+    Returns:
+      A LinkWalkQuery of the documents at the last hop.
+    """
+    found = {}
+    for hop in xrange(depth):
+      if hop:
+        docs = cls._followLinks(found).values()
+
+      found = {}
+      for doc in docs:
+        for linkKey, document in doc.linksView().iteritems():
+          b, k, t = linkKey
+          if (tag == "_" or t == tag) and (bucket == "_" or b == bucket) and (b, k) not in found:
+            found[(b, k)] = (t, doc, document)
+
+    links = [(b, k, t) for (b, k), (t, doc, document) in found.iteritems()]
+    return LinkWalkQuery(links, lambda links: cls._followLinks(found))
+
+  @classmethod
+  def _followLinks(cls, found):
+    """Gets the documents of the links found by _walkLinks, like
+    _linkedDocument does. The ones that are no longer in memory are loaded
+    together, by a single map reduce.
+
+    Args:
+      found: A dictionary of (bucket, key) : (tag, document that has the link,
+             what its _links holds for it).
+
+    Returns:
+      A dictionary of (bucket, key) : document, without the ones that can't be
+      resolved.
+    """
+    docs = {}
+    missing = []
+    for (b, k), (t, doc, document) in found.iteritems():
+      if isinstance(document, ref):
+        document = document()
+      if document is not None:
+        docs[(b, k)] = document
+      elif b in _document_classes:
+        missing.append((b, k))
+
+    loaded = cls._loadMany(missing, True)
+    for (b, k), document in loaded.iteritems():
+      t, doc = found[(b, k)][:2]
+      # Only remembered, not a change of the links.
+      doc._links[(b, k, t)] = doc._linkRef(document)
+    docs.update(loaded)
+    return docs
+
+  @classmethod
+  def _resolveLinks(cls, links):
+    """Loads the documents of (bucket, key, tag) links like _resolveLink, by a
+    single map reduce.
+
+    Returns:
+      A dictionary of (bucket, key) : document, without the ones that can't be
+      resolved.
+    """
+    return cls._loadMany([(b, k) for b, k, t in links if b in _document_classes], True)
 
   @classmethod
-  def mapreduce(cls): # TODO: Make a better interface
-    """Shorthand for creating a query object for map reduce.
+  def mapreduce(cls):
+    """Starts a map reduce over the bucket of this class.
 
     Returns:
-      A RiakMapReduce object.
+      A MapReduceBuilder, which could also be used as a RiakMapReduce.
     """
-    return cls.client.add(cls.bucket_name)
+    return MapReduceBuilder(cls, cls.client.add(cls.bucket_name))
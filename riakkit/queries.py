@@ -14,6 +14,12 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+
+from riakkit.commons.exceptions import NotFoundError, RiakkitError
+from riakkit.commons.properties import IntegerProperty, FloatProperty, DateTimeProperty
+from riakkit.commons.instrumentation import timed, MAPREDUCE
+
 class SolrQuery(object):
   """A wrapper around RiakSearch to play nice with Document and Solr
 
@@ -24,7 +30,7 @@ class SolrQuery(object):
   def __init__(self, cls, result):
     self.cls = cls
     self.result = result
-    self.loadDoc = lambda doc : self.cls.load(self.cls.bucket.get(doc[u"id"]))
+    self.loadDoc = lambda doc : self.cls.load(doc[u"id"])
 
   def length(self):
     """Gets the length of the documents that's searched through."""
@@ -45,23 +51,221 @@ class SolrQuery(object):
     return map(self.loadDoc, self.result[u"response"][u"docs"])
 
 
+# Javascript phases of MapReduceQuery and MapReduceBuilder. arg is given
+# through the phase options.
+_MAP_FILTER = """function(v, keydata, arg) {
+  if (v.not_found) return [];
+  var d = Riak.mapValuesJson(v)[0];
+  for (var i = 0; i < arg.length; i++) {
+    var c = arg[i], x = d[c[0]];
+    if (c[1] == "eq" && JSON.stringify(x) != JSON.stringify(c[2])) return [];
+    if (c[1] == "range" && !(x >= c[2] && x <= c[3])) return [];
+    if (c[1] == "contains") {
+      var found = false;
+      for (var j in x) if (JSON.stringify(x[j]) == JSON.stringify(c[2])) found = true;
+      if (!found) return [];
+    }
+  }
+  return [[v.bucket, v.key]];
+}"""
+
+# Riak's key filters (see the Riak documentation), for the inputs they cannot
+# be given to (index lookups and searches).
+_MAP_KEY_FILTER = """function(v, keydata, arg) {
+  function apply(x, filters) {
+    for (var i = 0; i < filters.length; i++) {
+      var f = filters[i], op = f[0];
+      if (op == "int_to_string" || op == "float_to_string") x = String(x);
+      else if (op == "string_to_int") x = parseInt(x, 10);
+      else if (op == "string_to_float") x = parseFloat(x);
+      else if (op == "to_upper") x = x.toUpperCase();
+      else if (op == "to_lower") x = x.toLowerCase();
+      else if (op == "tokenize") x = x.split(f[1])[f[2] - 1];
+      else if (op == "urldecode") x = decodeURIComponent(x);
+      else if (!test(x, f)) return false;
+    }
+    return true;
+  }
+  function test(x, f) {
+    var op = f[0];
+    if (x === undefined) return false;
+    if (op == "eq") return x == f[1];
+    if (op == "neq") return x != f[1];
+    if (op == "greater_than") return x > f[1];
+    if (op == "less_than") return x < f[1];
+    if (op == "greater_than_eq") return x >= f[1];
+    if (op == "less_than_eq") return x <= f[1];
+    if (op == "between") return f[3] === false ? x > f[1] && x < f[2] : x >= f[1] && x <= f[2];
+    if (op == "matches") return new RegExp(f[1]).test(x);
+    if (op == "starts_with") return x.indexOf(f[1]) == 0;
+    if (op == "ends_with") return x.slice(-f[1].length) == f[1];
+    if (op == "set_member") return f.slice(1).indexOf(x) != -1;
+    if (op == "and") return apply(x, f[1]) && apply(x, f[2]);
+    if (op == "or") return apply(x, f[1]) || apply(x, f[2]);
+    if (op == "not") return !apply(x, f[1]);
+    return false;
+  }
+  return !v.not_found && apply(v.key, arg) ? [[v.bucket, v.key]] : [];
+}"""
+
+_MAP_COUNT = """function(v) { return v.not_found ? [] : [1]; }"""
+
+_MAP_FIELD = """function(v, keydata, arg) {
+  if (v.not_found) return [];
+  var x = Riak.mapValuesJson(v)[0][arg];
+  return (x === undefined || x === null) ? [] : [x];
+}"""
+
+_MAP_GROUP = """function(v, keydata, arg) {
+  if (v.not_found) return [];
+  var x = Riak.mapValuesJson(v)[0][arg];
+  var r = {};
+  r[JSON.stringify(x === undefined ? null : x)] = 1;
+  return [r];
+}"""
+
+_REDUCE_GROUP = """function(values) {
+  var r = {};
+  for (var i = 0; i < values.length; i++)
+    for (var k in values[i]) r[k] = (r[k] || 0) + values[i][k];
+  return [r];
+}"""
+
+_MAP_VALUES = """function(v, keydata, arg) {
+  if (v.not_found) return [];
+  var d = Riak.mapValuesJson(v)[0];
+  if (arg) {
+    var r = {};
+    for (var i = 0; i < arg.length; i++) r[arg[i]] = d[arg[i]];
+    d = r;
+  }
+  return [[v.key, d]];
+}"""
+
+# Sends back an object as it would be fetched: [bucket, key, data, content type,
+# links, indexes, vclock], or [bucket, key] if it has siblings, which are left
+# to a fetch.
+_MAP_OBJECT = """function(v) {
+  if (v.not_found) return [];
+  if (v.values.length != 1) return [[v.bucket, v.key]];
+  var m = v.values[0].metadata;
+  if (m["X-Riak-Deleted"]) return [];
+  var links = m["Links"] || [], index = m["index"] || {}, indexes = [];
+  for (var field in index) {
+    var values = index[field] instanceof Array ? index[field] : [index[field]];
+    for (var i = 0; i < values.length; i++) indexes.push([field, values[i]]);
+  }
+  return [[v.bucket, v.key, v.values[0].data, m["content-type"], links, indexes, v.vclock]];
+}"""
+
+
 class MapReduceQuery(object):
   """A wrapper around RiakMapReduce to play nice with Document
 
+  It is run the first time its results are needed. Until then, keyFilter()
+  and where() could narrow it down in Riak, so only the matching documents
+  are sent back. Their objects are sent back with them (a last map phase), so
+  they don't have to be fetched again.
+
   Attributes:
     cls: The class for this MapReduceQuery.
     mr_obj: The original RiakMapReduce object.
-    riak_links: All the links returned from the run operation of RiakMapReduce.
+    operation: What it is reported as, see riakkit.commons.instrumentation.
+    riak_links: All the links returned from the run operation of RiakMapReduce,
+                or what _MAP_OBJECT gave for the documents if it was filtered.
   """
-  def __init__(self, cls, mr_obj):
+  def __init__(self, cls, mr_obj, operation=MAPREDUCE):
     self.cls = cls
     self.mr_obj = mr_obj
-    self.riak_links = mr_obj.run()
+    self.operation = operation
+    self._links = None
+    self._keyFilters = []
+    self._conditions = []
+
+  def keyFilter(self, *args):
+    """Only keeps the documents whose key passes a key filter. The filters
+    given by successive calls are applied one after another, the same way as
+    Riak's key filters. As those could not be used on index lookups and
+    searches, they are done in a map phase.
+
+    Example:
+      User.indexLookup("age_int", 18).keyFilter("tokenize", "-", 1).keyFilter("eq", "admin")
+
+    Args:
+      args: The name of the filter and its arguments, as the Riak documentation
+            has them.
+
+    Returns:
+      self for OOP purposes.
+    """
+    self._notRun()
+    self._keyFilters.append(list(args))
+    return self
+
+  def where(self, **conditions):
+    """Only keeps the documents matching the conditions, checked in a map
+    phase. Same conditions as MapReduceBuilder.filter.
+
+    Example:
+      User.indexLookup("age_int", 18, 25).where(name="John")
+
+    Returns:
+      self for OOP purposes.
+    """
+    self._notRun()
+    self._conditions.extend(_fieldConditions(self.cls, conditions))
+    return self
+
+  def _notRun(self):
+    if self._links is not None:
+      raise RiakkitError("This query has already been run.")
+
+  @property
+  def riak_links(self):
+    if self._links is None:
+      if self._keyFilters:
+        self.mr_obj.map(_MAP_KEY_FILTER, {"arg" : self._keyFilters})
+      if self._conditions:
+        self.mr_obj.map(_MAP_FILTER, {"arg" : self._conditions})
+      if self._filtered():
+        self.mr_obj.map(_MAP_OBJECT)
+      self._links = timed(self.operation, self.cls, self.cls.bucket_name, None, self.mr_obj.run)
+    return self._links
+
+  def keys(self):
+    """Gets the keys of the documents.
+
+    Returns:
+      A list of keys.
+    """
+    return [link[1] if isinstance(link, list) else link.get_key() for link in self.riak_links]
+
+  def _filtered(self):
+    return bool(self._keyFilters or self._conditions)
 
   def run(self):
-    """A generator that goes through riak_link"""
-    for link in self.riak_links:
-      yield self.cls.load(link.get())
+    """A generator that goes through the documents. Documents that are no
+    longer there are skipped.
+
+    The documents of a filtered query are made from the objects that came
+    with it. Otherwise, they are all fetched by a single map reduce (see
+    Document._loadMany) when it starts, rather than one request each."""
+    cls = self.cls
+    if self._filtered():
+      for value in self.riak_links:
+        try:
+          yield cls._loadFromMapReduce(value)
+        except NotFoundError:
+          continue
+    else:
+      keys = self.keys()
+      docs = cls._loadMany([(cls.bucket_name, key) for key in keys])
+      for key in keys:
+        doc = docs.get((cls.bucket_name, key))
+        if doc is not None:
+          yield doc
+
+  __iter__ = run
 
   def length(self):
     """The number of objects in this query.
@@ -71,10 +275,338 @@ class MapReduceQuery(object):
     """
     return len(self.riak_links)
 
+  __len__ = length
+
+  def all(self):
+    """Returns all the Documents in a single list.
+
+    Returns:
+      A list containing all the Documents
+    """
+    return list(self.run())
+
+
+class MapReduceBuilder(object):
+  """Builds a map reduce over the documents of a class (Document.mapreduce()).
+
+  The phases are chained like with RiakMapReduce, which is still reachable as
+  mr_obj (and whose other methods are available on the builder). On top of
+  these, filter() adds a map phase generated from the properties, and
+  count(), sum(), min(), max(), groupBy() and values() add the phases for
+  those aggregations, run the job and decode the result.
+
+  The generated phases are javascript, so they need the documents to be stored
+  as JSON.
+
+  Example:
+    User.mapreduce().filter(age__range=(18, 25)).count()
+
+  Attributes:
+    cls: The class for this MapReduceBuilder.
+    mr_obj: The RiakMapReduce object.
+  """
+  def __init__(self, cls, mr_obj):
+    self.cls = cls
+    self.mr_obj = mr_obj
+
+  def __getattr__(self, name):
+    return getattr(self.mr_obj, name)
+
+  def add(self, *args):
+    """Adds inputs, see RiakMapReduce.add."""
+    self.mr_obj.add(*args)
+    return self
+
+  def map(self, function, options=None):
+    """Adds a map phase, see RiakMapReduce.map."""
+    self.mr_obj.map(function, options)
+    return self
+
+  def reduce(self, function, options=None):
+    """Adds a reduce phase, see RiakMapReduce.reduce."""
+    self.mr_obj.reduce(function, options)
+    return self
+
+  def link(self, bucket="_", tag="_", keep=False):
+    """Adds a link phase, see RiakMapReduce.link."""
+    self.mr_obj.link(bucket, tag, keep)
+    return self
+
+  def run(self, timeout=None):
+    """Runs the job, see RiakMapReduce.run."""
+    return timed(MAPREDUCE, self.cls, self.cls.bucket_name, None, self.mr_obj.run, timeout)
+
+  def keyFilter(self, *args):
+    """Adds a key filter, which is applied by Riak before any phase.
+
+    Example:
+      User.mapreduce().keyFilter("starts_with", "admin")
+
+    Args:
+      args: The name of the filter and its arguments, as the Riak documentation
+            has them.
+    """
+    self.mr_obj.add_key_filter(*args)
+    return self
+
+  def filter(self, **conditions):
+    """Adds a map phase that only keeps the documents matching all the
+    conditions. Its outputs are the [bucket, key] of the documents, so
+    other phases could follow.
+
+    Examples:
+      User.mapreduce().filter(name="John", age__range=(18, 25))
+
+    Args:
+      conditions: field=value or field__range=(start, end). The values are the
+                  same as the values of the field, for a list or set field,
+                  value is one of the elements.
+
+    Raises:
+      RiakkitError if a field is not a property of the class.
+    """
+    return self.map(_MAP_FILTER, {"arg" : _fieldConditions(self.cls, conditions)})
+
+  def count(self):
+    """Counts the documents.
+
+    Returns:
+      An integer.
+    """
+    result = self.map(_MAP_COUNT).reduce("Riak.reduceSum").run()
+    return result[0] if result else 0
+
+  def sum(self, field):
+    """Sums a numeric field over the documents.
+
+    Returns:
+      The sum, 0 if there are no documents.
+    """
+    return self._aggregate(field, "Riak.reduceSum", 0)
+
+  def min(self, field):
+    """Gets the minimum of a numeric field over the documents.
+
+    Returns:
+      The minimum, or None if there are no documents.
+    """
+    return self._aggregate(field, "Riak.reduceMin", None)
+
+  def max(self, field):
+    """Gets the maximum of a numeric field over the documents.
+
+    Returns:
+      The maximum, or None if there are no documents.
+    """
+    return self._aggregate(field, "Riak.reduceMax", None)
+
+  def groupBy(self, field):
+    """Counts the documents for every value of a field.
+
+    Returns:
+      A dictionary of value : number of documents. The documents without a
+      value for the field are counted under None.
+
+    Raises:
+      RiakkitError if the field is a list, set or dictionary.
+    """
+    prop = self._property(field)
+    if prop.mutable:
+      raise RiakkitError("Cannot group by %s, its values are not hashable." % field)
+
+    result = self.map(_MAP_GROUP, {"arg" : field}).reduce(_REDUCE_GROUP).run()
+    groups = {}
+    for value, count in (result[0] if result else {}).iteritems():
+      value = json.loads(value)
+      if value is not None: # The documents without the field.
+        value = prop.convertFromDb(value)
+      groups[value] = groups.get(value, 0) + count
+    return groups
+
+  def values(self, *fields):
+    """Gets the data of the documents without creating them. Only the fields
+    asked for are sent back by Riak.
+
+    Args:
+      fields: The fields to get. All of them if none are given.
+
+    Returns:
+      A list of (key, {field : value}). The values are converted with
+      convertFromDb of their property.
+    """
+    for field in fields:
+      self._property(field)
+
+    result = self.map(_MAP_VALUES, {"arg" : list(fields) or None}).run()
+    meta = self.cls._meta
+    values = []
+    for key, data in result:
+      for name, value in data.iteritems():
+        prop = meta.get(name)
+        if prop is not None:
+          data[name] = prop.convertFromDb(value)
+      values.append((key, data))
+    return values
+
+  def _aggregate(self, field, reducer, default):
+    prop = self._property(field)
+    if not isinstance(prop, (IntegerProperty, FloatProperty, DateTimeProperty)):
+      raise RiakkitError("%s is not a numeric field." % field)
+
+    result = self.map(_MAP_FIELD, {"arg" : field}).reduce(reducer).run()
+    if not result:
+      return default
+    return prop.convertFromDb(result[0])
+
+  def _property(self, field):
+    return _jsonProperty(self.cls, field)
+
+
+def _jsonProperty(cls, field):
+  """Gets the property of a field used in a javascript phase."""
+  prop = cls._meta.get(field)
+  if prop is None:
+    raise RiakkitError("%s has no field %s." % (cls.__name__, field))
+  if cls._codec.content_type != "application/json":
+    raise RiakkitError("%s is not stored as JSON, which javascript phases need." % cls.__name__)
+  return prop
+
+
+def _fieldConditions(cls, conditions):
+  """Converts field=value and field__range=(start, end) into the arg of
+  _MAP_FILTER."""
+  toDb = lambda prop, value: prop.convertToDb(prop.standardize(value))
+  arg = []
+  for field, value in conditions.iteritems():
+    isRange = field.endswith("__range")
+    if isRange:
+      field = field[:-len("__range")]
+    prop = _jsonProperty(cls, field)
+
+    if isRange:
+      start, end = value
+      arg.append([field, "range", toDb(prop, start), toDb(prop, end)])
+    elif prop.mutable:
+      arg.append([field, "contains", getattr(value, "key", value)])
+    else:
+      arg.append([field, "eq", toDb(prop, value)])
+  return arg
+
+
+class LinkWalkQuery(object):
+  """The documents at the end of a link walk (Document.walk, Document.linkWalk).
+
+  The documents are only loaded as it is iterated, all at once.
+
+  Attributes:
+    links: A list of (bucket, key, tag) that were reached.
+  """
+  def __init__(self, links, load):
+    """Initializes the query.
+
+    Args:
+      links: A list of (bucket, key, tag).
+      load: A function taking the links, giving a dictionary of
+            (bucket, key) : document for the ones that could be loaded.
+    """
+    self.links = links
+    self._load = load
+
+  def run(self):
+    """A generator that goes through the documents. Documents that are no
+    longer there are skipped."""
+    docs = self._load(self.links)
+    for bucket, key, tag in self.links:
+      doc = docs.get((bucket, key))
+      if doc is not None:
+        yield doc
+
+  __iter__ = run
+
+  def length(self):
+    """The number of links that were reached.
+
+    Return:
+      an integer.
+    """
+    return len(self.links)
+
+  __len__ = length
+
+  def all(self):
+    """Returns all the Documents in a single list.
+
+    Returns:
+      A list containing all the Documents
+    """
+    return list(self.run())
+
+
+class ShardedQuery(object):
+  """The documents in a sharded collection_name (see riakkit.backrefs).
+
+  Nothing is read until it is iterated, and then only one shard at a time.
+
+  Attributes:
+    collection: The ShardedCollection.
+    key: The key of the document that owns the collection.
+  """
+  def __init__(self, collection, key):
+    self.collection = collection
+    self.key = key
+
+  def pages(self):
+    """A generator that goes through the keys, a shard at a time.
+
+    Yields:
+      A list of keys for every shard that is not empty.
+    """
+    for number in xrange(self.collection.shards):
+      obj = self.collection.shard(self.key, number)
+      if obj.exists():
+        keys = obj.get_data()
+        if keys:
+          yield keys
+
+  def keys(self):
+    """A generator that goes through the keys of the documents."""
+    for page in self.pages():
+      for key in page:
+        yield key
+
+  def run(self):
+    """A generator that goes through the documents. Documents that are no
+    longer there are skipped. The ones of a shard that are not in memory are
+    fetched together, by a single map reduce."""
+    cls = self.collection.cls
+    for page in self.pages():
+      docs = cls._loadMany([(cls.bucket_name, key) for key in page], True)
+      for key in page:
+        doc = docs.get((cls.bucket_name, key))
+        if doc is not None:
+          yield doc
+
+  __iter__ = run
+
+  def length(self):
+    """The number of documents. This reads every shard.
+
+    Return:
+      an integer.
+    """
+    return sum(len(page) for page in self.pages())
+
+  __len__ = length
+
+  def __contains__(self, doc):
+    key = getattr(doc, "key", doc)
+    obj = self.collection.shard(self.key, self.collection.shardOf(key))
+    return obj.exists() and key in (obj.get_data() or ())
+
   def all(self):
     """Returns all the Documents in a single list.
 
     Returns:
       A list containing all the Documents
     """
-    return map(lambda link: self.cls.load(link.get()), self.riak_links)
+    return list(self.run())
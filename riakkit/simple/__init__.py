@@ -14,3 +14,4 @@
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
 from basedocument import BaseDocument, SimpleDocument
+from indexcollection import IndexCollection
@@ -14,13 +14,85 @@
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
 from riakkit.commons import walkParents, uuid1Key
-from riakkit.commons.properties import BaseProperty, ReferenceBaseProperty
-from riakkit.commons.exceptions import ValidationError
+from riakkit.commons.properties import BaseProperty, ReferenceBaseProperty, INVALID
+from riakkit.commons.exceptions import ValidationError, NotFoundError
+from riakkit.commons.codecs import JSON_CODEC, getCodec
+from riakkit.commons import profiling
 
-from copy import copy, deepcopy
+from copy import copy
+from weakref import ref
 import json
 from riak.mapreduce import RiakLink
 
+class PropertyDescriptor(object):
+  """Reads a property straight from the _data of the documents, instead of
+  going through BaseDocument.__getattr__. The metaclasses put one on the class
+  for each property. On the class itself, it gives the property.
+  """
+  __slots__ = ("name", "prop")
+
+  def __init__(self, name, prop):
+    self.name = name
+    self.prop = prop
+
+  def __get__(self, doc, cls):
+    if doc is None:
+      return self.prop
+
+    try:
+      return doc._data[self.name]
+    except KeyError:
+      doc._attrError(self.name)
+
+
+class ReferenceDescriptor(PropertyDescriptor):
+  """PropertyDescriptor of the reference properties. The referenced documents
+  are loaded the first time they are read and kept in _data."""
+  __slots__ = ()
+
+  def __get__(self, doc, cls):
+    if doc is None:
+      return self.prop
+
+    data = doc._data
+    try:
+      value = data[self.name]
+    except KeyError:
+      doc._attrError(self.name)
+
+    if not self.prop.loaded(value):
+      value = data[self.name] = self.prop.attemptLoad(value)
+    return value
+
+
+def addPropertyDescriptors(cls, names):
+  """Puts a PropertyDescriptor for each of the names of properties on a class.
+
+  Names that the class or its parents already use for something else (methods,
+  class attributes) are left alone, those are still found first and the
+  property goes through __getattr__ like before.
+
+  Args:
+    cls: The class, once it's created.
+    names: The names of properties in cls._meta.
+  """
+  for name in names:
+    for c in cls.__mro__:
+      if name in c.__dict__:
+        break
+    else:
+      c = None
+
+    if c is not None and not isinstance(c.__dict__[name], PropertyDescriptor):
+      continue
+
+    prop = cls._meta[name]
+    if isinstance(prop, ReferenceBaseProperty):
+      descriptor = ReferenceDescriptor(name, prop)
+    else:
+      descriptor = PropertyDescriptor(name, prop)
+    setattr(cls, name, descriptor)
+
 class BaseDocumentMetaclass(type):
   def __new__(cls, clsname, parents, attrs):
     if clsname in ("BaseDocument", "SimpleDocument"):
@@ -29,18 +101,37 @@ class BaseDocumentMetaclass(type):
     meta = {}
     for name in attrs.keys():
       if isinstance(attrs[name], BaseProperty):
-        meta[name] = attrs.pop(name)
-
-    all_parents = reversed(walkParents(parents, ("BaseDocument", "SimpleDocument", "object", "type")))
+        meta[name] = prop = attrs.pop(name)
+        prop.name = name
+        if prop.index:
+          prop.index = prop.indexName(name)
+    own = meta.keys()
+
+    all_parents = walkParents(parents, ("BaseDocument", "SimpleDocument", "object", "type"))
+    if len(parents) == 1 and all_parents:
+      # The _meta of the parent already has the properties of its own parents.
+      all_parents = all_parents[:1]
+    else:
+      own = None
 
-    for p_cls in all_parents:
+    for p_cls in reversed(all_parents):
       meta.update(copy(p_cls._meta))
     attrs["_meta"] = meta
+    attrs["_indexed"] = [(name, prop) for name, prop in meta.iteritems() if prop.index]
 
-    return type.__new__(cls, clsname, parents, attrs)
+    if "codec" in attrs:
+      attrs["_codec"] = getCodec(attrs["codec"])
+
+    new_class = type.__new__(cls, clsname, parents, attrs)
+    new_class._codec = new_class._codec.forClass(new_class)
+    # With a single parent, its descriptors are already right for the
+    # properties it has.
+    addPropertyDescriptors(new_class, meta if own is None else own)
+    profiling.classCreated(new_class)
+    return new_class
 
   def __getattr__(self, name):
-    if name in self._meta:
+    if name != "_meta" and name in self._meta:
       return self._meta[name]
     raise AttributeError
 
@@ -67,6 +158,15 @@ class BaseDocument(object):
   # of the RAD and use the core for efficiency.
   _clsType = 0
 
+  # The codec used by serialize(dictionary=False), deserialize with a string
+  # and when the document is written into a RiakObject. Could be the name of a
+  # registered codec or a Codec object. See riakkit.commons.codecs
+  codec = "json"
+  _codec = JSON_CODEC
+
+  # The (name, property) with index, see SimpleDocument._indexProperties
+  _indexed = ()
+
   def __init__(self, **kwargs):
     """Initialize a new BaseDocument.
 
@@ -100,7 +200,8 @@ class BaseDocument(object):
 
     Args:
       dictionary: If True, this function will return a dictionary passed back
-                  to riak-python-client. Otherwise it will return a JSON.
+                  to riak-python-client. Otherwise it will return a string
+                  encoded with the codec of this class (JSON by default).
     Returns:
       A dictionary or a string. Depending on the value of dictionary.
     """
@@ -111,7 +212,7 @@ class BaseDocument(object):
     if dictionary:
       return d
     else:
-      return json.dumps(d)
+      return self._codec.encode(d)
 
   def _processOneValue(self, d, name, value):
     prop = self._meta.get(name, None)
@@ -122,6 +223,16 @@ class BaseDocument(object):
     if not self.validate(name):
       self._valiError(value, name)
 
+    raw = self._raw
+    if raw is not None and prop is not None:
+      rawValue = raw.get(name)
+      # None is converted to the default value on load, so it has to go through
+      # the conversion again.
+      if (rawValue is not None and prop.rawPassthrough(value) and
+          not self._isChanged(name, prop)):
+        d[unicode(name)] = rawValue
+        return
+
     value = converter(value)
 
     d[unicode(name)] = value
@@ -151,12 +262,40 @@ class BaseDocument(object):
     if name in self._meta:
       prop = self._meta[name]
       value = self._data[name]
+      if name in self._validated:
+        stamp = self._validated[name]
+        if stamp is None or stamp == getattr(value, "_mutations", None):
+          return True
+
       if prop.required and value is None:
         return False
-      else:
-        return prop.validate(value)
+      elif prop.validate(value):
+        self._validationPassed(name, prop, value)
+        return True
+      return False
     return True
 
+  def _validationPassed(self, name, prop, value):
+    # Values that could change without us knowing are always validated again.
+    # For tracked containers, the number of changes is kept so we know if it
+    # changed since.
+    if prop.observable(value):
+      if prop.mutable:
+        self._validated[name] = getattr(value, "_mutations", None)
+      else:
+        self._validated[name] = None
+
+  def _isChanged(self, name, prop):
+    """Checks if an observable field changed since the data in _raw."""
+    if name in self._dirty:
+      return True
+
+    if prop.mutable:
+      value = self._data[name]
+      return value is not None and value._mutations != self._clean.get(name, 0)
+
+    return False
+
   @classmethod
   def constructObject(cls, data):
     """Construct an object given some data.
@@ -177,15 +316,17 @@ class BaseDocument(object):
     call convertFromDb. This method will also clear the document.
 
     Args:
-      data: The data, either a dictionary or a json string.
+      data: The data, either a dictionary or a string encoded with the codec
+            of this class (JSON by default).
 
     Returns:
       self for OOP purposes.
     """
     if isinstance(data, basestring):
-      data = json.loads(data)
+      data = self._codec.decode(data)
 
     self.clear()
+    self._raw = dict(data) # Not the dictionary of the caller.
     keys = set(self._meta.keys())
     for name, value in data.iteritems():
       prop = self._meta.get(name, None)
@@ -230,6 +371,16 @@ class BaseDocument(object):
     Returns:
       self for OOP"""
     self._data = {}
+    # The data from the database (as given to deserialize) and the name of the
+    # fields that has been changed since. Unchanged fields are saved back as
+    # they were in _raw instead of being converted again.
+    self._raw = None
+    self._dirty = set()
+    # The number of changes of the tracked containers when _raw was set.
+    self._clean = {}
+    # The fields whose current value is known to be valid, mapped to the number
+    # of changes of the value when it was validated (None if not a container).
+    self._validated = {}
 
     if setdefault:
       for name, prop in self._meta.iteritems():
@@ -242,24 +393,139 @@ class BaseDocument(object):
       self.__dict__[name] = value
       return
 
-    validator = lambda x: True
-    standardizer = lambda x: x
-    if name in self._meta:
-      validator = self._meta[name].validate
-      standardizer = self._meta[name].standardize
-
-    if not validator(value):
-      raise ValidationError(name,
-          "Validation did not pass for %s for the field %s.%s" 
-          % (value, self.__class__.__name__, name)
-      )
-    value = standardizer(value)
+    prop = self._meta.get(name, None)
+    if prop is not None:
+      standardized = prop.setter()(value)
+      if standardized is INVALID:
+        raise ValidationError(name,
+            "Validation did not pass for %s for the field %s.%s"
+            % (value, self.__class__.__name__, name)
+        )
+      value = standardized
+
     self._data[name] = value
+    self._dirty.add(name)
+
+    # The value is just validated, no need to do it again on serialize unless
+    # it's missing while required.
+    if prop is not None and not (prop.required and value is None):
+      if not prop.mutable:
+        self._validated[name] = None # Same as _validationPassed
+      else:
+        self._validationPassed(name, prop, value)
+    else:
+      self._validated.pop(name, None)
+
+  def _fieldChanged(self, name):
+    """Marks a field as changed. Used when _data is modified directly."""
+    self._dirty.add(name)
+    self._validated.pop(name, None)
+
+  def _resetRaw(self, raw):
+    """Sets the data that's now in the database (usually after a save) so
+    unchanged fields could be saved back without converting them again.
+
+    Lists and dictionaries that are still the very objects in _data (their
+    convertToDb returns them as is) are copied, or changes made in place after
+    this would be in _raw as well.
+    """
+    for name, value in raw.iteritems():
+      if value is not None and value is self._data.get(name):
+        if isinstance(value, list):
+          raw[name] = list(value)
+        elif isinstance(value, dict):
+          raw[name] = dict(value)
+    self._raw = raw
+    self._dirty = set()
+    self._clean = {}
+    for name, prop in self._meta.iteritems():
+      if prop.tracked:
+        mutations = getattr(self._data.get(name), "_mutations", 0)
+        if mutations:
+          self._clean[name] = mutations
+
+  def changes(self):
+    """Gets the changes made to the document since it was loaded or saved. If
+    the document never was, everything is a change.
+
+    Fields that are collections (SetProperty, MultiReferenceProperty) are
+    reported as the elements added and removed. Other fields are reported with
+    their new value. All values are in the database form.
+
+    Returns:
+      A dictionary of {"fields" : {name : value}, "added" : {name : [elements]},
+      "removed" : {name : [elements]}, "deleted" : [names]}. deleted are the
+      fields that are no longer in the document.
+    """
+    fields = {}
+    added = {}
+    removed = {}
+    raw = self._raw or {}
+    for name, value in self._data.iteritems():
+      prop = self._meta.get(name, None)
+      old = raw.get(name)
+      if prop is None:
+        if name not in raw or old != value:
+          fields[name] = value
+        continue
+
+      if (old is not None and prop.observable(value) and
+          not self._isChanged(name, prop)):
+        continue
+
+      new = prop.convertToDb(value)
+      if name in raw and old == new:
+        continue
+
+      difference = prop.difference(old, new)
+      if difference is None:
+        fields[name] = new
+      else:
+        if difference[0]:
+          added[name] = difference[0]
+        if difference[1]:
+          removed[name] = difference[1]
+
+    deleted = [name for name in raw if name not in self._data]
+    return {"fields" : fields, "added" : added, "removed" : removed,
+            "deleted" : deleted}
+
+  def applyChanges(self, changes):
+    """Applies the changes from changes() to this document. The fields changed
+    are marked as changed, and will be saved.
+
+    Args:
+      changes: A dictionary in the format returned by changes(). Missing keys
+               are fine.
+
+    Returns:
+      self for OOP purposes.
+    """
+    for name, value in changes.get("fields", {}).iteritems():
+      prop = self._meta.get(name, None)
+      self._data[name] = value if prop is None else prop.convertFromDb(value)
+      self._fieldChanged(name)
+
+    added = changes.get("added", {})
+    removed = changes.get("removed", {})
+    for name in set(added) | set(removed):
+      prop = self._meta[name]
+      self._data[name] = prop.patch(self._data.get(name), added.get(name, ()),
+                                    removed.get(name, ()))
+      self._fieldChanged(name)
+
+    for name in changes.get("deleted", ()):
+      if name in self._data:
+        self.__delattr__(name)
+
+    return self
 
   def __getattr__(self, name):
+    # The properties are usually read through their PropertyDescriptor, this
+    # is for the others and doc[name].
     if name in self._data:
       prop = self._meta.get(name, BaseProperty)
-      if isinstance(prop, ReferenceBaseProperty):
+      if isinstance(prop, ReferenceBaseProperty) and not prop.loaded(self._data[name]):
         self._data[name] = prop.attemptLoad(self._data[name])
       return self._data[name]
 
@@ -271,6 +537,8 @@ class BaseDocument(object):
         self._data[name] = None
       else:
         del self._data[name]
+      self._dirty.add(name)
+      self._validated.pop(name, None)
     else:
       raise KeyError("'%s'" % name)
 
@@ -291,6 +559,24 @@ class SimpleDocument(BaseDocument):
   """
   _clsType = 1
 
+  # Weak references to the IndexCollections this document is in, told when
+  # the indexes change.
+  _indexCollections = None
+
+  # _links maps (bucket, key, tag) to what _linkRef gives for the linked
+  # document (a weak reference, or the document itself), or None until it is
+  # needed.
+  #
+  # _indexes and _links are copied on write: they could be shared with the
+  # caller of setIndexes or with the _clean snapshots, and are only
+  # copied when they are changed. The revisions count the changes, so the
+  # views and the RiakObjects are only rebuilt when they changed.
+  _indexesShared = False
+  _linksShared = False
+  _indexesRevision = 0
+  _linksRevision = 0
+  _indexesViewCache = (None, ())
+
   def __init__(self, key=uuid1Key, **kwargs):
     """Creates a SimpleDocument object.
 
@@ -306,10 +592,87 @@ class SimpleDocument(BaseDocument):
     BaseDocument.__init__(self, **kwargs)
 
   def clear(self, setdefault=True):
-    self._indexes = {}
-    self._links = set()
+    self._replaceIndexes({})
+    self._replaceLinks({})
+    # The indexes and links as they are in the database, for changes()
+    self._cleanIndexes = {}
+    self._cleanLinks = {}
     return BaseDocument.clear(self, setdefault)
 
+  def _resetRaw(self, raw):
+    BaseDocument._resetRaw(self, raw)
+    self._resetRelations()
+
+  def _resetRelations(self):
+    """Sets the current indexes and links as the ones in the database. They are
+    shared with the snapshot, not copied."""
+    self._cleanIndexes = self._indexes
+    self._indexesShared = True
+    self._cleanLinks = self._links
+    self._linksShared = True
+
+  def _linkKey(self, document, tag):
+    return (getattr(document, "bucket_name", None), document.key, tag)
+
+  def _linkRef(self, document):
+    """What _links holds for a linked document. The links do not keep the
+    documents alive, the ones that are collected are resolved again by
+    _resolveLink."""
+    return ref(document)
+
+  def changes(self):
+    """Gets the changes made to the document since it was loaded or saved,
+    including the indexes and the links.
+
+    Returns:
+      The same thing as BaseDocument.changes(), with the addition of
+      "indexes" : {"added" : [(field, value)], "removed" : [(field, value)]} and
+      "links" : {"added" : [(bucket, key, tag)], "removed" : [(bucket, key, tag)]}
+      bucket is None if the linked document has no bucket_name (the
+      bucket_name of this document for a Document).
+    """
+    changes = BaseDocument.changes(self)
+
+    current = set(self.indexesView())
+    clean = set((field, value) for field, values in self._cleanIndexes.iteritems() for value in values)
+    changes["indexes"] = {"added" : list(current - clean),
+                          "removed" : list(clean - current)}
+
+    current = set(self._links)
+    clean = set(self._cleanLinks)
+    changes["links"] = {"added" : list(current - clean),
+                        "removed" : list(clean - current)}
+    return changes
+
+  def applyChanges(self, changes):
+    """Applies the changes from changes(), including the indexes and the links.
+
+    Args:
+      changes: A dictionary in the format returned by changes().
+
+    Returns:
+      self for OOP purposes.
+    """
+    BaseDocument.applyChanges(self, changes)
+
+    indexes = changes.get("indexes", {})
+    for field, value in indexes.get("removed", ()):
+      self.removeIndex(field, value)
+    for field, value in indexes.get("added", ()):
+      self.addIndex(field, value)
+
+    links = changes.get("links", {})
+    removed = [tuple(l) for l in links.get("removed", ()) if tuple(l) in self._links]
+    added = [tuple(l) for l in links.get("added", ()) if tuple(l) not in self._links]
+    if removed or added:
+      writable = self._writableLinks()
+      for l in removed:
+        del writable[l]
+      for l in added:
+        writable[l] = None # Resolved when links() is called.
+
+    return self
+
   def save(self, **kwargs):
     """Not available in SimpleDocument.
 
@@ -332,9 +695,12 @@ class SimpleDocument(BaseDocument):
     Returns:
       self for OOP purposes.
     """
-    l = self._indexes.get(field, set())
+    indexes = self._writableIndexes()
+    l = indexes.get(field, set())
     l.add(value)
-    self._indexes[field] = l
+    indexes[field] = l
+    if self._indexCollections:
+      self._notifyIndexCollections("_indexAdded", field, value)
     return self
 
   def removeIndex(self, field, value=None):
@@ -347,14 +713,21 @@ class SimpleDocument(BaseDocument):
     Returns:
       self for OOP purposes
     """
+    indexes = self._writableIndexes()
     if value is None:
-      self._indexes.pop(field)
+      values = indexes.pop(field)
     else:
-      if field in self._indexes:
-        self._indexes[field].discard(value)
-        if len(self._indexes[field]) == 0:
-          self._indexes.pop(field)
-
+      values = ()
+      if field in indexes:
+        if value in indexes[field]:
+          values = (value, )
+        indexes[field].discard(value)
+        if len(indexes[field]) == 0:
+          indexes.pop(field)
+
+    if self._indexCollections:
+      for v in values:
+        self._notifyIndexCollections("_indexRemoved", field, v)
     return self
 
   def setIndexes(self, indexes):
@@ -362,14 +735,40 @@ class SimpleDocument(BaseDocument):
 
     Args:
       indexes: Format should be {"fieldname" : {"fieldvalue"}, "fieldname2" : {"fieldvalue"}}.
-               A deep copy is made here.
+               This is not copied until the document changes its indexes, so
+               it should not be modified afterwards.
 
     Returns:
       self for OOP purposes.
     """
-    self._indexes = deepcopy(indexes)
+    self._replaceIndexes(indexes)
+    self._indexesShared = True
     return self
 
+  def _writableIndexes(self):
+    """Gets _indexes to change it, copying it first if it's shared."""
+    if self._indexesShared:
+      self._indexes = dict((field, set(values)) for field, values in self._indexes.iteritems())
+      self._indexesShared = False
+    self._indexesRevision += 1
+    return self._indexes
+
+  def _replaceIndexes(self, indexes):
+    collections = self._indexCollections
+    if collections:
+      self._notifyIndexCollections("_unindex")
+    self._indexes = indexes
+    self._indexesShared = False
+    self._indexesRevision += 1
+    if collections:
+      self._notifyIndexCollections("_index")
+
+  def _notifyIndexCollections(self, method, *args):
+    for ref in self._indexCollections:
+      collection = ref()
+      if collection is not None:
+        getattr(collection, method)(self, *args)
+
   def indexes(self, field=None):
     """Retrives the whole index or a specific list of indexes for a field.
 
@@ -382,17 +781,32 @@ class SimpleDocument(BaseDocument):
     if field is not None:
       return copy(self._indexes[field])
 
-    i = []
-    for field, l in self._indexes.iteritems():
-      for value in l:
-        i.append((field, value))
-
-    return i
+    return list(self.indexesView())
 
   index = indexes # Done so that index(fieldname) is grammatically correct
 
+  def indexesView(self, field=None):
+    """Same as indexes(), without copying anything. What's returned must not be
+    modified.
+
+    Args:
+      field: the field name. Defaults to None.
+
+    Returns:
+      The set of field values, or a tuple of (field, value) pairs that is only
+      rebuilt when the indexes change.
+    """
+    if field is not None:
+      return self._indexes[field]
+
+    revision, view = self._indexesViewCache
+    if revision != self._indexesRevision:
+      view = tuple((field, value) for field, values in self._indexes.iteritems() for value in values)
+      self._indexesViewCache = (self._indexesRevision, view)
+    return view
+
   def addLink(self, document, tag=None):
-    """Adds a link for the document.
+    """Adds a link for the document. Adding the same link again does nothing.
 
     Args:
       document: A SimpleDocument object or its child. Checking will not be done.
@@ -400,7 +814,7 @@ class SimpleDocument(BaseDocument):
 
     Returns:
       self for OOP purposes"""
-    self._links.add((document, tag))
+    self._writableLinks()[self._linkKey(document, tag)] = self._linkRef(document)
     return self
 
   def removeLink(self, document, tag=None):
@@ -412,11 +826,9 @@ class SimpleDocument(BaseDocument):
 
     Returns:
       self for OOP purposes"""
-    l = set()
-    for d, t in self._links:
-      if d.key != document.key or tag != t: # TODO: Best way to do this?
-        l.add((d, t))
-    self._links = l
+    linkKey = self._linkKey(document, tag)
+    if linkKey in self._links:
+      del self._writableLinks()[linkKey]
     return self
 
   def setLinks(self, links):
@@ -424,24 +836,82 @@ class SimpleDocument(BaseDocument):
 
     Args:
       links: Format should be set((document, tag), (document, tag)).
-             A shallow copy is made here.
 
     Returns:
       self for OOP purposes"""
-    self._links = copy(links)
+    self._replaceLinks(dict((self._linkKey(d, t), self._linkRef(d)) for d, t in links))
     return self
 
+  def _replaceLinks(self, links):
+    self._links = links
+    self._linksShared = False
+    self._linksRevision += 1
+
+  def _writableLinks(self):
+    """Gets _links to change it, copying it first if it's shared."""
+    if self._linksShared:
+      self._links = dict(self._links)
+      self._linksShared = False
+    self._linksRevision += 1
+    return self._links
+
+  def _linkedDocument(self, linkKey, document):
+    """Gets the document of a link.
+
+    Args:
+      linkKey: (bucket, key, tag) of the link.
+      document: What _linkRef gave for it, or None.
+
+    Returns:
+      The document if it is still in memory, or what _resolveLink gives. The
+      key if the document could not be found.
+    """
+    if isinstance(document, ref):
+      document = document()
+    if document is None:
+      bucket, key, tag = linkKey
+      try:
+        document = self._resolveLink(bucket, key)
+      except NotFoundError:
+        return key
+      if not isinstance(document, basestring):
+        # Only remembered, not a change of the links.
+        self._links[linkKey] = self._linkRef(document)
+    return document
+
+  def _resolveLink(self, bucket, key):
+    """Gets the document of a link when it is no longer in memory. SimpleDocument
+    cannot load documents, so this gives the key.
+
+    Raises:
+      NotFoundError if the document is not there.
+    """
+    return key
+
   def links(self, bucket=None):
     """Gets all the links.
 
+    The links only hold weak references to the documents. The linked
+    SimpleDocuments that are no longer in memory are given as their key.
+
     Args:
       bucket: Defaults to None. If it is a RiakBucket, this will return a list of RiakLinks instead of (document, tag) in a set
 
     Returns:
       A set of (document, tag) or [RiakLink, RiakLink]"""
     if bucket is not None:
-      return [RiakLink(bucket.get_name(), d.key, t) for d, t in self._links]
-    return copy(self._links)
+      return [RiakLink(bucket.get_name(), k, t) for b, k, t in self._links]
+    return set((self._linkedDocument(l, d), l[2]) for l, d in self._links.items())
+
+  def linksView(self):
+    """Gets the links without resolving the documents or copying. What's
+    returned must not be modified.
+
+    Returns:
+      A dictionary of (bucket, key, tag) : weak reference to the document, or
+      None if it was never loaded. bucket is None if the linked document has no
+      bucket_name."""
+    return self._links
 
   def toRiakObject(self, bucket):
     """Converts the SimpleDocument into a RiakObject. Does not touch references,
@@ -454,11 +924,36 @@ class SimpleDocument(BaseDocument):
       A RiakObject with data, indexes, and links set according to this
       SimpleDocument
     """
-    obj = bucket.new(self.key, self.serialize())
-    obj.set_indexes(self.indexes())
+    codec = self._codec
+    data = self.serialize()
+    self._indexProperties(data)
+    obj = codec.bind(bucket).new(self.key, data, codec.content_type)
+    obj.set_indexes(self.indexesView())
     obj.set_links(self.links(bucket), True)
     return obj
 
+  def _indexProperties(self, data):
+    """Sets the indexes of the properties with index from their values. Only
+    the fields that changed since the document was loaded or saved are looked
+    at, the others' indexes are still the ones from the database. Fields whose
+    index is not there at all (saved before the property had an index) are
+    looked at too.
+
+    Args:
+      data: The serialized data.
+    """
+    raw = self._raw
+    for name, prop in self._indexed:
+      value = self._data.get(name)
+      if (raw is not None and prop.index in self._indexes and
+          prop.observable(value) and not self._isChanged(name, prop)):
+        continue
+
+      if prop.index in self._indexes:
+        self.removeIndex(prop.index)
+      for v in prop.indexValues(data.get(name)):
+        self.addIndex(prop.index, v)
+
   @staticmethod
   def _getIndexesFromRiakObj(robj):
     objIndexes = robj.get_indexes()
@@ -489,4 +984,5 @@ class SimpleDocument(BaseDocument):
     doc = cls(robj.get_key())
     doc.deserialize(robj.get_data())
     doc.setIndexes(cls._getIndexesFromRiakObj(robj))
+    doc._resetRelations()
     return doc
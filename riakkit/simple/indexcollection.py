@@ -0,0 +1,151 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, bisect_right, insort
+from weakref import ref
+
+
+class IndexCollection(object):
+  """A collection of SimpleDocuments in memory, looked up by their secondary
+  indexes like Riak does.
+
+  _bin fields are hashed, exact lookups are a dictionary lookup. _int fields
+  also keep their values sorted, so range lookups are a bisect. Documents tell
+  the collections they are in when their indexes change (addIndex,
+  removeIndex, setIndexes), the collection never goes through them again.
+
+  Documents are identified by their key.
+  """
+
+  def __init__(self, documents=()):
+    """Initializes a collection.
+
+    Args:
+      documents: The SimpleDocuments to add to it.
+    """
+    self._documents = {} # key => document
+    self._fields = {} # field => {value : set of keys}
+    self._sorted = {} # _int field => sorted list of values
+    self._ref = ref(self) # What the documents hold on to.
+    for doc in documents:
+      self.add(doc)
+
+  def add(self, doc):
+    """Adds a document to the collection.
+
+    Returns:
+      self for OOP purposes.
+    """
+    if doc.key in self._documents:
+      self.remove(self._documents[doc.key])
+
+    self._documents[doc.key] = doc
+    if doc._indexCollections is None:
+      doc._indexCollections = set()
+    doc._indexCollections.add(self._ref)
+    self._index(doc)
+    return self
+
+  def remove(self, doc):
+    """Removes a document from the collection.
+
+    Raises:
+      KeyError if the document is not in it.
+    """
+    self._unindex(doc)
+    del self._documents[doc.key]
+    doc._indexCollections.discard(self._ref)
+
+  def __len__(self):
+    return len(self._documents)
+
+  def __iter__(self):
+    return self._documents.itervalues()
+
+  def __contains__(self, doc):
+    return getattr(doc, "key", doc) in self._documents
+
+  def get(self, key):
+    """Gets a document given its key, or None."""
+    return self._documents.get(key)
+
+  def indexLookup(self, index, startkey, endkey=None):
+    """Gets the documents with a value of the index field.
+
+    Same interface as Document.indexLookup. Ranges on _bin fields go through
+    the values of the field, as they are only hashed.
+
+    Args:
+      index: The index field
+      startkey: The value, or the start of the range.
+      endkey: The end of the range (inclusive). If None, this looks up
+              startkey only. Default: None
+
+    Returns:
+      A list of documents, each only once.
+    """
+    values = self._fields.get(index)
+    if not values:
+      return []
+
+    if endkey is None:
+      keys = values.get(startkey, ())
+    else:
+      if index in self._sorted:
+        ordered = self._sorted[index]
+        inRange = ordered[bisect_left(ordered, startkey):bisect_right(ordered, endkey)]
+      else:
+        inRange = [v for v in values if startkey <= v <= endkey]
+
+      if len(inRange) == 1:
+        keys = values[inRange[0]]
+      else:
+        keys = set()
+        for v in inRange:
+          keys.update(values[v])
+
+    return [self._documents[k] for k in keys]
+
+  def _index(self, doc):
+    for field, values in doc._indexes.iteritems():
+      for value in values:
+        self._indexAdded(doc, field, value)
+
+  def _unindex(self, doc):
+    for field, values in doc._indexes.iteritems():
+      for value in values:
+        self._indexRemoved(doc, field, value)
+
+  def _indexAdded(self, doc, field, value):
+    values = self._fields.setdefault(field, {})
+    keys = values.get(value)
+    if keys is None:
+      keys = values[value] = set()
+      if field.endswith("_int"):
+        insort(self._sorted.setdefault(field, []), value)
+    keys.add(doc.key)
+
+  def _indexRemoved(self, doc, field, value):
+    values = self._fields.get(field)
+    keys = values and values.get(value)
+    if not keys:
+      return
+
+    keys.discard(doc.key)
+    if not keys:
+      del values[value]
+      ordered = self._sorted.get(field)
+      if ordered is not None:
+        del ordered[bisect_left(ordered, value)]
@@ -16,12 +16,20 @@
 import unittest
 import random
 import time
+import datetime
+import gc
+import weakref
 
 from riakkit import *
 from riakkit.helpers import emailValidator, checkPassword
-from riakkit.commons import getUniqueListGivenBucketName
+from riakkit.commons import getUniqueListGivenBucketName, walkParents
+from riakkit.commons.codecs import Codec, CompactCodec, registerCodec, getCodec
+from riakkit.commons.properties import INVALID
+from riakkit.commons.instrumentation import capture, GET, STORE, DELETE, INDEX, MAPREDUCE
+from riakkit.commons import profiling
 
 import riak
+import json
 
 def integerkeys(d):
   if d is None:
@@ -142,6 +150,104 @@ class RiakkitBaseTest(unittest.TestCase):
     self.assertEqual(None, testobj.dictprop.get("1", None))
     self.assertEqual(2, testobj.dictprop.get(1, None))
 
+  def test_composedValidators(self):
+    prop = StringProperty(validators=[lambda x: x != "a", lambda x: x != "b"],
+                          standardprocessors=[lambda x: x + "1", lambda x: x + "2"])
+    self.assertFalse(prop.validate("b"))
+    self.assertTrue(prop.validate("c"))
+    self.assertEqual(u"c12", prop.standardize("c"))
+    self.assertTrue(prop.setter()("a") is INVALID)
+    self.assertEqual(u"c12", prop.setter()("c"))
+
+    # They are composed when they are set, changing the list is not seen.
+    prop.validators.append(lambda x: x != "c")
+    self.assertTrue(prop.validate("c"))
+    self.assertEqual(u"c12", prop.setter()("c"))
+    prop.validators = prop.validators
+    self.assertFalse(prop.validate("c"))
+    self.assertTrue(prop.setter()("c") is INVALID)
+
+    prop.validators = lambda x: x != "c"
+    self.assertTrue(prop.setter()("c") is INVALID)
+    self.assertEqual(u"b12", prop.setter()("b"))
+
+  def test_setterProfiling(self):
+    class SetterModel(SimpleDocument):
+      intprop = IntegerProperty(validators=lambda x: x != 2)
+
+    prop = SetterModel._meta["intprop"]
+    setter = prop.setter()
+    self.assertTrue(setter is prop.setter())
+    obj = SetterModel(intprop=1)
+    self.assertRaises(ValidationError, setattr, obj, "intprop", 2)
+    self.assertTrue(setter(2) is INVALID)
+    self.assertEqual(1, obj.intprop)
+
+    profiling.enable(SetterModel)
+    try:
+      profiled = prop.setter()
+      self.assertFalse(profiled is setter)
+      obj.intprop = "3"
+      self.assertRaises(ValidationError, setattr, obj, "intprop", 2)
+    finally:
+      profiling.disable(SetterModel)
+
+    rows = dict((name, calls) for name, calls, seconds in profiling.report())
+    self.assertEquals(2, rows["SetterModel.intprop.validate"])
+    self.assertEquals(1, rows["SetterModel.intprop.standardize"])
+    self.assertFalse(prop.setter() is profiled)
+    self.assertTrue(prop.setter()(2) is INVALID)
+    self.assertEqual(3, obj.intprop)
+
+  def test_fusedSetters(self):
+    class OddInteger(IntegerProperty):
+      def validate(self, value):
+        return IntegerProperty.validate(self, value) and (value is None or int(value) % 2 == 1)
+
+    props = [IntegerProperty(), IntegerProperty(standardprocessors=lambda x: x and x * 2),
+             FloatProperty(validators=lambda x: x != "2"), StringProperty(),
+             BooleanProperty(), DynamicProperty(validators=lambda x: x is not None),
+             OddInteger(), DateTimeProperty(), DateTimeProperty(utc=True, milliseconds=True),
+             DateTimeProperty(utc=True, validators=lambda x: getattr(x, "year", 0) > 1969)]
+    for prop in props:
+      for value in (None, 1, "2", "3.5", 4.5, "", "abc", u"\xe9"):
+        if prop.validate(value):
+          expected = prop.standardize(value)
+        else:
+          expected = INVALID
+        actual = prop.setter()(value)
+        self.assertEqual(expected, actual)
+        self.assertEqual(type(expected), type(actual))
+
+  def test_utcDateTime(self):
+    class EventModel(BaseDocument):
+      seconds = DateTimeProperty(utc=True)
+      milliseconds = DateTimeProperty(utc=True, milliseconds=True, index=True)
+
+    moment = datetime.datetime(2012, 2, 29, 23, 59, 58, 123456)
+    obj = EventModel(seconds=moment, milliseconds=moment)
+    data = obj.serialize()
+    self.assertEqual(1330559998, data["seconds"])
+    self.assertEqual(1330559998123, data["milliseconds"])
+    self.assertEqual(int, type(data["seconds"]))
+
+    obj = EventModel().deserialize(data)
+    self.assertEqual(moment.replace(microsecond=0), obj.seconds)
+    self.assertEqual(moment.replace(microsecond=123000), obj.milliseconds)
+
+    obj.milliseconds = 1000
+    self.assertEqual(datetime.datetime(1970, 1, 1, 0, 0, 1), obj.milliseconds)
+    self.assertRaises(ValidationError, lambda: setattr(obj, "seconds", 1e20))
+
+    class Plus2(datetime.tzinfo):
+      def utcoffset(self, dt):
+        return datetime.timedelta(hours=2)
+    obj.seconds = datetime.datetime(2012, 3, 1, 1, 59, 58, tzinfo=Plus2())
+    self.assertEqual(moment.replace(microsecond=0), obj.seconds)
+
+    self.assertTrue(abs(datetime.datetime.utcnow() - EventModel().seconds).seconds < 5)
+    self.assertRaises(RiakkitError, lambda: DateTimeProperty(milliseconds=True))
+
   def test_references(self):
     refobj = ReferenceTestModel()
     refobj.ref = self.simpleobj
@@ -153,6 +259,211 @@ class RiakkitBaseTest(unittest.TestCase):
   def test_getattr(self):
     self.assertRaises(AttributeError, lambda: self.testobj.none_exist)
 
+  def test_propertyDescriptors(self):
+    self.assertTrue(TestModel.intprop is TestModel._meta["intprop"])
+    self.testobj.intprop = 5
+    self.assertEqual(5, self.testobj.intprop)
+    self.testobj.clear(False)
+    self.assertRaises(AttributeError, lambda: self.testobj.intprop)
+
+    class ClashingModel(SimpleDocument):
+      index = StringProperty(default="value")
+      other = StringProperty()
+
+    class ClashingChild(ClashingModel):
+      third = IntegerProperty()
+
+    obj = ClashingChild(other="a", third=1)
+    self.assertTrue(callable(obj.index)) # Still the method
+    self.assertEqual("value", obj["index"])
+    self.assertEqual("a", obj.other)
+    self.assertEqual(1, obj.third)
+
+    refobj = ReferenceTestModel()
+    refobj.refsdict = {"a" : self.simpleobj}
+    self.assertTrue(refobj.refsdict["a"] is self.simpleobj)
+    self.assertTrue(refobj.refsdict is refobj.refsdict)
+
+  def test_rawPassthrough(self):
+    testobj = self.testobj
+    timestamp = 1325376000.5 # Microseconds are lost converting this back and forth.
+    testobj.deserialize({"floatprop" : 1.0, "listprop" : [1, 2],
+                         "datetimeprop" : timestamp, "floatprocessorprop" : 1.0})
+
+    dictionary = testobj.serialize()
+    self.assertEqual(timestamp, dictionary["datetimeprop"])
+    self.assertEqual(2.0, dictionary["floatprocessorprop"]) # forwardprocessors always run
+
+    testobj.datetimeprop = testobj.datetimeprop
+    self.assertEqual(int(timestamp), testobj.serialize()["datetimeprop"])
+
+    del testobj.floatprop
+    self.assertRaises(ValidationError, testobj.serialize)
+
+  def test_rawNotShared(self):
+    class EmDocumentsModel(BaseDocument):
+      emlist = EmDocumentsListProperty(TestEmDocument)
+      emdict = EmDocumentsDictProperty(TestEmDocument)
+
+    em = {"email" : "test@test.com", "listprop" : [], "intprop" : 1}
+    data = {"emlist" : [em], "emdict" : {"a" : em}}
+    obj = EmDocumentsModel().deserialize(data)
+    self.assertEquals({"emlist" : [em], "emdict" : {"a" : em}}, data)
+    self.assertFalse(obj._raw is data)
+
+    obj.emlist[0].intprop = 2
+    self.assertEquals([em], obj._raw["emlist"])
+    self.assertEquals(2, obj.serialize()["emlist"][0]["intprop"])
+
+  def test_validateOnce(self):
+    calls = []
+    def validator(value):
+      calls.append(value)
+      return value != "bad"
+
+    class ValidateOnceModel(BaseDocument):
+      prop = StringProperty(validators=validator)
+      required = StringProperty(required=True)
+
+    obj = ValidateOnceModel(prop="good", required="yes")
+    self.assertEqual(1, len(calls))
+    obj.serialize()
+    obj.serialize()
+    self.assertTrue(obj.valid())
+    self.assertEqual(1, len(calls))
+
+    obj.required = None
+    self.assertFalse(obj.valid())
+    self.assertRaises(ValidationError, obj.serialize)
+
+    obj.deserialize({"prop" : "bad", "required" : "yes"})
+    self.assertFalse(obj.valid())
+    obj.prop = "good"
+    self.assertTrue(obj.valid())
+
+  def test_trackedContainers(self):
+    class TrackedModel(BaseDocument):
+      setprop = SetProperty()
+      listprop = ListProperty(validators=lambda x: len(x) < 3)
+
+    obj = TrackedModel().deserialize({"setprop" : [1, 2], "listprop" : [1]})
+    self.assertTrue(isinstance(obj.setprop, TrackedSet))
+    self.assertTrue(isinstance(obj.listprop, TrackedList))
+
+    raw = obj._raw["setprop"]
+    self.assertTrue(raw is obj.serialize()["setprop"])
+    obj.setprop.add(3)
+    self.assertEqual([1, 2, 3], sorted(obj.serialize()["setprop"]))
+
+    self.assertTrue(obj.valid())
+    obj.listprop.extend([2, 3])
+    self.assertFalse(obj.valid())
+    obj.listprop.pop()
+    self.assertTrue(obj.valid())
+
+  def test_codecs(self):
+    self.simpleobj.someprop = "moo"
+    self.assertEqual(json.dumps(self.simpleobj.serialize()), self.simpleobj.serialize(False))
+
+    reversedCodec = registerCodec(Codec("test_reversed", "text/plain",
+        lambda d: json.dumps(d)[::-1], lambda s: json.loads(s[::-1])))
+    self.assertTrue(getCodec("test_reversed") is reversedCodec)
+    self.assertRaises(RiakkitError, lambda: getCodec("not_a_codec"))
+
+    class CodecTestModel(SimpleDocument):
+      codec = "test_reversed"
+      someprop = StringProperty()
+
+    obj = CodecTestModel(someprop="moo")
+    encoded = obj.serialize(False)
+    self.assertEqual(json.dumps({u"someprop" : u"moo"})[::-1], encoded)
+    self.assertEqual(u"moo", CodecTestModel().deserialize(encoded).someprop)
+
+    # Binding replaces the default encoders, but not the ones of other codecs.
+    bucket = riak.RiakClient().bucket("test_codecs")
+    reversedCodec.bind(bucket)
+    self.assertTrue(bucket.get_encoder("text/plain") is reversedCodec.encode)
+    reversedCodec.bind(bucket)
+    otherCodec = Codec("test_other", "text/plain", json.dumps, json.loads)
+    self.assertRaises(RiakkitError, otherCodec.bind, bucket)
+    jsonCodec = Codec("test_json", "application/json", json.dumps, json.loads)
+    jsonCodec.bind(bucket)
+    self.assertTrue(bucket.get_decoder("application/json") is json.loads)
+    Codec("test_json2", "application/json", json.dumps, json.loads).bind(bucket)
+
+  def test_compactCodec(self):
+    layouts = [("kind", "active", "tags"),
+               ("kind", "active", "tags", "deleted", "count")]
+
+    class CompactModel(SimpleDocument):
+      codec = CompactCodec(layouts)
+      kind = EnumProperty(["post", "comment"])
+      active = BooleanProperty()
+      deleted = BooleanProperty()
+      tags = SetProperty()
+      count = IntegerProperty()
+
+    obj = CompactModel(kind="comment", active=True, deleted=False, tags=set(["b", "a"]), count=3)
+    obj.dynamic = "value"
+    encoded = obj.serialize(False)
+    self.assertEqual([2, 2 | 1 << 2, 1, ["a", "b"], 3, {"dynamic" : "value"}], json.loads(encoded))
+    self.assertTrue(len(encoded) < len(json.dumps(obj.serialize())))
+    self.assertTrue(CompactModel._codec.content_type.startswith("application/x-riakkit-compact"))
+
+    loaded = CompactModel().deserialize(encoded)
+    self.assertEqual(obj.serialize(), loaded.serialize())
+
+    # Dictionaries and the older layouts are still read.
+    loaded = CompactModel().deserialize(json.dumps({"kind" : 0, "count" : 1, "active" : None}))
+    self.assertEqual(("post", 1, None), (loaded.kind, loaded.count, loaded.active))
+    loaded = CompactModel().deserialize(json.dumps([1, 1, 1, ["x"]]))
+    self.assertEqual(("comment", False, set(["x"]), None), (loaded.kind, loaded.active, loaded.tags, loaded.count))
+    self.assertRaises(RiakkitError, lambda: CompactModel().deserialize("[3, 0]"))
+
+    class OtherCompactModel(SimpleDocument): # Same layouts, active isn't a boolean.
+      codec = CompactCodec(layouts)
+      kind = EnumProperty(["post", "comment"])
+      active = StringProperty()
+      deleted = BooleanProperty()
+      tags = SetProperty()
+      count = IntegerProperty()
+
+    bucket = riak.RiakClient().bucket("test_compact")
+    CompactModel._codec.bind(bucket)
+    CompactModel._codec.forClass(CompactModel).bind(bucket)
+    self.assertRaises(RiakkitError, OtherCompactModel._codec.bind, bucket)
+
+    def unknownField():
+      class UnknownFieldModel(SimpleDocument):
+        codec = CompactCodec([("kind", "unknown")])
+        kind = StringProperty()
+    self.assertRaises(RiakkitError, unknownField)
+
+  def test_inheritance(self):
+    class A(BaseDocument):
+      a = StringProperty(default="a")
+      shared = StringProperty(default="A")
+
+    class B(A):
+      b = IntegerProperty()
+
+    class C(A):
+      shared = StringProperty(default="C")
+
+    class D(B, C):
+      pass
+
+    self.assertEqual([B, C, A], walkParents((B, C), ("BaseDocument", "object")))
+    self.assertEqual([B, A], walkParents((B, ), ("BaseDocument", "object")))
+    self.assertEqual(set(["a", "b", "shared"]), set(D._meta))
+    self.assertEqual("a", D().a)
+
+    # The walks are cached on the classes, which could still be collected.
+    classes = weakref.WeakSet([A, B, C, D])
+    del A, B, C, D
+    gc.collect()
+    self.assertEqual(0, len(classes))
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -279,6 +590,161 @@ class RiakkitSimpleTest(unittest.TestCase):
     self.assertEquals(1, len(doc.indexes()))
     self.assertEquals({"str"}, doc.index("field_bin"))
 
+  def test_changes(self):
+    class ChangesModel(SimpleDocument):
+      intprop = IntegerProperty()
+      setprop = SetProperty()
+
+    b = riak.RiakClient().bucket("test")
+    o = b.new("o1")
+    o.set_data({"intprop" : 1, "setprop" : [1, 2]})
+    o.add_index("field_bin", "str")
+    doc = ChangesModel.load(o)
+
+    self.assertEquals({"fields" : {}, "added" : {}, "removed" : {}, "deleted" : [],
+                       "indexes" : {"added" : [], "removed" : []},
+                       "links" : {"added" : [], "removed" : []}}, doc.changes())
+
+    doc.intprop = 2
+    doc.setprop.add(3)
+    doc.setprop.discard(1)
+    doc.removeIndex("field_bin", "str")
+    doc.addIndex("field_int", 42)
+    changes = doc.changes()
+    self.assertEquals({"intprop" : 2}, changes["fields"])
+    self.assertEquals({"setprop" : [3]}, changes["added"])
+    self.assertEquals({"setprop" : [1]}, changes["removed"])
+    self.assertEquals([("field_int", 42)], changes["indexes"]["added"])
+    self.assertEquals([("field_bin", "str")], changes["indexes"]["removed"])
+
+    other = ChangesModel.load(o)
+    self.assertEquals(other, other.applyChanges(changes))
+    self.assertEquals(2, other.intprop)
+    self.assertEquals({2, 3}, other.setprop)
+    self.assertEquals([("field_int", 42)], other.indexes())
+    self.assertEquals(doc.serialize(), other.serialize())
+
+    doc._resetRaw(doc.serialize(dictionary=True))
+    self.assertEquals({}, doc.changes()["fields"])
+    self.assertEquals([], doc.changes()["indexes"]["added"])
+
+  def test_propertyIndexes(self):
+    class IndexedModel(SimpleDocument):
+      age = IntegerProperty(index=True)
+      name = StringProperty(index="nick_bin")
+      tags = SetProperty(index=True)
+
+    b = riak.RiakClient().bucket("test")
+    doc = IndexedModel(age=18, name="bob", tags={"a", "b"})
+    o = doc.toRiakObject(b)
+    self.assertEquals([18], o.get_indexes("age_int"))
+    self.assertEquals(["bob"], o.get_indexes("nick_bin"))
+    self.assertEquals(["a", "b"], sorted(o.get_indexes("tags_bin")))
+
+    doc = IndexedModel.load(o)
+    doc.age = 19
+    doc.tags.discard("a")
+    o = doc.toRiakObject(b)
+    self.assertEquals([19], o.get_indexes("age_int"))
+    self.assertEquals(["b"], o.get_indexes("tags_bin"))
+    self.assertEquals(["bob"], o.get_indexes("nick_bin"))
+
+    self.assertRaises(RiakkitError, type, "BadIndexModel", (SimpleDocument, ),
+                      {"prop" : StringProperty(index="prop")})
+
+  def test_indexesView(self):
+    obj = SimpleModel()
+    indexes = {"field_bin" : {"a"}}
+    obj.setIndexes(indexes)
+    view = obj.indexesView()
+    self.assertEquals((("field_bin", "a"), ), view)
+    self.assertTrue(view is obj.indexesView())
+    self.assertEquals({"a"}, obj.indexesView("field_bin"))
+
+    obj.addIndex("field_bin", "b") # Copied on write
+    self.assertEquals({"field_bin" : {"a"}}, indexes)
+    self.assertEquals([("field_bin", "a"), ("field_bin", "b")], sorted(obj.indexesView()))
+
+    links = {(obj, "tag")}
+    other = SimpleModel()
+    other.setLinks(links)
+    view = other.linksView()
+    self.assertTrue(view is other.linksView())
+    other._resetRelations()
+    other.addLink(other, "tag2") # Copied on write
+    self.assertEquals(1, len(view))
+    self.assertEquals(2, len(other.linksView()))
+
+  def test_keyedLinks(self):
+    obj = SimpleModel("keyed")
+    linked = SimpleModel("linked")
+    obj.addLink(linked, "tag")
+    obj.addLink(SimpleModel("linked"), "tag") # Same key, coalesced
+    self.assertEquals({(None, "linked", "tag")}, set(obj.linksView()))
+
+    obj.removeLink(SimpleModel("linked"), "tag")
+    self.assertEquals(set(), obj.links())
+
+    obj.addLink(linked, "tag")
+    obj._resetRelations()
+    del linked # The links do not keep it alive.
+    self.assertEquals({("linked", "tag")}, obj.links())
+
+    obj.applyChanges({"links" : {"added" : [(None, "other", None)], "removed" : [(None, "linked", "tag")]}})
+    self.assertEquals({("other", None)}, obj.links())
+    self.assertEquals({"added" : [(None, "other", None)], "removed" : [(None, "linked", "tag")]}, obj.changes()["links"])
+
+  def test_profiling(self):
+    class ProfiledModel(SimpleDocument):
+      intprop = IntegerProperty(backwardprocessors=lambda x: x)
+
+    profiling.enable(ProfiledModel)
+    try:
+      obj = ProfiledModel(intprop=1)
+      obj.deserialize(obj.serialize())
+      obj.deserialize({"intprop" : 2})
+    finally:
+      profiling.disable(ProfiledModel)
+
+    rows = dict((name, calls) for name, calls, seconds in profiling.report())
+    self.assertEquals(2, rows["ProfiledModel.intprop.convertFromDb"])
+    self.assertEquals(2, rows["ProfiledModel.intprop.backwardprocessors <lambda>"])
+    self.assertEquals(1, rows["ProfiledModel.intprop.convertToDb"])
+    self.assertEquals(1, rows["ProfiledModel.intprop.validate"])
+    self.assertFalse("convertFromDb" in ProfiledModel._meta["intprop"].__dict__)
+
+    class ProfiledChild(ProfiledModel): # Shares intprop
+      pass
+
+    profiling.enable(ProfiledModel)
+    profiling.enable(ProfiledChild)
+    profiling.disable(ProfiledChild)
+    self.assertTrue("convertFromDb" in ProfiledModel._meta["intprop"].__dict__)
+    profiling.disable(ProfiledModel)
+    self.assertFalse("convertFromDb" in ProfiledModel._meta["intprop"].__dict__)
+
+  def test_indexCollection(self):
+    docs = [SimpleModel("doc%d" % i).addIndex("age_int", i).addIndex("name_bin", "name%d" % (i % 2))
+            for i in xrange(10)]
+    collection = IndexCollection(docs)
+    self.assertEquals(10, len(collection))
+    self.assertEquals([docs[3]], collection.indexLookup("age_int", 3))
+    self.assertEquals(docs[2:6], sorted(collection.indexLookup("age_int", 2, 5), key=lambda d: d.indexes("age_int").pop()))
+    self.assertEquals(5, len(collection.indexLookup("name_bin", "name1")))
+    self.assertEquals([], collection.indexLookup("none_bin", "a"))
+
+    docs[3].removeIndex("age_int", 3)
+    self.assertEquals([], collection.indexLookup("age_int", 3))
+    docs[3].addIndex("age_int", 42)
+    self.assertEquals([docs[3]], collection.indexLookup("age_int", 40, 50))
+    docs[3].setIndexes({"other_bin" : {"a"}})
+    self.assertEquals([], collection.indexLookup("age_int", 40, 50))
+    self.assertEquals([docs[3]], collection.indexLookup("other_bin", "a"))
+
+    collection.remove(docs[3])
+    self.assertFalse(docs[3] in collection)
+    self.assertEquals([], collection.indexLookup("other_bin", "a"))
+
   def test_simpleReferences(self):
     c = riak.RiakClient()
     b = c.bucket("test")
@@ -336,6 +802,33 @@ class Comment(BaseDocumentModel):
   author = ReferenceProperty(User, collection_name="comments")
   content = StringProperty()
 
+class ShardedComment(BaseDocumentModel):
+  bucket_name = "test_shardedcomments"
+
+  author = ReferenceProperty(User, collection_name="sharded_comments",
+                             collection_storage="sharded", collection_shards=4)
+  content = StringProperty()
+
+class IndexedComment(BaseDocumentModel):
+  bucket_name = "test_indexedcomments"
+
+  author = ReferenceProperty(User, collection_name="indexed_comments",
+                             collection_storage="index")
+
+class IndexedUser(BaseDocumentModel):
+  bucket_name = "test_indexedusers"
+
+  age = IntegerProperty(index=True)
+  name = StringProperty()
+
+class AggregatedModel(BaseDocumentModel):
+  bucket_name = "test_aggregate"
+
+  intprop = IntegerProperty()
+  kind = StringProperty()
+  tags = ListProperty()
+  since = DateTimeProperty(default=lambda: datetime.datetime(2012, 1, 1))
+
 class EmDocumentWithRef(EmDocument):
   ref = ReferenceProperty(SearchableModel)
 
@@ -376,6 +869,40 @@ class RiakkitDocumentTests(unittest.TestCase):
     self.assertTrue(uo.exists())
     uo.delete()
 
+  def test_changesAfterSave(self):
+    m = AggregatedModel(intprop=1, tags=["a"])
+    m.save()
+    self.assertEquals({}, m.changes()["fields"])
+
+    m.tags.append("b")
+    self.assertEquals({"tags" : ["a", "b"]}, m.changes()["fields"])
+    m.save()
+    self.assertEquals({}, m.changes()["fields"])
+    self.assertEquals(["a", "b"], AggregatedModel.load(m.key, True).tags)
+
+    m.delete()
+
+  def test_codec(self):
+    calls = []
+    def encode(data):
+      calls.append("encode")
+      return json.dumps(data)
+    def decode(data):
+      calls.append("decode")
+      return json.loads(data)
+
+    class CodecModel(BaseDocumentModel):
+      bucket_name = "test_codec"
+      codec = Codec("test_counting", "application/json", encode, decode)
+
+      name = StringProperty()
+
+    doc = CodecModel(name="foo").save()
+    self.assertEquals(["encode"], calls)
+    self.assertEquals("foo", CodecModel.load(doc.key).name)
+    self.assertEquals(["encode", "decode"], calls)
+    doc.delete()
+
   def test_cachingDelete(self):
     user1 = User(username="foo", password="123")
     key = user1.key
@@ -475,6 +1002,82 @@ class RiakkitDocumentTests(unittest.TestCase):
     user1.delete()
     user2.delete()
 
+  def test_linksNotInDatabase(self):
+    user1 = User(username="foo_linksNotInDatabase", password="123")
+    user1.addLink(SimpleModel("simple"), "simple")
+    user1.addLink(User(username="bar_linksNotInDatabase", password="123"), "unsaved")
+    # Could not be loaded again, so they are held on to.
+    self.assertEquals({"SimpleModel", "User"}, set(type(d).__name__ for d, t in user1.links()))
+
+    user1.save()
+    User.instances.clear()
+    user1 = User.load(user1.key)
+    self.assertTrue(("test_users", "simple", "simple") in user1.linksView())
+    self.assertTrue(("simple", "simple") in user1.links()) # Given as the key.
+    user1.removeLink(SimpleModel("simple"), "simple")
+    self.assertEquals([("test_users", "simple", "simple")], user1.changes()["links"]["removed"])
+    user1.delete()
+
+  def test_linkWalk(self):
+    user1 = User(username="foo_linkWalk", password="123")
+    user2 = User(username="bar_linkWalk", password="123")
+    user3 = User(username="baz_linkWalk", password="123")
+    user3.save()
+    user2.addLink(user3, "friend").save()
+    user1.addLink(user2, "friend").addLink(user3, "other").save()
+
+    for local in (False, True):
+      self.assertEquals([user2.key], [u.key for u in user1.walk("friend", local=local)])
+      self.assertEquals([user3.key], [u.key for u in user1.walk("friend", 2, local=local)])
+      self.assertEquals({user2.key, user3.key}, set(u.key for u in user1.walk(local=local)))
+      self.assertEquals(0, len(User.linkWalk(user3.key, local=local)))
+
+    unsaved = User(username="qux_linkWalk", password="123")
+    user3.addLink(unsaved, "friend") # Not saved, only in memory.
+    self.assertEquals([unsaved], list(user3.walk("friend", local=True)))
+    self.assertEquals([unsaved], list(user2.walk("friend", 2, local=True)))
+
+    keys = [user1.key, user2.key, user3.key]
+    del user1, user2, user3, unsaved
+    gc.collect()
+    with capture() as stats:
+      self.assertEquals([keys[2]], [u.key for u in User.linkWalk(keys[0], "friend", 2, local=True)])
+    self.assertEquals(0, stats.count(GET, User.bucket_name))
+    self.assertEquals(3, stats.count(MAPREDUCE)) # The first document, then one per hop.
+
+    for key in keys:
+      User.get(key).delete()
+
+  def test_lateClient(self):
+    class LateModel(Document):
+      bucket_name = "test_late"
+
+      name = StringProperty(unique=True)
+
+    self.assertRaises(RiakkitError, lambda: LateModel.bucket)
+    self.assertRaises(RiakkitError, lambda: LateModel._meta["name"].unique_bucket)
+    LateModel.client = riak.RiakClient()
+    doc = LateModel(name="late").save()
+    self.assertEquals("test_late", LateModel.bucket.get_name())
+    self.assertTrue(LateModel._meta["name"].unique_bucket.get("late").exists())
+    doc.delete()
+
+  def test_instrumentation(self):
+    with capture() as stats:
+      user = User(username="foo_instrumentation", password="123").save()
+    self.assertEquals(1, stats.count(STORE, User.bucket_name))
+    self.assertEquals(2, stats.count(STORE)) # The document and its unique username
+    self.assertEquals(1, stats.maxDepth())
+    self.assertEquals({(getUniqueListGivenBucketName(User.bucket_name, "username"), "foo_instrumentation") : 2},
+                      stats.repeated(GET))
+
+    with capture() as stats:
+      User.load(user.key)
+      user.delete()
+    self.assertEquals(1, stats.count(GET, User.bucket_name))
+    self.assertEquals(2, stats.count(DELETE))
+    self.assertTrue(stats.latency() > 0)
+
   def test_exists(self):
     user1 = User(username="foo_exists", password="123")
     user1.save()
@@ -512,6 +1115,111 @@ class RiakkitDocumentTests(unittest.TestCase):
     user1.comments[0].delete()
     user1.delete()
 
+  def test_shardedReferences(self):
+    user1 = User(username="foo_sharded", password="123")
+    user1.save()
+    comment1 = ShardedComment(author=user1, content="Hello World!")
+    comment1.save()
+    comment2 = ShardedComment(author=user1, content="Hello World 2!")
+    comment2.save()
+
+    self.assertFalse("sharded_comments" in user1.serialize())
+    self.assertEquals(2, len(user1.sharded_comments))
+    self.assertTrue(comment1 in user1.sharded_comments)
+    self.assertEquals({comment1.key, comment2.key}, set(user1.sharded_comments.keys()))
+    self.assertEquals(sorted([comment1, comment2], key=lambda x: x.content),
+                      sorted(user1.sharded_comments, key=lambda x: x.content))
+
+    comment1.delete()
+    self.assertEquals([comment2.key], list(user1.sharded_comments.keys()))
+
+    user1key = user1.key
+    user1.delete()
+    self.assertEquals(None, comment2.author)
+    self.assertEquals(0, len(User.sharded_comments.query(user1key)))
+    comment2.delete()
+
+  def test_indexedReferences(self):
+    user1 = User(username="foo_indexed", password="123")
+    user1.save()
+    comment1 = IndexedComment(author=user1)
+    comment1.save()
+
+    self.assertFalse("indexed_comments" in user1.serialize())
+    self.assertEquals({user1.key}, comment1.index("author_bin"))
+    self.assertEquals([comment1], user1.indexed_comments.all())
+
+    user1.delete()
+    self.assertEquals(None, comment1.author)
+    self.assertRaises(KeyError, lambda: comment1.index("author_bin"))
+    comment1.delete()
+
+  def test_query(self):
+    user1 = IndexedUser(age=18, name="foo").save()
+    user2 = IndexedUser(age=25, name="bar").save()
+
+    self.assertEquals([user1], IndexedUser.query(age=18).all())
+    self.assertEquals(2, IndexedUser.query(age__range=(18, 25)).length())
+    self.assertRaises(RiakkitError, IndexedUser.query, name="foo")
+    self.assertRaises(RiakkitError, IndexedUser.query, age=18, name="foo")
+    self.assertRaises(RiakkitError, IndexedUser.query, age=None)
+
+    # Saved without the index, like before age had index=True.
+    riak.RiakClient().bucket("test_indexedusers").new("noindex", {"age" : 30, "name" : "baz"}).store()
+    user3 = IndexedUser.load("noindex")
+    self.assertEquals(0, IndexedUser.query(age=30).length())
+    user3.save()
+    self.assertEquals([user3], IndexedUser.query(age=30).all())
+
+    user1.delete()
+    user2.delete()
+    user3.delete()
+
+  def test_queryFilters(self):
+    user1 = IndexedUser("admin-1", age=18, name="foo").save()
+    user2 = IndexedUser("user-2", age=20, name="bar").save()
+    user3 = IndexedUser("user-3", age=25, name="foo").save()
+
+    q = IndexedUser.query(age__range=(18, 25)).where(name="foo")
+    self.assertEquals({user1.key, user3.key}, set(q.keys()))
+    self.assertEquals(2, len(q.all()))
+    self.assertRaises(RiakkitError, q.where, name="bar")
+
+    q = IndexedUser.query(age__range=(18, 25)).keyFilter("tokenize", "-", 1).keyFilter("eq", "user")
+    self.assertEquals({user2.key, user3.key}, set(q.keys()))
+    q = IndexedUser.query(age__range=(18, 25)).keyFilter("starts_with", "user").where(name="foo")
+    self.assertEquals([user3], q.all())
+    q = IndexedUser.query(age__range=(19, 25)).where(age__range=(21, 30))
+    self.assertEquals([user3.key], q.keys())
+
+    user1.delete()
+    user2.delete()
+    user3.delete()
+
+  def test_queryFetches(self):
+    user1 = IndexedUser("fetch-1", age=40, name="foo").save()
+    user2 = IndexedUser("fetch-2", age=41, name="bar").save()
+    keys = [user1.key, user2.key]
+    del user1, user2
+    gc.collect()
+
+    with capture() as stats:
+      docs = IndexedUser.query(age__range=(40, 41)).where(name="foo").all()
+    self.assertEquals(["foo"], [d.name for d in docs])
+    self.assertEquals({("age_int", 40)}, set(docs[0].indexesView()))
+    self.assertEquals(0, stats.count(GET))
+    self.assertEquals(1, stats.count(INDEX))
+    self.assertEquals(0, stats.count(MAPREDUCE))
+
+    with capture() as stats:
+      docs = IndexedUser.query(age__range=(40, 41)).all()
+    self.assertEquals(["bar", "foo"], sorted(d.name for d in docs))
+    self.assertEquals(0, stats.count(GET))
+    self.assertEquals(1, stats.count(MAPREDUCE))
+
+    for key in keys:
+      IndexedUser.get(key).delete()
+
   def test_referencesDeleteTarget(self): # deletes user, as Comment is the origin
     user1 = User(username="refdeltarget", password="123")
     comment1 = Comment(author=user1, content="Hello World!")
@@ -667,6 +1375,37 @@ class RiakkitDocumentTests(unittest.TestCase):
     m2.delete()
     m3.delete()
 
+  def test_mapreduceBuilder(self):
+    m1 = AggregatedModel(intprop=2, kind="a", tags=["x"]).save()
+    m2 = AggregatedModel(intprop=3, kind="a", tags=["y"]).save()
+    m3 = AggregatedModel(intprop=7, kind="b", tags=["x", "y"]).save()
+
+    self.assertEquals(3, AggregatedModel.mapreduce().count())
+    self.assertEquals(12, AggregatedModel.mapreduce().sum("intprop"))
+    self.assertEquals(2, AggregatedModel.mapreduce().min("intprop"))
+    self.assertEquals(7, AggregatedModel.mapreduce().max("intprop"))
+    self.assertEquals({"a" : 2, "b" : 1}, AggregatedModel.mapreduce().groupBy("kind"))
+    o = riak.RiakClient().bucket("test_aggregate").new("nokind", {"intprop" : 1}).store()
+    self.assertEquals({"a" : 2, "b" : 1, None : 1}, AggregatedModel.mapreduce().groupBy("kind"))
+    # Not the default of the property, which is only given to loaded documents.
+    self.assertEquals({datetime.datetime(2012, 1, 1) : 3, None : 1}, AggregatedModel.mapreduce().groupBy("since"))
+    o.delete()
+
+    self.assertEquals(2, AggregatedModel.mapreduce().filter(kind="a").count())
+    self.assertEquals(2, AggregatedModel.mapreduce().filter(intprop__range=(3, 10)).count())
+    self.assertEquals(2, AggregatedModel.mapreduce().filter(kind="a", tags="x").sum("intprop"))
+    self.assertEquals(1, AggregatedModel.mapreduce().keyFilter("eq", m3.key).count())
+
+    values = AggregatedModel.mapreduce().filter(kind="b").values("tags")
+    self.assertEquals([(m3.key, {"tags" : ["x", "y"]})], values)
+
+    self.assertRaises(RiakkitError, AggregatedModel.mapreduce().sum, "kind")
+    self.assertRaises(RiakkitError, AggregatedModel.mapreduce().groupBy, "tags")
+
+    m1.delete()
+    m2.delete()
+    m3.delete()
+
   def test_emdocumentWithReference(self):
     # Since there's no collection_names, no ensuring that saving d will save m.
     # TODO: Fix this?
@@ -793,6 +1532,45 @@ class RiakkitPropertyTests(unittest.TestCase):
     fr = prop.convertFromDb(to)
     self.assertEquals({1, 2, 3}, fr)
 
+  def test_referenceContainers(self):
+    doc = SimpleModel("b")
+    l = ReferenceList(["a", doc, "c"])
+    self.assertTrue(l.hasKey("b"))
+    self.assertFalse(l.hasKey("d"))
+
+    l.append("d")
+    self.assertTrue(l.hasKey("d"))
+    self.assertTrue(l.removeKey("b"))
+    self.assertFalse(l.removeKey("b"))
+    self.assertEquals(["a", "d", "c"], l) # The last one took its place.
+    self.assertTrue(l.hasKey("c"))
+    self.assertTrue(l.removeKey("c"))
+    self.assertEquals("d", l.pop())
+    self.assertFalse(l.hasKey("d"))
+    l.extend(["b", "b"])
+    self.assertTrue(l.removeKey("a"))
+    self.assertEquals(["b", "b"], l)
+    self.assertTrue(l.removeKey("b") and l.removeKey("b"))
+    self.assertEquals([], l)
+    l.append("a")
+    l[0] = "e"
+    self.assertFalse(l.hasKey("a"))
+    self.assertTrue(l.hasKey("e"))
+
+    d = ReferenceDict(x="a", y=doc)
+    self.assertTrue(d.hasKey("b"))
+    d["z"] = doc
+    self.assertTrue(d.removeKey("b"))
+    self.assertEquals({"x" : "a"}, d)
+    self.assertFalse(d.hasKey("b"))
+
+    refdoc = ReferenceTestModel(multirefs=["a", "b"], refsdict={"x" : "b"})
+    self.assertTrue(isinstance(refdoc.multirefs, ReferenceList))
+    self.assertTrue(ReferenceTestModel.multirefs.deleteReference(refdoc, doc))
+    self.assertEquals(["a"], refdoc.multirefs)
+    self.assertTrue(ReferenceTestModel.refsdict.deleteReference(refdoc, doc))
+    self.assertEquals({}, refdoc.refsdict)
+
   def test_emdocumentDictProperty(self):
     prop = EmDocumentsDictProperty(emdocument_class=TestEmDocument)
 